@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import dynamo_batch
+import price
+import price_history
+import pricing_engine
+import table_backend
+import telemetry
+
+# Reprices the whole catalog with the demand/supply rule, e.g. after
+# DEMAND_COEFFICIENT changes, instead of waiting for each product's next
+# stream MODIFY. Products is read with a paginated parallel Scan, one worker
+# per segment; each page is priced in one price_batch call, compared with
+# the stored CurrentPrice and only the prices that moved are written back.
+# Writes are versioned like competitor's: each one is conditional on the
+# Version that was read, and a write that loses a race with a live update
+# re-reads the item and tries again. All writers share one write capacity
+# budget.
+#
+#   python catalog_reprice.py --segments 16 --wcu 4000
+
+# Parallel scan segments, one worker each
+CATALOG_REPRICE_SEGMENTS = int(os.environ.get('CATALOG_REPRICE_SEGMENTS', '16'))
+
+# Write capacity units per second the job may consume on CurrentPrice
+CATALOG_REPRICE_WCU = float(os.environ.get('CATALOG_REPRICE_WCU', '1000'))
+
+# Attempts of a conditional write that keeps losing to live updates, and its backoff
+MAX_WRITE_ATTEMPTS = int(os.environ.get('CATALOG_REPRICE_MAX_WRITE_ATTEMPTS', '5'))
+BASE_BACKOFF_SECONDS = 0.02
+MAX_BACKOFF_SECONDS = 1.0
+
+PRODUCTS_TABLE_NAME = 'Products'
+CURRENT_PRICE_TABLE_NAME = 'CurrentPrice'
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+class WriteBudget:
+    # Token bucket shared by the writers: at most rate capacity units per second
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        units = min(units, self.rate)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return
+                wait = (units - self.tokens) / self.rate
+            time.sleep(wait)
+
+def write_price(table, product_id, new_price, item, budget):
+    # Write new_price (a Price) if the item's Version is still the one that
+    # was read, re-reading and retrying when it is not. Returns 'Written',
+    # 'Unchanged' when the stored price already matches, or 'Conflict' once
+    # the retry budget is spent.
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        if item is not None and 'CurrentPrice' in item and price.Price.parse(item['CurrentPrice']) == new_price:
+            return 'Unchanged'
+
+        version = (item or {}).get('Version')
+        values = {':new_price': new_price.to_decimal(), ':next_version': (version or 0) + 1}
+        if item is None:
+            condition = 'attribute_not_exists(ProductID)'
+        elif version is None:
+            condition = 'attribute_exists(ProductID) AND attribute_not_exists(Version)'
+        else:
+            condition = 'Version = :version'
+            values[':version'] = version
+
+        budget.acquire(1)
+        try:
+            table.update_item(
+                Key={'ProductID': product_id},
+                UpdateExpression='SET CurrentPrice = :new_price, Version = :next_version',
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values
+            )
+            return 'Written'
+        except Exception as e:
+            if not table_backend.is_conditional_check_failed(e):
+                raise
+            if attempt + 1 >= MAX_WRITE_ATTEMPTS:
+                break
+            time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * (2 ** attempt))))
+            item = table.get_item(Key={'ProductID': product_id}, ConsistentRead=True).get('Item')
+    return 'Conflict'
+
+def reprice_page(items, budget):
+    # Price one page of Products and write the CurrentPrices that changed.
+    # Returns (priced, written, skipped, conflicts).
+    products = [item for item in items if 'BasePrice' in item and 'Demand' in item and 'Stock' in item]
+    if not products:
+        return 0, 0, len(items), 0
+
+    new_prices = pricing_engine.to_prices(pricing_engine.price_batch(
+        base_price=[price.Price.parse(item['BasePrice']) for item in products],
+        demand=[item['Demand'] for item in products],
+        stock=[item['Stock'] for item in products]
+    ))
+
+    # Read the stored prices so unchanged products cost no write
+    stored, unprocessed = dynamo_batch.batch_get_items(table_backend.get_resource(), {
+        CURRENT_PRICE_TABLE_NAME: [{'ProductID': item['ProductID']} for item in products]
+    })
+    if unprocessed:
+        raise RuntimeError(f"Could not read current prices: {unprocessed}")
+    stored = {item['ProductID']: item for item in stored[CURRENT_PRICE_TABLE_NAME]}
+
+    changed = []
+    for item, new_price in zip(products, new_prices):
+        if new_price is None:
+            continue
+        current = stored.get(item['ProductID'])
+        if current is not None and 'CurrentPrice' in current and price.Price.parse(current['CurrentPrice']) == new_price:
+            continue
+        changed.append((item, new_price, current))
+
+    written = conflicts = 0
+    for (item, new_price, _), status, error in dynamo_batch.map_concurrently(
+            lambda write: write_price(dynamo_batch.worker_table(CURRENT_PRICE_TABLE_NAME),
+                                      write[0]['ProductID'], write[1], write[2], budget), changed):
+        if error:
+            raise error
+        if status == 'Conflict':
+            log.warning("CurrentPrice kept changing during the reprice, leaving it", ProductID=item['ProductID'])
+            conflicts += 1
+        elif status == 'Written':
+            written += 1
+            price_history.record(item['ProductID'], new_price, 'demand_and_supply',
+                                 base_price=item['BasePrice'], demand=item['Demand'], stock=item['Stock'])
+
+    # Keep the history buffer to one page
+    price_history.flush()
+    return len(products), written, len(items) - len(products), conflicts
+
+def _reprice_segment(segment, total_segments, budget, stop):
+    table = table_backend.get_thread_resource().Table(PRODUCTS_TABLE_NAME)
+    kwargs = {
+        'ProjectionExpression': 'ProductID, BasePrice, Demand, Stock',
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+    totals = [0, 0, 0, 0]
+    while not stop.is_set():
+        response = table.scan(**kwargs)
+        for position, count in enumerate(reprice_page(response['Items'], budget)):
+            totals[position] += count
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        kwargs['ExclusiveStartKey'] = last_key
+    return totals
+
+def reprice(total_segments=None, segments=None, wcu=None):
+    # Reprice the given scan segments (all of them by default) of the catalog
+    total_segments = total_segments or CATALOG_REPRICE_SEGMENTS
+    segments = list(range(total_segments)) if segments is None else list(segments)
+    budget = WriteBudget(wcu or CATALOG_REPRICE_WCU)
+    stop = threading.Event()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(telemetry.propagate(_reprice_segment), segment, total_segments, budget, stop) for segment in segments]
+        try:
+            results = [future.result() for future in futures]
+        except Exception:
+            # Stop the other workers at their next page
+            stop.set()
+            raise
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        'Segments': len(segments),
+        'TotalSegments': total_segments,
+        'Priced': sum(priced for priced, _, _, _ in results),
+        'Written': sum(written for _, written, _, _ in results),
+        'Skipped': sum(skipped for _, _, skipped, _ in results),
+        'Conflicts': sum(conflicts for _, _, _, conflicts in results),
+        'Seconds': round(elapsed, 3)
+    }
+    summary['ProductsPerSecond'] = round(summary['Priced'] / elapsed, 1) if elapsed else None
+    telemetry.count('PricesUpdated', summary['Written'])
+    telemetry.count('WriteConflicts', summary['Conflicts'])
+    log.info("Repriced catalog", **summary)
+    return summary
+
+@telemetry.instrument
+def lambda_handler(event, context):
+    # event may name TotalSegments and the Segments this invocation handles,
+    # so a Step Functions Map state can spread one reprice over invocations
+    try:
+        summary = reprice(event.get('TotalSegments'), event.get('Segments'), event.get('WCU'))
+    except Exception as e:
+        log.exception("Catalog reprice failed", Error=e)
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Catalog reprice failed: {e}")
+        }
+    return {
+        'statusCode': 200,
+        'body': price.dumps(summary)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprice every product with the demand/supply rule')
+    parser.add_argument('--segments', type=int, default=CATALOG_REPRICE_SEGMENTS, help='parallel scan segments')
+    parser.add_argument('--wcu', type=float, default=CATALOG_REPRICE_WCU, help='write capacity units per second')
+    args = parser.parse_args()
+
+    print(json.dumps(reprice(total_segments=args.segments, wcu=args.wcu), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import os
+import threading
+import telemetry
+import rate_limiter
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Region used when AWS_REGION / AWS_DEFAULT_REGION are not set
+DEFAULT_REGION = 'us-east-2'
+
+# Connection settings shared by every client and resource
+MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '50'))
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('CLIENT_CONNECT_TIMEOUT_SECONDS', '2'))
+READ_TIMEOUT_SECONDS = float(os.environ.get('CLIENT_READ_TIMEOUT_SECONDS', '10'))
+MAX_ATTEMPTS = int(os.environ.get('CLIENT_MAX_ATTEMPTS', '5'))
+# botocore's adaptive mode rate limits each client on its own; with the shared
+# rate limiter on, standard retries leave the rate to it
+RETRY_MODE = os.environ.get('CLIENT_RETRY_MODE', 'standard' if rate_limiter.RATE_LIMIT_ENABLED else 'adaptive')
+TCP_KEEPALIVE = os.environ.get('CLIENT_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+# Client operations that go through the shared rate limiter
+RATE_LIMITED_OPERATIONS = {'events': ('put_events',)}
+
+# Services whose calls go through the shared rate limiter: every DynamoDB
+# table call (see dynamo_trace) and the operations above. With the limiter
+# on, their clients make a single attempt and the limiter does all the
+# retrying, so a throttle is backed off once, in one place, and the
+# limiter sees every one of them.
+RATE_LIMITED_SERVICES = {'dynamodb'} | set(RATE_LIMITED_OPERATIONS)
+
+# Clients and resources created so far, kept across warm invocations
+_clients = {}
+_resources = {}
+_session = None
+_lock = threading.Lock()
+
+# Resources owned by a single thread, for pool workers
+_thread = threading.local()
+
+def region():
+    return os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or DEFAULT_REGION
+
+def config(service=None):
+    # botocore Config tuned for the handlers: a pool large enough for the
+    # concurrent batch helpers, keep-alive, short timeouts and adaptive retries
+    # (none for the services the rate limiter retries)
+    from botocore.config import Config
+    single_attempt = rate_limiter.RATE_LIMIT_ENABLED and service in RATE_LIMITED_SERVICES
+    return Config(
+        region_name=region(),
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT_SECONDS,
+        read_timeout=READ_TIMEOUT_SECONDS,
+        tcp_keepalive=TCP_KEEPALIVE,
+        retries={'max_attempts': 1 if single_attempt else MAX_ATTEMPTS, 'mode': RETRY_MODE}
+    )
+
+def _get_session():
+    # boto3 is imported on first use so handlers that never call AWS skip its import cost
+    global _session
+    if _session is None:
+        import boto3
+        _session = boto3.session.Session()
+    return _session
+
+def _cache_key(service, kwargs):
+    return (service, tuple(sorted(kwargs.items())))
+
+def client(service, **kwargs):
+    # Return the shared client for service, creating it on first use
+    key = _cache_key(service, kwargs)
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                instance = _get_session().client(service, config=config(service), **kwargs)
+                if rate_limiter.RATE_LIMIT_ENABLED and service in RATE_LIMITED_OPERATIONS:
+                    instance = rate_limiter.LimitedClient(instance, service, RATE_LIMITED_OPERATIONS[service])
+                _clients[key] = instance
+                log.info("Created client", Service=service)
+    return _clients[key]
+
+def resource(service, **kwargs):
+    # Return the shared resource for service, creating it on first use
+    key = _cache_key(service, kwargs)
+    if key not in _resources:
+        with _lock:
+            if key not in _resources:
+                _resources[key] = _get_session().resource(service, config=config(service), **kwargs)
+                log.info("Created resource", Service=service)
+    return _resources[key]
+
+def thread_resource(service):
+    # Return the calling thread's own resource for service. boto3 resources
+    # and sessions are not thread-safe, so pool workers must not share the
+    # one returned by resource(); each worker thread creates one, once.
+    resources = _thread.__dict__.setdefault('resources', {})
+    if service not in resources:
+        import boto3
+        resources[service] = boto3.session.Session().resource(service, config=config(service))
+        log.info("Created thread resource", Service=service, Thread=threading.current_thread().name)
+    return resources[service]
+
+def register(service, instance, kind='client', **kwargs):
+    # Use instance for service from now on, e.g. a stub when running locally
+    cache = _clients if kind == 'client' else _resources
+    cache[_cache_key(service, kwargs)] = instance
+
+def reset():
+    # Forget every client, resource and the session
+    global _session
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+        _session = None
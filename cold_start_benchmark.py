@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Measures what each handler costs a fresh container before it can serve a
+# request (module import, including resource creation at import time), and
+# what a warm invocation pays to get its clients: a new boto3 resource per
+# call, as the handlers used to do, against the shared clients module.
+#
+#   python cold_start_benchmark.py --runs 10 --backend dynamodb
+
+HANDLERS = [
+    'competitor',
+    'competitor_trigger',
+    'customer',
+    'customer_trigger',
+    'demand_and_supply',
+    'demand_supply_trigger',
+    'price_aggregator',
+    'price_quote',
+    'seasonal_sales',
+    'seasonal_sales_trigger'
+]
+
+# Runs in a fresh interpreter: import one handler and report the time taken
+_COLD_START = """
+import sys, json, time
+start = time.perf_counter()
+modules = len(sys.modules)
+import importlib
+importlib.import_module(sys.argv[1])
+print(json.dumps({'ImportMs': (time.perf_counter() - start) * 1000, 'Modules': len(sys.modules) - modules}))
+"""
+
+def cold_start(handler, runs, backend):
+    env = dict(os.environ, TABLE_BACKEND=backend)
+    env.setdefault('AWS_REGION', 'us-east-2')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', _COLD_START, handler],
+            cwd=directory, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    import_ms = sorted(sample['ImportMs'] for sample in samples)
+    return {
+        'Handler': handler,
+        'MedianImportMs': statistics.median(import_ms),
+        'MaxImportMs': import_ms[-1],
+        'Modules': samples[-1]['Modules']
+    }
+
+def warm_clients(iterations):
+    # Cost per invocation of getting a DynamoDB resource and a Lambda client
+    import boto3
+    import clients
+    os.environ.setdefault('AWS_REGION', 'us-east-2')
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        boto3.resource('dynamodb', region_name=clients.region())
+        boto3.client('lambda', region_name=clients.region())
+    per_call = (time.perf_counter() - start) * 1000 / iterations
+
+    clients.reset()
+    start = time.perf_counter()
+    clients.resource('dynamodb')
+    clients.client('lambda')
+    first_shared = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        clients.resource('dynamodb')
+        clients.client('lambda')
+    shared = (time.perf_counter() - start) * 1000 / iterations
+
+    return {'NewPerInvocationMs': per_call, 'SharedFirstUseMs': first_shared, 'SharedWarmMs': shared}
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start and client creation benchmark for the handlers')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler')
+    parser.add_argument('--iterations', type=int, default=20, help='warm invocations to average over')
+    parser.add_argument('--backend', default='dynamodb', choices=['dynamodb', 'memory', 'sqlite'])
+    parser.add_argument('--handler', action='append', help='only benchmark these handlers')
+    args = parser.parse_args()
+
+    print(f"{'Handler':<26}{'Median import ms':>18}{'Max import ms':>15}{'Modules':>9}")
+    for handler in args.handler or HANDLERS:
+        result = cold_start(handler, args.runs, args.backend)
+        print(f"{result['Handler']:<26}{result['MedianImportMs']:>18.1f}{result['MaxImportMs']:>15.1f}{result['Modules']:>9}")
+
+    warm = warm_clients(args.iterations)
+    print()
+    print(f"New resource and client per invocation: {warm['NewPerInvocationMs']:.2f} ms")
+    print(f"Shared clients, first use:              {warm['SharedFirstUseMs']:.2f} ms")
+    print(f"Shared clients, warm invocation:        {warm['SharedWarmMs']:.4f} ms")
+
+if __name__ == '__main__':
+    main()
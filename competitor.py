@@ -1,103 +1,208 @@
+import os
 import json
-import boto3
-from decimal import Decimal
+import time
+import threading
 import random
-import logging
-
-# Initialize a logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Initialize a DynamoDB client
-dynamodb = boto3.resource('dynamodb')
+import dynamo_batch
+import event_publisher
+import item_cache
+import price
+import price_aggregator
+import price_history
+import pricing_engine
+import table_backend
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
 # Define the DynamoDB table names as strings
 PRODUCTS_TABLE = 'CurrentPrice'
 
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
+# Optimistic concurrency: every CurrentPrice write bumps Version, and a
+# write that loses a race is re-read and retried with jittered exponential
+# backoff, up to MAX_WRITE_ATTEMPTS attempts
+MAX_WRITE_ATTEMPTS = int(os.environ.get('COMPETITOR_MAX_WRITE_ATTEMPTS', '5'))
+BASE_BACKOFF_SECONDS = 0.02
+MAX_BACKOFF_SECONDS = 1.0
+
+# Conflict and retry counters, kept across warm invocations
+OCC_STATS = {'Writes': 0, 'Conflicts': 0, 'Retries': 0, 'Exhausted': 0}
+_occ_stats_lock = threading.Lock()
+
+def _count(name, amount=1):
+    with _occ_stats_lock:
+        OCC_STATS[name] += amount
+
+def write_price(table, product_id, new_price, item):
+    # Write new_price (a Price) if the item's Version is still the one that was read.
+    # Returns (status, attributes): 200 with the new item, 404 if the item
+    # is gone, or 409 once the retry budget is spent.
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        if item is None:
+            return 404, None
+
+        version = item.get('Version')
+        values = {':new_price': new_price.to_decimal(), ':next_version': (version or 0) + 1}
+        if version is None:
+            condition = 'attribute_exists(ProductID) AND attribute_not_exists(Version)'
+        else:
+            condition = 'Version = :version'
+            values[':version'] = version
 
+        try:
+            _count('Writes')
+            response = table.update_item(
+                Key={'ProductID': product_id},
+                UpdateExpression='SET CurrentPrice = :new_price, Version = :next_version',
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW'
+            )
+            return 200, response['Attributes']
+        except Exception as e:
+            if not table_backend.is_conditional_check_failed(e):
+                raise
+            _count('Conflicts')
+            if attempt + 1 >= MAX_WRITE_ATTEMPTS:
+                break
+            _count('Retries')
+            time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * (2 ** attempt))))
+            item = table.get_item(Key={'ProductID': product_id}, ConsistentRead=True).get('Item')
+
+    _count('Exhausted')
+    return 409, None
+
+def apply_updates(updates):
+    # Apply a list of competitor price updates in a single pass. Returns one
+    # result per distinct ProductID with a 'Status' of 200, 404 or 409.
+    # Only the last update for a product matters
+    latest = {}
+    for update in updates:
+        latest[update['ProductID']] = update
+
+    # Fetch the current prices, served from the warm cache when possible
+    items, unprocessed = item_cache.batch_get_items(
+        table_backend.get_resource(), {PRODUCTS_TABLE: [{'ProductID': product_id} for product_id in latest]}
+    )
+    if unprocessed:
+        raise RuntimeError(f"Could not read current prices: {unprocessed}")
+    products = {item['ProductID']: item for item in items[PRODUCTS_TABLE]}
+
+    results = []
+    found = []
+    for product_id, update in latest.items():
+        if product_id in products:
+            found.append((product_id, update))
+        else:
+            log.warning("Product not found", ProductID=product_id)
+            results.append({'ProductID': product_id, 'Status': 404})
+
+    # Calculate the new current prices
+    competitor_prices = {
+        product_id: price.Price.parse(update.get('NewCompetitorPrice', '0')) for product_id, update in found
+    }
+    new_prices = pricing_engine.to_prices(pricing_engine.price_batch(
+        competitor_price=[competitor_prices[product_id] for product_id, _ in found],
+        competitor_offset=[random.choice(pricing_engine.COMPETITOR_OFFSETS) for _ in found]
+    )) if found else []
+
+    # Update the current prices with versioned conditional writes
+    writes = []
+    for (product_id, update), new_price in zip(found, new_prices):
+        log.debug("Calculated NewCurrentPrice", ProductID=product_id, NewCurrentPrice=new_price)
+        writes.append((product_id, new_price, products[product_id]))
+
+    if price_aggregator.PRICE_AGGREGATION_ENABLED:
+        # Hand the prices to the aggregator instead of writing them
+        outcomes = [
+            (write, (200, None), error) for write, _, error in price_aggregator.submit_signals(
+                'competitor', [(write, write[0], write[1]) for write in writes])
+        ]
+    else:
+        outcomes = dynamo_batch.map_concurrently(
+            lambda write: write_price(dynamo_batch.worker_table(PRODUCTS_TABLE), *write), writes)
+
+    for (product_id, new_price, _), (status, attributes), error in outcomes:
+        if error:
+            raise error
+
+        if status == 409:
+            # The cached item is stale, make the next invocation read it again
+            item_cache.cache.invalidate(PRODUCTS_TABLE, {'ProductID': product_id})
+            log.warning("Conditional check failed, the current price might have been updated by another process", ProductID=product_id)
+            results.append({'ProductID': product_id, 'Status': 409})
+        elif status == 404:
+            item_cache.cache.invalidate(PRODUCTS_TABLE, {'ProductID': product_id})
+            log.warning("Product not found", ProductID=product_id)
+            results.append({'ProductID': product_id, 'Status': 404})
+        else:
+            if attributes is not None:
+                log.debug("Updated CurrentPrice", ProductID=product_id, CurrentPrice=new_price, Version=attributes['Version'])
+                # Keep the cached copy in step with the write
+                item_cache.cache.put(PRODUCTS_TABLE, {'ProductID': product_id}, attributes)
+            if not price_aggregator.PRICE_AGGREGATION_ENABLED:
+                # The aggregator records the price it writes, not the signal
+                price_history.record(product_id, new_price, 'competitor', competitor_price=competitor_prices[product_id])
+            results.append({'ProductID': product_id, 'Status': 200, 'NewCurrentPrice': str(new_price)})
+
+    statuses = [result['Status'] for result in results]
+    telemetry.count('PricesUpdated', statuses.count(200))
+    telemetry.count('ProductsNotFound', statuses.count(404))
+    telemetry.count('WriteConflicts', statuses.count(409))
+    return results
+
+@telemetry.instrument
 def lambda_handler(event, context):
     try:
-        logger.info("Starting current price update function")
-        logger.info(f"Received event: {json.dumps(event)}")
+        log.debug("Received event", Event=event)
 
         # Extract the updated item details from the event
-            detail = event.get('detail', {})
+        detail = event.get('detail', {})
 
         if not detail:
-            logger.error("No detail found in the event")
+            log.error("No detail found in the event")
             return {
                 'statusCode': 400,
                 'body': json.dumps("No detail found in the event")
             }
 
+        # A versioned envelope carries many updates in one event
+        if detail.get('Version') == event_publisher.ENVELOPE_VERSION:
+            updates = detail.get('Updates', [])
+            log.info("Processing envelope", Updates=len(updates))
+            results = apply_updates(updates)
+            log.info("Optimistic concurrency stats", **OCC_STATS)
+            return {
+                'statusCode': 200,
+                'body': price.dumps({'Results': results, 'ConcurrencyStats': OCC_STATS})
+            }
+
         competitor_id = detail.get('CompetitorID')
         product_id = detail.get('ProductID')
-        new_competitor_price =
-        Decimal(detail.get('NewCompetitorPrice', '0'))
-
-        logger.info(f"Processing CompetitorID: {competitor_id},
-        ProductID: {product_id}, NewCompetitorPrice:
-        {new_competitor_price}")
+        log.debug("Processing competitor price update", CompetitorID=competitor_id, ProductID=product_id, NewCompetitorPrice=detail.get('NewCompetitorPrice', '0'))
 
-           # Fetch the product details from the Products table
-        product_table = dynamodb.Table(PRODUCTS_TABLE)
-        product_response = product_table.get_item(Key={'ProductID':product_id})
+        result, = apply_updates([detail])
+        log.debug("Optimistic concurrency stats", **OCC_STATS)
 
-        if 'Item' in product_response:
-            product = product_response['Item']
-            current_price = product.get('CurrentPrice', Decimal('0'))
-
-            # Calculate the new current price
-            new_price = new_competitor_price + Decimal(random.choice([-1, 1]))
-
-            logger.info(f"Calculated NewCurrentPrice: {new_price} for ProductID: {product_id}")
-
-            # Update the product's current price in the Products table with conditional write
-            try:
-                update_response = product_table.update_item(
-                Key={'ProductID': product_id},
-                UpdateExpression='SET CurrentPrice = :new_price',
-                ConditionExpression='CurrentPrice = :current_price',
-                ExpressionAttributeValues={':new_price': new_price,':current_price': current_price
-                },
-                ReturnValues='UPDATED_NEW'
-                )
-
-                logger.info(f"UpdateResponse: {update_response}")
-
-                # Log the actual update response attributes
-                updated_attributes = update_response.get('Attributes', {})
-                logger.info(f"Updated Attributes:{updated_attributes}")
-
-                if 'CurrentPrice' in updated_attributes and updated_attributes['CurrentPrice'] == new_price:
-                    logger.info(f"Successfully updated CurrentPrice to {new_price} for ProductID: {product_id}")
-                else:
-                    logger.error(f"Failed to update CurrentPrice for ProductID: {product_id}")
-
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps({'ProductID': product_id,
-                    'NewCurrentPrice': str(new_price)}, default=decimal_default)
-                }
-            except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
-                logger.warning(f"Conditional check failed for ProductID: {product_id}. The current price might have been updated by another process.")
-                return {
-                    'statusCode': 409,
-                    'body': json.dumps(f"Conditional check failed for ProductID: {product_id}. The current price might have been updated by another process.")
-                }
-        else:
-            logger.warning(f"Product not found for ProductID:{product_id}")
+        if result['Status'] == 404:
             return {
                 'statusCode': 404,
                 'body': json.dumps(f"Product not found for ProductID: {product_id}")
             }
+        if result['Status'] == 409:
+            return {
+                'statusCode': 409,
+                'body': json.dumps(f"Conditional check failed for ProductID: {product_id}. The current price might have been updated by another process.")
+            }
+        return {
+            'statusCode': 200,
+            'body': price.dumps({'ProductID': product_id,
+            'NewCurrentPrice': result['NewCurrentPrice']})
+        }
     except Exception as e:
-        logger.error(f"Error processing the request: {e}")
+        log.exception("Error processing the request", Error=e)
         return {
-        'statusCode': 500,
-        'body': json.dumps(f"Internal server error: {e}")
+            'statusCode': 500,
+            'body': json.dumps(f"Internal server error: {e}")
         }
@@ -1,57 +1,130 @@
+import os
 import json
-import boto3
-from decimal import Decimal, Context, setcontext, Inexact, Rounded
 import random
-import logging
+import clients
+import dynamo_batch
+import event_publisher
+import key_sampler
+import price
+import table_backend
+import telemetry
 
-# Initialize a logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Initialize clients
-dynamodb = boto3.resource('dynamodb')
-eventbridge = boto3.client('events')
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
 # Define the DynamoDB table name as a string
 COMPETITOR_TABLE = 'Competitor'
-
-# Set the decimal context to avoid Inexact and Rounded errors
-context = Context(prec=10, rounding=None, traps=[Inexact, Rounded])
-setcontext(context)
-
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
-
+COMPETITOR_KEY = ('CompetitorID', 'ProductID')
+
+# Number of competitor price updates generated per invocation, and how they
+# are published: 'single' sends one event per update, 'envelope' packs many
+# updates into each event. Both can be overridden by the invoking event.
+UPDATES_PER_INVOCATION = int(os.environ.get('COMPETITOR_UPDATES_PER_INVOCATION', '1'))
+EVENT_MODE = os.environ.get('COMPETITOR_EVENT_MODE', 'single')
+
+def random_competitor_price():
+    # A competitor price between 10.00 and 100.00
+    return price.Price(random.randint(1000, 10000))
+
+def generate_updates(table, count):
+    # Give count randomly sampled competitor items a new price. Returns the
+    # event details of the items that were updated.
+    index = key_sampler.get_index(table, COMPETITOR_KEY)
+    if not len(index):
+        return []
+
+    writes = []
+    for _ in range(count):
+        key = index.sample()
+        new_competitor_price = random_competitor_price()
+        writes.append(((key, new_competitor_price), {
+            'Key': key,
+            'UpdateExpression': 'SET CompetitorPrice = :val1',
+            'ConditionExpression': 'attribute_exists(CompetitorID)',
+            'ExpressionAttributeValues': {':val1': new_competitor_price.to_decimal()}
+        }))
+
+    updates = []
+    for (key, new_competitor_price), _, error in dynamo_batch.update_items(table, writes):
+        if table_backend.is_conditional_check_failed(error):
+            # The item was deleted since the index was built
+            index.discard(key)
+            continue
+        if error:
+            raise error
+        updates.append({
+            'CompetitorID': key['CompetitorID'],
+            'ProductID': key['ProductID'],
+            'NewCompetitorPrice': str(new_competitor_price)
+        })
+    return updates
+
+def publish_updates(updates, mode):
+    # Publish the updates through a buffered publisher, either one event per
+    # update or packed into versioned envelopes
+    publisher = event_publisher.EventPublisher(clients.client('events'), 'my.lambda.competitorprice', 'CompetitorPriceUpdate')
+    details = event_publisher.pack_envelopes(updates) if mode == 'envelope' else updates
+    for detail in details:
+        publisher.add(detail)
+    publisher.flush()
+    return publisher.stats()
+
+@telemetry.instrument
 def lambda_handler(event, context):
     try:
-        # Log the start of the function
-        logger.info(f"Starting update function for table {COMPETITOR_TABLE}")
-
         # Get the DynamoDB table
-        table = dynamodb.Table(COMPETITOR_TABLE)
-
-        # Fetch all items from the table
-        response = table.scan()
-        items = response['Items']
-
-        if items:
-            # Select a random item
-            random_item = random.choice(items)
-            competitor_id = random_item['CompetitorID']
-            product_id = random_item['ProductID']
-            new_competitor_price = Decimal(str(round(random.uniform(10.0, 100.0), 2)))
-
-            # Update the item in DynamoDB
-            table.update_item(
-                Key={'CompetitorID': competitor_id, 'ProductID': product_id},
-                UpdateExpression='SET CompetitorPrice = :val1',
-                ExpressionAttributeValues={':val1': new_competitor_price}
-            )
+        table = table_backend.get_resource().Table(COMPETITOR_TABLE)
+
+        count = int(event.get('Count', UPDATES_PER_INVOCATION))
+        mode = event.get('Mode', EVENT_MODE)
+        if count > 1 or mode == 'envelope':
+            # Generator mode: many updates per invocation, published in batches
+            updates = generate_updates(table, count)
+            if not updates:
+                log.warning("No items found in the DynamoDB table", Table=COMPETITOR_TABLE)
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps("No items found in the DynamoDB table")
+                }
+
+            stats = publish_updates(updates, mode)
+            log.info("Generated competitor price updates", Updates=len(updates), Mode=mode, **stats)
+            telemetry.count('CompetitorUpdates', len(updates))
+            telemetry.count('EventsPublished', stats['Published'])
+            telemetry.count('EventsFailed', stats['Failed'])
+            return {
+                'statusCode': 200 if not stats['Failed'] else 207,
+                'body': json.dumps(dict(stats, Updates=len(updates), Mode=mode))
+            }
+
+        # Select a random key from the cached key index
+        random_key = key_sampler.random_key(table, COMPETITOR_KEY)
+
+        if random_key:
+            competitor_id = random_key['CompetitorID']
+            product_id = random_key['ProductID']
+            new_competitor_price = random_competitor_price()
+
+            # Update the item in DynamoDB, unless it was deleted since the index was built
+            try:
+                table.update_item(
+                    Key=random_key,
+                    UpdateExpression='SET CompetitorPrice = :val1',
+                    ConditionExpression='attribute_exists(CompetitorID)',
+                    ExpressionAttributeValues={':val1': new_competitor_price.to_decimal()}
+                )
+            except Exception as e:
+                if not table_backend.is_conditional_check_failed(e):
+                    raise
+                key_sampler.get_index(table, COMPETITOR_KEY).discard(random_key)
+                log.warning("Sampled item no longer exists", CompetitorID=competitor_id, ProductID=product_id)
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps("Sampled item no longer exists in the DynamoDB table")
+                }
 
             # Log the updated item details
-            logger.info(f"Updated CompetitorID: {competitor_id} with NewCompetitorPrice: {new_competitor_price}")
+            log.debug("Updated competitor price", CompetitorID=competitor_id, ProductID=product_id, NewCompetitorPrice=new_competitor_price)
 
             # Prepare the event details
             updated_item = {
@@ -61,34 +134,36 @@ def lambda_handler(event, context):
             }
 
             # Send event to EventBridge
-            response = eventbridge.put_events(
+            response = clients.client('events').put_events(
                 Entries=[
                     {
                         'Source': 'my.lambda.competitorprice',
                         'DetailType': 'CompetitorPriceUpdate',
-                        'Detail': json.dumps(updated_item, default=decimal_default),
+                        'Detail': price.dumps(updated_item),
                         'EventBusName': 'default'
                     }
                 ]
             )
 
             # Log the EventBridge response
-            logger.info(f"EventBridge response: {response}")
+            log.debug("EventBridge response", Response=response)
+            telemetry.count('CompetitorUpdates')
+            telemetry.count('EventsFailed' if response.get('FailedEntryCount') else 'EventsPublished')
 
             return {
                 'statusCode': 200,
-                'body': json.dumps(updated_item, default=decimal_default)
+                'body': price.dumps(updated_item)
             }
 
         else:
-            logger.warning("No items found in the DynamoDB table")
+            log.warning("No items found in the DynamoDB table", Table=COMPETITOR_TABLE)
             return {
                 'statusCode': 404,
                 'body': json.dumps("No items found in the DynamoDB table")
             }
 
     except Exception as e:
-        logger.error(f"Error processing the request: {e}")
+        log.exception("Error processing the request", Error=e)
         return {
             'statusCode': 500,
             'body': json.dumps(f"Internal server error: {e}")
@@ -1,22 +1,19 @@
 import json
-import boto3
-import logging
-from decimal import Decimal
+import dynamo_batch
+import idempotency
+import item_cache
+import price
+import price_history
+import pricing_engine
+import record_executor
+import table_backend
+import telemetry
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Initialize DynamoDB resource with specified region
-dynamodb = boto3.resource('dynamodb', region_name='us-east-2')
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
 # Define the loyalty level coefficients
-LOYALTY_COEFFICIENTS = {
-    'Bronze': Decimal('0.02'),
-    'Silver': Decimal('0.05'),
-    'Gold': Decimal('0.10'),
-    'Platinum': Decimal('0.15')
-}
+LOYALTY_COEFFICIENTS = pricing_engine.LOYALTY_COEFFICIENTS
 
 # Define the loyalty level thresholds
 LOYALTY_THRESHOLDS = [
@@ -26,14 +23,9 @@ LOYALTY_THRESHOLDS = [
     (0, 'Bronze')
 ]
 
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
-
 def calculate_new_price(base_price, loyalty_level):
-    coefficient = LOYALTY_COEFFICIENTS.get(loyalty_level, Decimal('0.02'))  # Default to Bronze if not found
-    return base_price * (Decimal('1.0') + coefficient)
+    # Unknown loyalty levels are priced as Bronze
+    return pricing_engine.price_one(base_price=base_price, loyalty_level=loyalty_level)
 
 def determine_loyalty_level(total_spent):
     for threshold, level in LOYALTY_THRESHOLDS:
@@ -41,86 +33,212 @@ def determine_loyalty_level(total_spent):
             return level
     return 'Bronze'  # Default to Bronze if no threshold matches
 
+def selection_key(record):
+    # Idempotency key of a selection record: its SelectionID, or the stream
+    # sequence number for images without one
+    new_image = record['dynamodb']['NewImage']
+    if 'SelectionID' in new_image:
+        return new_image['SelectionID']['S']
+    return record['dynamodb']['SequenceNumber']
+
+def apply_spend(customer_table, customer_id, spends, customer):
+    # Add the (key, Price) spends to the customer's TotalSpent with one
+    # atomic ADD that also claims their keys, then move the loyalty level if
+    # the new total crosses a threshold. customer is the item as read.
+    # Returns the keys applied and the keys an earlier delivery had applied.
+    loyalty_level = customer['LoyaltyLevel']
+    duplicates = []
+    while True:
+        delta = sum((spend for _, spend in spends), price.ZERO)
+        claim = idempotency.inline_claim([key for key, _ in spends], customer)
+        update = {
+            'Key': {'CustomerID': customer_id},
+            'UpdateExpression': "ADD TotalSpent :delta",
+            'ExpressionAttributeValues': {':delta': delta.to_decimal()},
+            'ReturnValues': 'UPDATED_NEW'
+        }
+        if claim:
+            update['UpdateExpression'] = f"ADD TotalSpent :delta, {claim.add}"
+            if claim.remove:
+                update['UpdateExpression'] += f" REMOVE {claim.remove}"
+            update['ConditionExpression'] = claim.condition
+            update['ExpressionAttributeNames'] = claim.names
+            update['ExpressionAttributeValues'].update(claim.values)
+        try:
+            response = customer_table.update_item(**update)
+            break
+        except Exception as e:
+            if not table_backend.is_conditional_check_failed(e):
+                raise
+            # A key is applied already: drop the applied ones and try again
+            customer = customer_table.get_item(Key={'CustomerID': customer_id}, ConsistentRead=True).get('Item') or {}
+            applied = idempotency.applied_keys(customer)
+            if not any(key in applied for key, _ in spends):
+                raise
+            duplicates.extend(key for key, _ in spends if key in applied)
+            spends = [(key, spend) for key, spend in spends if key not in applied]
+            if not spends:
+                return [], duplicates
+
+    new_total_spent = response['Attributes']['TotalSpent']
+    new_loyalty_level = determine_loyalty_level(new_total_spent)
+    log.debug("New total spent", CustomerID=customer_id, TotalSpent=new_total_spent, LoyaltyLevel=new_loyalty_level)
+    if new_loyalty_level == loyalty_level:
+        return [key for key, _ in spends], duplicates
+    
+    try:
+        # Only apply the level if no other writer has moved TotalSpent since
+        customer_table.update_item(
+            Key={'CustomerID': customer_id},
+            UpdateExpression="SET LoyaltyLevel = :loyaltyLevel",
+            ConditionExpression="TotalSpent = :totalSpent",
+            ExpressionAttributeValues={
+                ':totalSpent': new_total_spent,
+                ':loyaltyLevel': new_loyalty_level
+            }
+        )
+    except Exception as e:
+        if table_backend.is_conditional_check_failed(e):
+            log.debug("TotalSpent changed concurrently, leaving LoyaltyLevel to the newer update", CustomerID=customer_id)
+            telemetry.count('WriteConflicts')
+            return [key for key, _ in spends], duplicates
+        # The spend is applied; the level follows with the customer's next update
+        log.error("Failed to update LoyaltyLevel", CustomerID=customer_id, Error=e)
+        telemetry.count('UpdateErrors')
+    else:
+        log.debug("Updated LoyaltyLevel", CustomerID=customer_id)
+        telemetry.count('LoyaltyLevelChanges')
+    return [key for key, _ in spends], duplicates
+
+@telemetry.instrument
 def lambda_handler(event, context):
     try:
-        logger.info("Starting lambda function to process CustomerProductSelection stream event")
-        
-        # Log the event for debugging purposes
-        logger.info(f"Event: {json.dumps(event, default=decimal_default)}")
+        # Log the event for debugging purposes, in sampled invocations only
+        log.debug("Received event", Event=event)
         
         if 'Records' not in event or not event['Records']:
-            logger.error("Event does not contain 'Records' key or 'Records' is empty")
+            log.error("Event does not contain 'Records' key or 'Records' is empty")
             return {
                 'statusCode': 400,
                 'body': json.dumps("Event does not contain 'Records' key or 'Records' is empty")
             }
         
+        # Collect the (CustomerID, ProductID) pair of every INSERT record
+        keyed_selections = []
         for record in event['Records']:
-            logger.info(f"Processing record: {record}")
-            
             if record['eventName'] == 'INSERT':
                 new_image = record['dynamodb']['NewImage']
                 customer_id = new_image['CustomerID']['S']
                 product_id = new_image['ProductID']['S']
-                logger.info(f"CustomerID: {customer_id}, ProductID: {product_id}")
-                
-                # Get the base price from the Products table
-                product_table = dynamodb.Table('Products')
-                product_response = product_table.get_item(Key={'ProductID': product_id})
-                
-                if 'Item' not in product_response:
-                    logger.error(f"Product with ID {product_id} not found")
-                    continue
-                
-                product = product_response['Item']
-                base_price = Decimal(product['BasePrice'])
-                logger.info(f"Base price of product {product_id}: {base_price}")
-                
-                # Get the customer's loyalty level and total spent
-                customer_table = dynamodb.Table('Customer')
-                customer_response = customer_table.get_item(Key={'CustomerID': customer_id})
-                
-                if 'Item' not in customer_response:
-                    logger.error(f"Customer with ID {customer_id} not found")
-                    continue
-                
-                customer = customer_response['Item']
-                loyalty_level = customer['LoyaltyLevel']
-                total_spent = Decimal(customer['TotalSpent'])
-                logger.info(f"Customer {customer_id} - LoyaltyLevel: {loyalty_level}, TotalSpent: {total_spent}")
-                
-                # Calculate the new current price
-                current_price = calculate_new_price(base_price, loyalty_level)
-                logger.info(f"Calculated current price: {current_price}")
-                
-                # Update the customer's total spent
-                new_total_spent = total_spent + current_price
-                logger.info(f"New total spent for customer {customer_id}: {new_total_spent}")
-                
-                # Determine if the loyalty level should be updated
-                new_loyalty_level = determine_loyalty_level(new_total_spent)
-                logger.info(f"New loyalty level for customer {customer_id}: {new_loyalty_level}")
-                
-                # Update the customer's record in the Customer table
-                customer_table.update_item(
-                    Key={'CustomerID': customer_id},
-                    UpdateExpression="SET TotalSpent = :totalSpent, LoyaltyLevel = :loyaltyLevel",
-                    ExpressionAttributeValues={
-                        ':totalSpent': new_total_spent,
-                        ':loyaltyLevel': new_loyalty_level
-                    }
-                )
-                
-                logger.info(f"Updated customer {customer_id}: TotalSpent = {new_total_spent}, LoyaltyLevel = {new_loyalty_level}")
+                log.debug("Processing selection", CustomerID=customer_id, ProductID=product_id)
+                keyed_selections.append((selection_key(record), customer_id, product_id,
+                                         record['dynamodb']['SequenceNumber']))
+        
+        # Skip the selections this container already applied; the rest are
+        # claimed by the updates that apply them
+        fresh = set(idempotency.filter_recent('customer', [key for key, _, _, _ in keyed_selections]))
+        selections = []
+        for key, customer_id, product_id, sequence_number in keyed_selections:
+            if key in fresh:
+                fresh.discard(key)
+                selections.append((key, customer_id, product_id, sequence_number))
+        
+        # Fetch the distinct products and customers with one batched read,
+        # serving hot products from the warm cache
+        items, unprocessed = item_cache.batch_get_items(table_backend.get_resource(), {
+            'Products': [{'ProductID': product_id} for _, _, product_id, _ in selections],
+            'Customer': [{'CustomerID': customer_id} for _, customer_id, _, _ in selections]
+        })
+        products = {item['ProductID']: item for item in items['Products']}
+        customers = {item['CustomerID']: item for item in items['Customer']}
+        if unprocessed:
+            log.error("Unprocessed keys after retries", UnprocessedKeys=unprocessed)
+        unread_products = {key['ProductID'] for key in unprocessed.get('Products', [])}
+        unread_customers = {key['CustomerID'] for key in unprocessed.get('Customer', [])}
+        applied_keys = {customer_id: idempotency.applied_keys(item) for customer_id, item in customers.items()}
+        
+        # A selection whose product or customer is missing adds no spend. One
+        # that could not be read is reported, so the stream delivers it
+        # again. One whose key the customer item already holds was applied
+        # by an earlier delivery and costs no write.
+        failures = []
+        priced_selections = []
+        duplicates = 0
+        for key, customer_id, product_id, sequence_number in selections:
+            if product_id in unread_products or customer_id in unread_customers:
+                failures.append(sequence_number)
+                continue
+            if product_id not in products:
+                log.error("Product not found", ProductID=product_id)
+                continue
+            if customer_id not in customers:
+                log.error("Customer not found", CustomerID=customer_id)
+                continue
+            if key in applied_keys[customer_id]:
+                duplicates += 1
+                continue
+            priced_selections.append((key, customer_id, product_id, sequence_number))
+        
+        # Calculate the current price of every selection in one batch
+        current_prices = pricing_engine.customer_prices(
+            [products[product_id]['BasePrice'] for _, _, product_id, _ in priced_selections],
+            [customers[customer_id]['LoyaltyLevel'] for _, customer_id, _, _ in priced_selections]
+        )
+        
+        # Group each customer's spends, at most one inline claim's worth per
+        # update
+        spends = {}
+        for (key, customer_id, product_id, sequence_number), current_price in zip(priced_selections, current_prices):
+            log.debug("Calculated current price", CustomerID=customer_id, ProductID=product_id, CurrentPrice=current_price)
+            spends.setdefault(customer_id, []).append((key, product_id, sequence_number, current_price))
+        updates = [
+            (customer_id, customer_spends[start:start + idempotency.MAX_INLINE_KEYS])
+            for customer_id, customer_spends in spends.items()
+            for start in range(0, len(customer_spends), idempotency.MAX_INLINE_KEYS)
+        ]
+        
+        # Apply each customer's spends, customers in parallel
+        for (customer_id, update), result, error in record_executor.process(
+                updates, key=lambda entry: entry[0],
+                function=lambda entry: apply_spend(dynamo_batch.worker_table('Customer'), entry[0],
+                                                   [(key, spend) for key, _, _, spend in entry[1]],
+                                                   customers[entry[0]])):
+            if error:
+                log.error("Failed to update TotalSpent", CustomerID=customer_id, Error=error)
+                telemetry.count('UpdateErrors')
+                failures.extend(sequence_number for _, _, sequence_number, _ in update)
+                continue
+            applied, applied_before = result
+            duplicates += len(applied_before)
+            idempotency.remember('customer', applied + applied_before)
+            applied = set(applied)
+            for key, product_id, _, current_price in update:
+                if key in applied:
+                    price_history.record(product_id, current_price, 'customer',
+                                         base_price=products[product_id]['BasePrice'],
+                                         loyalty_level=customers[customer_id]['LoyaltyLevel'])
         
-        logger.info("Finished processing all records")
+        telemetry.count('SelectionsPriced', len(priced_selections))
+        telemetry.count('CustomersUpdated', len(spends))
+        telemetry.count('DuplicatesClaimed', duplicates)
+        telemetry.count('RecordFailures', len(failures))
+        log.info("Processed records", Records=len(event['Records']), Selections=len(selections), Failures=len(failures),
+                 Duplicates=duplicates, ItemCache=item_cache.cache.stats())
         return {
             'statusCode': 200,
-            'body': json.dumps('Successfully processed event')
+            'body': json.dumps('Successfully processed event'),
+            'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failures]
         }
     except Exception as e:
-        logger.error(f"Error processing CustomerProductSelection stream event: {e}")
+        log.exception("Error processing CustomerProductSelection stream event", Error=e)
+        # Report every record so the stream retries the whole batch; the
+        # selections already applied hold their keys on the customer item
+        # and are skipped
         return {
             'statusCode': 500,
-            'body': json.dumps('Error processing CustomerProductSelection stream event')
+            'body': json.dumps('Error processing CustomerProductSelection stream event'),
+            'batchItemFailures': [
+                {'itemIdentifier': record['dynamodb']['SequenceNumber']}
+                for record in event.get('Records', []) if 'SequenceNumber' in record.get('dynamodb', {})
+            ]
         }
@@ -1,47 +1,77 @@
+import os
 import json
-import random
-import boto3
-import logging
-from decimal import Decimal
-import time
+import dynamo_batch
+import id_generator
+import key_sampler
+import price
+import table_backend
+import telemetry
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
-# Initialize DynamoDB resource with specified region
-dynamodb = boto3.resource('dynamodb', region_name='us-east-2')  # Change to your region
-TABLE_NAME = 'PurchaseHistory'
-
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
+# Selections written per invocation unless the event sets Count; more than
+# one switches to bulk mode, which writes them with BatchWriteItem
+SELECTION_BATCH_SIZE = int(os.environ.get('SELECTION_BATCH_SIZE', '1'))
+MAX_SELECTION_BATCH_SIZE = 10000
 
 def generate_selection_id():
-    timestamp = int(time.time() * 1000)  # Current time in milliseconds
-    random_number = random.randint(1000, 9999)  # Random 4-digit number
-    selection_id = str(timestamp)[-6:] + str(random_number)  # Combine to make a 10-digit number
-    return selection_id
+    # Snowflake ID, unique across containers
+    return str(id_generator.next_id())
+
+def random_selections(count):
+    # count selections of a random customer and product, each with a new SelectionID
+    dynamodb = table_backend.get_resource()
+    product_table = dynamodb.Table('Products')
+    customer_table = dynamodb.Table('Customer')
+    return [
+        {
+            'SelectionID': str(selection_id),
+            'CustomerID': key_sampler.random_key(customer_table, ('CustomerID',))['CustomerID'],
+            'ProductID': key_sampler.random_key(product_table, ('ProductID',))['ProductID']
+        }
+        for selection_id in id_generator.next_ids(count)
+    ]
 
+def insert_selections(count):
+    # Bulk mode: write count selections with BatchWriteItem
+    selections = random_selections(count)
+    unprocessed = dynamo_batch.batch_put_items(table_backend.get_resource(), 'CustomerProductSelection', selections)
+    written = len(selections) - len(unprocessed)
+    log.info("Added customer product selections", Selections=written, Unprocessed=len(unprocessed))
+    telemetry.count('SelectionsCreated', written)
+    return {
+        'statusCode': 200 if not unprocessed else 500,
+        'body': price.dumps({
+            'Selections': written,
+            'Unprocessed': len(unprocessed),
+            'FirstSelectionID': selections[0]['SelectionID'],
+            'LastSelectionID': selections[-1]['SelectionID']
+        })
+    }
+
+@telemetry.instrument
 def lambda_handler(event, context):
     try:
-        logger.info(f"Starting lambda function for table {TABLE_NAME}")
+        count = int((event or {}).get('Count', SELECTION_BATCH_SIZE))
+        if not 1 <= count <= MAX_SELECTION_BATCH_SIZE:
+            return {
+                'statusCode': 400,
+                'body': json.dumps(f"Count must be between 1 and {MAX_SELECTION_BATCH_SIZE}")
+            }
+        if count > 1:
+            return insert_selections(count)
 
-        # Access the PurchaseHistory table
-        table = dynamodb.Table(TABLE_NAME)
+        # The shared resource is created on first use, not at import
+        dynamodb = table_backend.get_resource()
 
         # Select random product from Products table
         product_table = dynamodb.Table('Products')
-        product_items = product_table.scan()['Items']
-        product_ids = [item['ProductID'] for item in product_items]
-        random_product_id = random.choice(product_ids)
+        random_product_id = key_sampler.random_key(product_table, ('ProductID',))['ProductID']
 
         # Select a random customerID from the Customers table
         customer_table = dynamodb.Table('Customer')
-        customer_items = customer_table.scan()['Items']
-        customer_ids = [item['CustomerID'] for item in customer_items]
-        random_customer_id = random.choice(customer_ids)
+        random_customer_id = key_sampler.random_key(customer_table, ('CustomerID',))['CustomerID']
 
         # Generate a new selection ID and add the record to CustomerProductSelection table
         selection_table = dynamodb.Table('CustomerProductSelection')
@@ -54,20 +84,21 @@ def lambda_handler(event, context):
             }
         )
 
-        logger.info(f"Changing {random_customer_id} and {random_product_id} and calculating new customer price...")
+        log.debug("Added customer product selection", SelectionID=selection_id, CustomerID=random_customer_id, ProductID=random_product_id)
+        telemetry.count('SelectionsCreated')
 
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': price.dumps({
                 'selectionID': selection_id,
                 'randomProductID': random_product_id,
                 'randomCustomerID': random_customer_id,
                 'message': 'The Customer lambda function has been updated successfully. A new customer has been calculated.'
-            }, default=decimal_default)
+            })
         }
 
     except Exception as e:
-        logger.error(f"Error updating PurchaseHistory: {e}")
+        log.exception("Error updating PurchaseHistory", Error=e)
         return {
             'statusCode': 500,
             'body': json.dumps('Error updating PurchaseHistory')
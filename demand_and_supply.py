@@ -1,63 +1,146 @@
 import json
-import boto3
 from decimal import Decimal
-import logging
+import dynamo_batch
+import item_cache
+import price
+import price_aggregator
+import price_history
+import pricing_engine
+import record_executor
+import telemetry
 
-# Initialize a logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Initialize a DynamoDB client
-dynamodb = boto3.resource('dynamodb')
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
 # Define the DynamoDB table names
 PRODUCTS_TABLE_NAME = 'Products'
 CURRENT_PRICE_TABLE_NAME = 'CurrentPrice'
 
+def coalesce_records(records):
+    # Collapse the batch to the latest MODIFY image per ProductID. Records
+    # arrive in stream order, so a later record replaces an earlier one.
+    # Returns ({product_id: record}, [malformed_record, ...]).
+    latest = {}
+    malformed = []
+    for record in records:
+        if record.get('eventName') != 'MODIFY':
+            continue
+        try:
+            product_id = record['dynamodb']['NewImage']['ProductID']['S']
+        except KeyError:
+            malformed.append(record)
+            continue
+        latest[product_id] = record
+    return latest, malformed
+
+def read_pricing_inputs(new_image):
+    # Extract (base price, demand, stock) from a Products stream image
+    return (
+        price.Price.parse(new_image['BasePrice']),
+        Decimal(new_image['Demand']['N']),
+        Decimal(new_image['Stock']['N'])
+    )
+
+def _failure(record):
+    return {'itemIdentifier': record['dynamodb']['SequenceNumber']}
+
+def _skip(record, reason, **fields):
+    # A record that cannot even be parsed would fail the same way on every
+    # retry and block its shard until it expires, so it is logged and
+    # dropped instead of reported. Records that parse but fail to price or
+    # write are reported in batchItemFailures instead.
+    log.error("Skipping record", Reason=reason, EventID=record.get('eventID'),
+              SequenceNumber=(record.get('dynamodb') or {}).get('SequenceNumber'), **fields)
+    telemetry.count('PoisonRecords')
+
+@telemetry.instrument
 def lambda_handler(event, context):
-  try:
-    # Log the start of the function
-    logger.info(f"Starting price update function for table
-    {PRODUCTS_TABLE_NAME} and {CURRENT_PRICE_TABLE_NAME}")
-
-    # Get the DynamoDB tables
-    products_table = dynamodb.Table(PRODUCTS_TABLE_NAME)
-    current_price_table = dynamodb.Table(CURRENT_PRICE_TABLE_NAME)
-
-    # Define the demand coefficient (example value, change as needed)
-    demand_coefficient = Decimal('0.05')
-
-    # Iterate over each record in the event
-    for record in event['Records']:
-      logger.info(f"Processing record: {record}")
-      if record['eventName'] == 'MODIFY':
-        new_image = record['dynamodb']['NewImage']
-      # Fetch the necessary attributes
-      product_id = new_image['ProductID']['S']
-      base_price = Decimal(new_image['BasePrice']['N'])
-      new_demand = Decimal(new_image['Demand']['N'])
-      new_stock = Decimal(new_image['Stock']['N'])
-  
-      # Calculate the new CurrentPrice
-      new_current_price = base_price * (Decimal(1) + demand_coefficient * (new_demand / new_stock))
-  
-      # Update the CurrentPrice in DynamoDB
-      current_price_table.update_item(
-        Key={'ProductID': product_id}, UpdateExpression='SET CurrentPrice = :val1',
-        ExpressionAttributeValues={':val1': new_current_price}
-      )
-  
-      # Log the updated price
-      logger.info(f"Updated CurrentPrice table for item
-        {product_id} with CurrentPrice: {new_current_price}")
-
-    return {
-      'statusCode': 200,
-      'body': json.dumps("Current prices updated successfully") 
-    }
-  except Exception as e:
-      logger.error(f"Error processing the request: {e}")
-    return {
-      'statusCode': 500,
-      'body': json.dumps(f"Internal server error: {e}")
-    }
+    records = event.get('Records', [])
+    try:
+        # Drop cached copies of the products changed in this batch
+        item_cache.invalidate_stream_records(records, PRODUCTS_TABLE_NAME)
+
+        latest, malformed = coalesce_records(records)
+        log.debug("Coalesced records", Records=len(records), Products=len(latest))
+
+        failures = []
+        for record in malformed:
+            _skip(record, 'Malformed record')
+
+        # Read the pricing inputs of the surviving images
+        survivors = []
+        for product_id, record in latest.items():
+            try:
+                survivors.append((product_id, record, read_pricing_inputs(record['dynamodb']['NewImage'])))
+            except Exception as e:
+                _skip(record, 'Unreadable pricing inputs', ProductID=product_id, Error=e)
+
+        # Price the survivors together
+        new_current_prices = pricing_engine.to_prices(pricing_engine.price_batch(
+            base_price=[inputs[0] for _, _, inputs in survivors],
+            demand=[inputs[1] for _, _, inputs in survivors],
+            stock=[inputs[2] for _, _, inputs in survivors]
+        )) if survivors else []
+
+        updates = []
+        for (product_id, record, inputs), new_current_price in zip(survivors, new_current_prices):
+            if new_current_price is None:
+                # The stream checkpoints at this record and retries from it
+                log.error("Price is undefined, Stock may be 0", ProductID=product_id, Stock=inputs[2])
+                failures.append(_failure(record))
+                continue
+
+            updates.append(((product_id, record, inputs, new_current_price), {
+                'Key': {'ProductID': product_id},
+                'UpdateExpression': 'SET CurrentPrice = :val1 ADD Version :one',
+                'ExpressionAttributeValues': {':val1': new_current_price.to_decimal(), ':one': 1}
+            }))
+
+        # Update the CurrentPrice in DynamoDB for the survivors only, or hand
+        # the prices to the aggregator
+        if price_aggregator.PRICE_AGGREGATION_ENABLED:
+            outcomes = price_aggregator.submit_signals(
+                'demand_and_supply', [(request, request[0], request[3]) for request, _ in updates]
+            )
+        else:
+            outcomes = [
+                (request, response, error) for (request, _), response, error in record_executor.process(
+                    updates, key=lambda update: update[0][0],
+                    function=lambda update: dynamo_batch.worker_table(CURRENT_PRICE_TABLE_NAME).update_item(**update[1]))
+            ]
+
+        updated = 0
+        for (product_id, record, inputs, new_current_price), _, error in outcomes:
+            item_cache.cache.invalidate(CURRENT_PRICE_TABLE_NAME, {'ProductID': product_id})
+            if error:
+                log.error("Failed to update CurrentPrice", ProductID=product_id, Error=error)
+                failures.append(_failure(record))
+                continue
+
+            updated += 1
+
+            # Log the updated price and keep it in the price history; a
+            # signal is no price yet, the aggregator records what it writes
+            log.debug("Updated CurrentPrice", ProductID=product_id, CurrentPrice=new_current_price)
+            if not price_aggregator.PRICE_AGGREGATION_ENABLED:
+                base_price, demand, stock = inputs
+                price_history.record(product_id, new_current_price, 'demand_and_supply',
+                                     base_price=base_price, demand=demand, stock=stock)
+
+        telemetry.count('RecordsCoalesced', len(records) - len(latest))
+        telemetry.count('PricesUpdated', updated)
+        telemetry.count('RecordFailures', len(failures))
+        log.info("Processed stream batch", Records=len(records), Products=len(latest), Updated=updated, Failures=len(failures))
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f"Current prices updated for {updated} products"),
+            'batchItemFailures': failures
+        }
+    except Exception as e:
+        log.exception("Error processing the request", Error=e)
+        # Report every record so the stream retries the whole batch
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Internal server error: {e}"),
+            'batchItemFailures': [_failure(record) for record in records if 'dynamodb' in record]
+        }
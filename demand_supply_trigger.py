@@ -1,51 +1,54 @@
 import json
-import boto3
 from decimal import Decimal
 import random
-import logging
+import key_sampler
+import table_backend
+import telemetry
 
-# Initialize a logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Initialize a DynamoDB client
-dynamodb = boto3.resource('dynamodb')
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
 # Define the DynamoDB table name as a string
 TABLE_NAME = 'Products'
 
+@telemetry.instrument
 def lambda_handler(event, context):
     try:
-        # Log the start of the function
-        logger.info(f"Starting lambda function for table {TABLE_NAME}")
-
         # Get the DynamoDB table
-        table = dynamodb.Table(TABLE_NAME)
-
-        # Fetch all items from the table
-        response = table.scan()
-        items = response['Items']
+        table = table_backend.get_resource().Table(TABLE_NAME)
 
-        if items:
-            # Select a random item
-            random_item = random.choice(items)
+        # Select a random key from the cached key index
+        random_item = key_sampler.random_key(table, ('ProductID',))
 
+        if random_item:
             # Simulate new random demand and stock values
             new_demand = random.randint(1, 100)
             new_stock = random.randint(1, 500)
 
-            # Update the item in DynamoDB
-            table.update_item(
-                Key={'ProductID': random_item['ProductID']},
-                UpdateExpression='SET Demand = :val1, Stock = :val2',
-                ExpressionAttributeValues={
-                    ':val1': Decimal(new_demand),
-                    ':val2': Decimal(new_stock)
+            # Update the item in DynamoDB, unless it was deleted since the index was built
+            try:
+                table.update_item(
+                    Key={'ProductID': random_item['ProductID']},
+                    UpdateExpression='SET Demand = :val1, Stock = :val2',
+                    ConditionExpression='attribute_exists(ProductID)',
+                    ExpressionAttributeValues={
+                        ':val1': Decimal(new_demand),
+                        ':val2': Decimal(new_stock)
+                    }
+                )
+            except Exception as e:
+                if not table_backend.is_conditional_check_failed(e):
+                    raise
+                key_sampler.get_index(table, ('ProductID',)).discard(random_item)
+                log.warning("Sampled item no longer exists", ProductID=random_item['ProductID'])
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps("Sampled item no longer exists in the DynamoDB table")
                 }
-            )
 
             # Log the updated item details
-            logger.info(f"Updated item {random_item['ProductID']} with Demand: {new_demand} and Stock: {new_stock}")
+            log.debug("Updated demand and stock", ProductID=random_item['ProductID'], Demand=new_demand, Stock=new_stock)
+            telemetry.count('ProductsUpdated')
 
             # Return the updated item details
             updated_item = {
@@ -59,14 +62,14 @@ def lambda_handler(event, context):
             }
 
         else:
-            logger.warning("No items found in the DynamoDB table")
+            log.warning("No items found in the DynamoDB table", Table=TABLE_NAME)
             return {
                 'statusCode': 404,
                 'body': json.dumps("No items found in the DynamoDB table")
             }
 
     except Exception as e:
-        logger.error(f"Error processing the request: {e}")
+        log.exception("Error processing the request", Error=e)
         return {
             'statusCode': 500,
             'body': json.dumps(f"Internal server error: {e}")
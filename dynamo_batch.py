@@ -0,0 +1,172 @@
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import table_backend
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# DynamoDB limits on the number of keys in a single BatchGetItem request
+# and of items in a single BatchWriteItem request
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+
+# Retry settings for UnprocessedKeys returned by BatchGetItem
+MAX_BATCH_RETRIES = 8
+BASE_BACKOFF_SECONDS = 0.05
+
+# Upper bound on the number of requests in flight at the same time
+MAX_WORKERS = 32
+
+# The helpers run their requests on one pool shared by every handler in the
+# container. Its threads live across invocations, so each creates its own
+# boto3 resource only once (see worker_table). Do not call the helpers from
+# inside a function they run: the nested call would wait on the same pool.
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='dynamo-batch')
+        return _executor
+
+def _worker_resource(dynamodb):
+    # boto3 resources are not thread-safe: against AWS every worker uses its own
+    return table_backend.get_thread_resource() if table_backend.TABLE_BACKEND == 'dynamodb' else dynamodb
+
+def worker_table(table_name):
+    # Table for functions passed to map_concurrently, from the worker's own resource
+    return table_backend.get_thread_resource().Table(table_name)
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _backoff(attempt):
+    # Full jitter exponential backoff
+    time.sleep(random.uniform(0, BASE_BACKOFF_SECONDS * (2 ** attempt)))
+
+def _key_id(key):
+    return tuple(sorted(key.items()))
+
+def _get_chunk(dynamodb, chunk):
+    dynamodb = _worker_resource(dynamodb)
+    items = {}
+    request_items = {}
+    for table_name, key in chunk:
+        request_items.setdefault(table_name, {'Keys': []})['Keys'].append(key)
+
+    attempt = 0
+    while request_items:
+        with telemetry.timer('BatchGetItemLatency'):
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+        for table_name, table_items in response.get('Responses', {}).items():
+            items.setdefault(table_name, []).extend(table_items)
+
+        request_items = response.get('UnprocessedKeys') or {}
+        if not request_items:
+            break
+        telemetry.count('UnprocessedKeyRetries')
+        if attempt >= MAX_BATCH_RETRIES:
+            log.warning("Giving up on unprocessed keys", Retries=attempt)
+            break
+        _backoff(attempt)
+        attempt += 1
+
+    unprocessed = {
+        table_name: list(request['Keys'])
+        for table_name, request in request_items.items()
+    }
+    return items, unprocessed
+
+def batch_get_items(dynamodb, keys_by_table):
+    # Fetch every key in keys_by_table ({table_name: [key, ...]}) using
+    # BatchGetItem requests of up to 100 keys, issued concurrently.
+    # Returns ({table_name: [item, ...]}, {table_name: [unprocessed_key, ...]}).
+    pending = []
+    for table_name, keys in keys_by_table.items():
+        seen = set()
+        for key in keys:
+            # BatchGetItem rejects requests that repeat a key
+            key_id = _key_id(key)
+            if key_id not in seen:
+                seen.add(key_id)
+                pending.append((table_name, key))
+
+    items = {table_name: [] for table_name in keys_by_table}
+    unprocessed = {}
+    if not pending:
+        return items, unprocessed
+
+    chunks = list(_chunks(pending, BATCH_GET_LIMIT))
+    for chunk_items, chunk_unprocessed in _get_executor().map(telemetry.propagate(lambda chunk: _get_chunk(dynamodb, chunk)), chunks):
+        for table_name, table_items in chunk_items.items():
+            items.setdefault(table_name, []).extend(table_items)
+        for table_name, table_keys in chunk_unprocessed.items():
+            unprocessed.setdefault(table_name, []).extend(table_keys)
+
+    return items, unprocessed
+
+def _write_chunk(dynamodb, table_name, chunk):
+    dynamodb = _worker_resource(dynamodb)
+    request_items = {table_name: [{'PutRequest': {'Item': item}} for item in chunk]}
+    attempt = 0
+    while True:
+        response = dynamodb.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if not request_items:
+            return []
+        telemetry.count('UnprocessedItemRetries')
+        if attempt >= MAX_BATCH_RETRIES:
+            log.warning("Giving up on unprocessed items", Retries=attempt)
+            return [request['PutRequest']['Item'] for request in request_items.get(table_name, [])]
+        _backoff(attempt)
+        attempt += 1
+
+def batch_put_items(dynamodb, table_name, items):
+    # Put every item into table_name using BatchWriteItem requests of up to
+    # 25 items, issued concurrently. The items must have distinct keys.
+    # Returns the items that were still unprocessed after the retries.
+    chunks = list(_chunks(items, BATCH_WRITE_LIMIT))
+    if not chunks:
+        return []
+    if len(chunks) == 1:
+        return _write_chunk(dynamodb, table_name, chunks[0])
+    return [
+        item
+        for unprocessed in _get_executor().map(
+            telemetry.propagate(lambda chunk: _write_chunk(dynamodb, table_name, chunk)), chunks)
+        for item in unprocessed
+    ]
+
+def map_concurrently(function, items):
+    # Call function(item) for every item concurrently. Returns a list of
+    # (item, result, error) tuples in the order of items, where exactly one
+    # of result and error is set. function runs on pool threads, so it must
+    # get its tables from worker_table rather than close over shared ones.
+    def _call(item):
+        try:
+            with telemetry.timer('RequestLatency'):
+                return item, function(item), None
+        except Exception as e:
+            return item, None, e
+
+    if not items:
+        return []
+
+    return list(_get_executor().map(telemetry.propagate(_call), items))
+
+def update_items(table, updates):
+    # Issue update_item on table for every (request_id, kwargs) pair in updates
+    # concurrently. Returns a list of (request_id, response, error) tuples in
+    # the order of updates, where exactly one of response and error is set.
+    table_name = table.name
+    return [
+        (request_id, response, error)
+        for (request_id, _), response, error in map_concurrently(
+            lambda update: worker_table(table_name).update_item(**update[1]), updates)
+    ]
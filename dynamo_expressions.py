@@ -0,0 +1,352 @@
+import re
+from decimal import Decimal
+from functools import lru_cache
+
+# Parser and evaluator for the subset of DynamoDB expression syntax used by
+# the handlers: condition/filter expressions, update expressions and
+# projection expressions over top-level attributes.
+
+_TOKEN_RE = re.compile(r'\s*(?:(<>|<=|>=|[=<>(),+\-])|(#\w+)|(:\w+)|([A-Za-z_]\w*))')
+
+# Marker for an attribute that is not present on the item
+MISSING = object()
+
+class ExpressionError(ValueError):
+    pass
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise ExpressionError(f"Invalid expression near: {expression[position:]!r}")
+        symbol, name_ref, value_ref, word = match.groups()
+        if symbol:
+            tokens.append(('symbol', symbol))
+        elif name_ref:
+            tokens.append(('name_ref', name_ref))
+        elif value_ref:
+            tokens.append(('value', value_ref))
+        else:
+            tokens.append(('word', word))
+        position = match.end()
+    return tokens
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, Decimal)):
+        raise ExpressionError(f"Operand is not a number: {value!r}")
+    return Decimal(value)
+
+def _compare(operator, left, right):
+    if left is MISSING or right is MISSING:
+        return False
+    try:
+        if operator == '=':
+            return left == right
+        if operator == '<>':
+            return left != right
+        if isinstance(left, (str, bytes)) != isinstance(right, (str, bytes)):
+            return False
+        if operator == '<':
+            return left < right
+        if operator == '<=':
+            return left <= right
+        if operator == '>':
+            return left > right
+        return left >= right
+    except TypeError:
+        return False
+
+def _begins_with(value, prefix):
+    return isinstance(value, (str, bytes)) and type(value) is type(prefix) and value.startswith(prefix)
+
+def _contains(value, operand):
+    if isinstance(value, str):
+        return isinstance(operand, str) and operand in value
+    if isinstance(value, (set, list)):
+        return operand in value
+    return False
+
+def _size(value):
+    if value is MISSING:
+        return MISSING
+    if isinstance(value, (str, bytes, set, list, dict)):
+        return Decimal(len(value))
+    raise ExpressionError("size() is only defined for strings, binaries, sets, lists and maps")
+
+class _Parser:
+    def __init__(self, expression, names):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+        self.names = names
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ExpressionError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def expect(self, symbol):
+        kind, text = self.take()
+        if text != symbol:
+            raise ExpressionError(f"Expected {symbol!r}, found {text!r}")
+
+    def at_keyword(self, *keywords):
+        kind, text = self.peek()
+        return kind == 'word' and text.upper() in keywords
+
+    def at_symbol(self, symbol):
+        return self.peek() == ('symbol', symbol)
+
+    def done(self):
+        return self.position >= len(self.tokens)
+
+    # Operands
+
+    def attribute_name(self):
+        kind, text = self.take()
+        if kind == 'name_ref':
+            if text not in self.names:
+                raise ExpressionError(f"Undefined attribute name: {text}")
+            return self.names[text]
+        if kind == 'word':
+            return text
+        raise ExpressionError(f"Expected an attribute name, found {text!r}")
+
+    def path(self):
+        name = self.attribute_name()
+        return lambda item, values: item.get(name, MISSING)
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 'value':
+            self.take()
+            return lambda item, values: _value(values, text)
+        if kind == 'word' and self.peek(1) == ('symbol', '('):
+            function = text.lower()
+            self.take()
+            self.take()
+            if function == 'size':
+                target = self.path()
+                self.expect(')')
+                return lambda item, values: _size(target(item, values))
+            if function == 'if_not_exists':
+                target = self.path()
+                self.expect(',')
+                default = self.operand()
+                self.expect(')')
+
+                def if_not_exists(item, values):
+                    current = target(item, values)
+                    return default(item, values) if current is MISSING else current
+                return if_not_exists
+            if function == 'list_append':
+                first = self.operand()
+                self.expect(',')
+                second = self.operand()
+                self.expect(')')
+                return lambda item, values: list(first(item, values)) + list(second(item, values))
+            raise ExpressionError(f"Unsupported function: {text}")
+        return self.path()
+
+    def set_value(self):
+        left = self.operand()
+        if self.at_symbol('+') or self.at_symbol('-'):
+            _, operator = self.take()
+            right = self.operand()
+            if operator == '+':
+                return lambda item, values: _number(left(item, values)) + _number(right(item, values))
+            return lambda item, values: _number(left(item, values)) - _number(right(item, values))
+        return left
+
+    # Conditions
+
+    def condition(self):
+        left = self.conjunction()
+        while self.at_keyword('OR'):
+            self.take()
+            right = self.conjunction()
+            left = (lambda first, second: lambda item, values: first(item, values) or second(item, values))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.at_keyword('AND'):
+            self.take()
+            right = self.negation()
+            left = (lambda first, second: lambda item, values: first(item, values) and second(item, values))(left, right)
+        return left
+
+    def negation(self):
+        if self.at_keyword('NOT'):
+            self.take()
+            inner = self.negation()
+            return lambda item, values: not inner(item, values)
+        return self.predicate()
+
+    def predicate(self):
+        if self.at_symbol('('):
+            self.take()
+            inner = self.condition()
+            self.expect(')')
+            return inner
+
+        kind, text = self.peek()
+        if kind == 'word' and self.peek(1) == ('symbol', '(') and text.lower() != 'size':
+            function = text.lower()
+            self.take()
+            self.take()
+            target = self.path()
+            if function == 'attribute_exists':
+                self.expect(')')
+                return lambda item, values: target(item, values) is not MISSING
+            if function == 'attribute_not_exists':
+                self.expect(')')
+                return lambda item, values: target(item, values) is MISSING
+            self.expect(',')
+            operand = self.operand()
+            self.expect(')')
+            if function == 'begins_with':
+                return lambda item, values: _begins_with(target(item, values), operand(item, values))
+            if function == 'contains':
+                return lambda item, values: _contains(target(item, values), operand(item, values))
+            raise ExpressionError(f"Unsupported function: {text}")
+
+        left = self.operand()
+        if self.at_keyword('BETWEEN'):
+            self.take()
+            low = self.operand()
+            if not self.at_keyword('AND'):
+                raise ExpressionError("Expected AND in BETWEEN")
+            self.take()
+            high = self.operand()
+            return lambda item, values: (
+                _compare('>=', left(item, values), low(item, values))
+                and _compare('<=', left(item, values), high(item, values))
+            )
+        if self.at_keyword('IN'):
+            self.take()
+            self.expect('(')
+            candidates = [self.operand()]
+            while self.at_symbol(','):
+                self.take()
+                candidates.append(self.operand())
+            self.expect(')')
+            return lambda item, values: any(
+                _compare('=', left(item, values), candidate(item, values)) for candidate in candidates
+            )
+
+        kind, operator = self.take()
+        if operator not in ('=', '<>', '<', '<=', '>', '>='):
+            raise ExpressionError(f"Expected a comparator, found {operator!r}")
+        right = self.operand()
+        return lambda item, values: _compare(operator, left(item, values), right(item, values))
+
+    # Update expressions
+
+    def update(self):
+        actions = {'SET': [], 'REMOVE': [], 'ADD': [], 'DELETE': []}
+        while not self.done():
+            kind, text = self.take()
+            clause = text.upper() if kind == 'word' else None
+            if clause not in actions:
+                raise ExpressionError(f"Expected SET, REMOVE, ADD or DELETE, found {text!r}")
+            while True:
+                name = self.attribute_name()
+                if clause == 'SET':
+                    self.expect('=')
+                    actions[clause].append((name, self.set_value()))
+                elif clause == 'REMOVE':
+                    actions[clause].append((name, None))
+                else:
+                    actions[clause].append((name, self.operand()))
+                if not self.at_symbol(','):
+                    break
+                self.take()
+        return actions
+
+def _value(values, reference):
+    if reference not in values:
+        raise ExpressionError(f"Undefined attribute value: {reference}")
+    return values[reference]
+
+def _names_key(names):
+    return tuple(sorted((names or {}).items()))
+
+@lru_cache(maxsize=512)
+def _compile_condition(expression, names_key):
+    parser = _Parser(expression, dict(names_key))
+    condition = parser.condition()
+    if not parser.done():
+        raise ExpressionError(f"Unexpected token {parser.peek()[1]!r}")
+    return condition
+
+@lru_cache(maxsize=512)
+def _compile_update(expression, names_key):
+    return _Parser(expression, dict(names_key)).update()
+
+@lru_cache(maxsize=512)
+def _compile_projection(expression, names_key):
+    parser = _Parser(expression, dict(names_key))
+    attributes = [parser.attribute_name()]
+    while parser.at_symbol(','):
+        parser.take()
+        attributes.append(parser.attribute_name())
+    if not parser.done():
+        raise ExpressionError(f"Unexpected token {parser.peek()[1]!r}")
+    return tuple(attributes)
+
+def evaluate_condition(expression, item, names=None, values=None):
+    # True when the condition or filter expression holds for item
+    return _compile_condition(expression, _names_key(names))(item, values or {})
+
+def project(expression, item, names=None):
+    # Keep only the attributes listed in a projection expression
+    attributes = _compile_projection(expression, _names_key(names))
+    return {attribute: item[attribute] for attribute in attributes if attribute in item}
+
+def apply_update(expression, item, names=None, values=None):
+    # Apply an update expression to a copy of item.
+    # Returns (new_item, names of the attributes the expression touched).
+    actions = _compile_update(expression, _names_key(names))
+    values = values or {}
+    new_item = dict(item)
+
+    # Every SET operand is evaluated against the item as it was before the update
+    assignments = [(name, operand(item, values)) for name, operand in actions['SET']]
+    for name, value in assignments:
+        if value is MISSING:
+            raise ExpressionError(f"The SET operand for {name} refers to a missing attribute")
+        new_item[name] = value
+
+    for name, _ in actions['REMOVE']:
+        new_item.pop(name, None)
+
+    for name, operand in actions['ADD']:
+        value = operand(item, values)
+        current = new_item.get(name, MISSING)
+        if isinstance(value, set):
+            new_item[name] = value if current is MISSING else set(current) | value
+        elif current is MISSING:
+            new_item[name] = _number(value)
+        else:
+            new_item[name] = _number(current) + _number(value)
+
+    for name, operand in actions['DELETE']:
+        current = new_item.get(name, MISSING)
+        if current is not MISSING:
+            remaining = set(current) - operand(item, values)
+            if remaining:
+                new_item[name] = remaining
+            else:
+                del new_item[name]
+
+    touched = [name for clause in actions.values() for name, _ in clause]
+    return new_item, touched
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import cProfile
+import threading
+import contextvars
+import telemetry
+import rate_limiter
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Per-call instrumentation of the DynamoDB resource returned by
+# table_backend.get_resource: every table operation is timed, its retries
+# and ReturnConsumedCapacity totals are recorded, and the numbers are rolled
+# up per table and operation for each instrumented invocation. Every call
+# also goes through the table's rate limiter (see rate_limiter).
+
+# Turn the instrumentation off entirely
+DYNAMO_TRACE_ENABLED = os.environ.get('DYNAMO_TRACE_ENABLED', 'true').lower() == 'true'
+
+# ReturnConsumedCapacity requested on every call: TOTAL, INDEXES or NONE
+RETURN_CONSUMED_CAPACITY = os.environ.get('DYNAMO_RETURN_CONSUMED_CAPACITY', 'TOTAL')
+
+# When set, each invocation's rollup is appended to this file as a JSON line
+DYNAMO_TRACE_FILE = os.environ.get('DYNAMO_TRACE_FILE')
+
+# When set, the first invocation of the container is run under cProfile and
+# its stats are written to this path
+DYNAMO_PROFILE_PATH = os.environ.get('DYNAMO_PROFILE_PATH')
+
+READ_OPERATIONS = ('get_item', 'scan', 'query', 'batch_get_item')
+
+class OperationStats:
+    __slots__ = ('calls', 'errors', 'wall_ms', 'max_ms', 'retries', 'capacity_units')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}
+        self.wall_ms = 0.0
+        self.max_ms = 0.0
+        self.retries = 0
+        self.capacity_units = 0.0
+
+    def as_dict(self):
+        return {
+            'Calls': self.calls,
+            'Errors': dict(self.errors),
+            'WallMs': round(self.wall_ms, 3),
+            'MaxMs': round(self.max_ms, 3),
+            'Retries': self.retries,
+            'CapacityUnits': self.capacity_units
+        }
+
+class Rollup:
+    # Call statistics of one invocation, by table and operation
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def record(self, table_name, operation, wall_ms, retries, capacity_units, error_code=None):
+        with self.lock:
+            stats = self.operations.get((table_name, operation))
+            if stats is None:
+                stats = self.operations[(table_name, operation)] = OperationStats()
+            stats.calls += 1
+            stats.wall_ms += wall_ms
+            stats.max_ms = max(stats.max_ms, wall_ms)
+            stats.retries += retries
+            stats.capacity_units += capacity_units
+            if error_code:
+                stats.errors[error_code] = stats.errors.get(error_code, 0) + 1
+
+    def totals(self):
+        with self.lock:
+            operations = list(self.operations.items())
+        totals = {'Calls': 0, 'Errors': 0, 'WallMs': 0.0, 'Retries': 0,
+                  'ReadCapacityUnits': 0.0, 'WriteCapacityUnits': 0.0}
+        for (_, operation), stats in operations:
+            totals['Calls'] += stats.calls
+            totals['Errors'] += sum(stats.errors.values())
+            totals['WallMs'] += stats.wall_ms
+            totals['Retries'] += stats.retries
+            capacity = 'ReadCapacityUnits' if operation in READ_OPERATIONS else 'WriteCapacityUnits'
+            totals[capacity] += stats.capacity_units
+        totals['WallMs'] = round(totals['WallMs'], 3)
+        return totals
+
+    def as_dict(self):
+        with self.lock:
+            operations = list(self.operations.items())
+        tables = {}
+        for (table_name, operation), stats in sorted(operations):
+            tables.setdefault(table_name, {})[operation] = stats.as_dict()
+        return {'Tables': tables, 'Totals': self.totals()}
+
+# Rollup of the invocation in progress (per context, like the telemetry
+# invocation), and of the last one that finished
+_rollup = contextvars.ContextVar('dynamo_trace_rollup', default=Rollup())
+_last = None
+_profiling = False
+
+def current():
+    return _rollup.get()
+
+def last():
+    # Rollup of the most recently finished invocation, as a dict
+    return _last
+
+def profile_next(path):
+    # Run the next instrumented invocation under cProfile and write its stats to path
+    global DYNAMO_PROFILE_PATH
+    DYNAMO_PROFILE_PATH = path
+
+def _retries(response):
+    return ((response or {}).get('ResponseMetadata') or {}).get('RetryAttempts', 0)
+
+def _capacity_units(consumed):
+    # ConsumedCapacity is a dict for single-table calls and a list for batch calls
+    if not consumed:
+        return 0.0
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return float(sum(entry.get('CapacityUnits', 0) for entry in consumed))
+
+def _units(operation, kwargs):
+    # Batch calls take one rate limiter token per key or item
+    if operation not in ('batch_get_item', 'batch_write_item'):
+        return 1
+    return sum(
+        len(requests.get('Keys', ())) if isinstance(requests, dict) else len(requests)
+        for requests in kwargs.get('RequestItems', {}).values()
+    ) or 1
+
+def _call(table_name, operation, method, kwargs):
+    limiter = f'dynamodb:{table_name}'
+    if not DYNAMO_TRACE_ENABLED:
+        return rate_limiter.call(limiter, method, kwargs, _units(operation, kwargs))
+    if RETURN_CONSUMED_CAPACITY != 'NONE':
+        kwargs.setdefault('ReturnConsumedCapacity', RETURN_CONSUMED_CAPACITY)
+    rollup = _rollup.get()
+    start = time.perf_counter()
+    try:
+        response = rate_limiter.call(limiter, method, kwargs, _units(operation, kwargs))
+    except Exception as e:
+        error_response = getattr(e, 'response', None) or {}
+        rollup.record(table_name, operation, (time.perf_counter() - start) * 1000, _retries(error_response), 0.0,
+                      (error_response.get('Error') or {}).get('Code') or type(e).__name__)
+        raise
+    rollup.record(table_name, operation, (time.perf_counter() - start) * 1000, _retries(response),
+                  _capacity_units(response.get('ConsumedCapacity')))
+    return response
+
+class TracedTable:
+    # Table proxy that records every data-plane call; anything else is passed through
+    def __init__(self, table):
+        self._table = table
+
+    def __getattr__(self, name):
+        return getattr(self._table, name)
+
+    def get_item(self, **kwargs):
+        return _call(self._table.name, 'get_item', self._table.get_item, kwargs)
+
+    def put_item(self, **kwargs):
+        return _call(self._table.name, 'put_item', self._table.put_item, kwargs)
+
+    def update_item(self, **kwargs):
+        return _call(self._table.name, 'update_item', self._table.update_item, kwargs)
+
+    def delete_item(self, **kwargs):
+        return _call(self._table.name, 'delete_item', self._table.delete_item, kwargs)
+
+    def scan(self, **kwargs):
+        return _call(self._table.name, 'scan', self._table.scan, kwargs)
+
+    def query(self, **kwargs):
+        return _call(self._table.name, 'query', self._table.query, kwargs)
+
+class TracedResource:
+    # Resource proxy whose tables and batch calls are instrumented
+    def __init__(self, resource):
+        self._resource = resource
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    def Table(self, name):
+        return TracedTable(self._resource.Table(name))
+
+    def batch_get_item(self, **kwargs):
+        table_name = '+'.join(sorted(kwargs.get('RequestItems', {})))
+        return _call(table_name, 'batch_get_item', self._resource.batch_get_item, kwargs)
+
+    def batch_write_item(self, **kwargs):
+        table_name = '+'.join(sorted(kwargs.get('RequestItems', {})))
+        return _call(table_name, 'batch_write_item', self._resource.batch_write_item, kwargs)
+
+def instrument_resource(resource):
+    # Wrapped for the rate limiter as well, which every table call goes through
+    return TracedResource(resource) if DYNAMO_TRACE_ENABLED or rate_limiter.RATE_LIMIT_ENABLED else resource
+
+def _start(invocation):
+    global _profiling, DYNAMO_PROFILE_PATH
+    token = _rollup.set(Rollup())
+    profiler = None
+    profile_path = None
+    if DYNAMO_PROFILE_PATH and not _profiling:
+        profile_path, DYNAMO_PROFILE_PATH = DYNAMO_PROFILE_PATH, None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        _profiling = True
+    return token, profiler, profile_path
+
+def _end(invocation, state):
+    global _last, _profiling
+    token, profiler, profile_path = state
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        _profiling = False
+        log.info("Wrote invocation profile", Path=profile_path)
+
+    rollup = _rollup.get()
+    _rollup.reset(token)
+    if not rollup.operations:
+        return
+    _last = rollup.as_dict()
+    totals = _last['Totals']
+    telemetry.count('DynamoDBCalls', totals['Calls'])
+    telemetry.count('DynamoDBRetries', totals['Retries'])
+    telemetry.count('ConsumedReadCapacityUnits', totals['ReadCapacityUnits'])
+    telemetry.count('ConsumedWriteCapacityUnits', totals['WriteCapacityUnits'])
+    log.info("DynamoDB usage", **totals)
+    log.debug("DynamoDB usage by table", Tables=_last['Tables'])
+
+    if DYNAMO_TRACE_FILE:
+        with open(DYNAMO_TRACE_FILE, 'a') as trace_file:
+            trace_file.write(json.dumps(dict(
+                _last, Handler=invocation.handler, RequestId=invocation.request_id, Timestamp=time.time()
+            )) + '\n')
+
+telemetry.on_invocation(_start, _end)
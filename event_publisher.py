@@ -0,0 +1,98 @@
+import time
+import random
+import price
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# PutEvents limits: entries per call and total request size
+MAX_ENTRIES_PER_CALL = 10
+MAX_REQUEST_BYTES = 256 * 1024
+
+# Retry settings for entries reported in FailedEntryCount
+MAX_PUBLISH_RETRIES = 5
+BASE_BACKOFF_SECONDS = 0.05
+
+# Version of the envelope that packs many updates into one event detail
+ENVELOPE_VERSION = 2
+
+def _entry_size(entry):
+    # Size of an entry as EventBridge counts it against the request limit
+    return sum(len(entry.get(field, '').encode()) for field in ('Source', 'DetailType', 'Detail'))
+
+def pack_envelopes(updates, max_bytes=MAX_REQUEST_BYTES - 1024):
+    # Pack updates into as few envelope details as possible, each one no
+    # larger than max_bytes once serialized
+    envelope_overhead = len(price.dumps({'Version': ENVELOPE_VERSION, 'Updates': []}))
+    envelope = []
+    size = envelope_overhead
+    for update in updates:
+        update_size = len(price.dumps(update)) + 2
+        if envelope and size + update_size > max_bytes:
+            yield {'Version': ENVELOPE_VERSION, 'Updates': envelope}
+            envelope = []
+            size = envelope_overhead
+        envelope.append(update)
+        size += update_size
+    if envelope:
+        yield {'Version': ENVELOPE_VERSION, 'Updates': envelope}
+
+class EventPublisher:
+    # Buffers events and sends them with PutEvents calls of up to 10 entries,
+    # retrying only the entries that EventBridge reports as failed
+    def __init__(self, client, source, detail_type, event_bus_name='default'):
+        self.client = client
+        self.source = source
+        self.detail_type = detail_type
+        self.event_bus_name = event_bus_name
+        self.entries = []
+        self.size = 0
+        self.published = 0
+        self.failed = []
+        self.calls = 0
+
+    def add(self, detail):
+        entry = {
+            'Source': self.source,
+            'DetailType': self.detail_type,
+            'Detail': price.dumps(detail),
+            'EventBusName': self.event_bus_name
+        }
+        entry_size = _entry_size(entry)
+        if self.entries and self.size + entry_size > MAX_REQUEST_BYTES:
+            self.flush()
+        self.entries.append(entry)
+        self.size += entry_size
+        if len(self.entries) >= MAX_ENTRIES_PER_CALL:
+            self.flush()
+
+    def flush(self):
+        pending = self.entries
+        self.entries = []
+        self.size = 0
+
+        attempt = 0
+        while pending:
+            response = self.client.put_events(Entries=pending)
+            self.calls += 1
+            if not response.get('FailedEntryCount'):
+                self.published += len(pending)
+                break
+
+            # Results come back in the order of the entries sent
+            retry = [
+                entry for entry, result in zip(pending, response['Entries'])
+                if result.get('ErrorCode')
+            ]
+            self.published += len(pending) - len(retry)
+            if attempt >= MAX_PUBLISH_RETRIES:
+                log.error("Giving up on events", Events=len(retry), Retries=attempt)
+                self.failed.extend(retry)
+                break
+            time.sleep(random.uniform(0, BASE_BACKOFF_SECONDS * (2 ** attempt)))
+            attempt += 1
+            pending = retry
+
+    def stats(self):
+        return {'Published': self.published, 'Failed': len(self.failed), 'PutEventsCalls': self.calls}
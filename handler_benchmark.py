@@ -0,0 +1,354 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import tracemalloc
+from decimal import Decimal
+
+# Drives every lambda_handler in-process against the memory table backend,
+# with stub EventBridge, Lambda and SQS clients, on synthetic seeded events:
+# stream batches of 1 to 1000 records, promotions of 10 to 10k products and
+# competitor bursts. Each scenario reports throughput, p50/p99 latency, peak
+# allocations and DynamoDB/AWS calls per invocation. A run can be saved as a
+# JSON baseline and later runs compared with it; regressions are flagged and
+# make the exit status non-zero. Compare runs from the same quiet machine,
+# the thread pools in the handlers make timings sensitive to other load.
+# Handlers with a call budget also fail the run when one invocation makes
+# more DynamoDB/AWS calls than its event allows.
+#
+#   python handler_benchmark.py --save-baseline benchmark_baseline.json
+#   python handler_benchmark.py --baseline benchmark_baseline.json
+
+# Configure the handlers before they are imported
+os.environ['TABLE_BACKEND'] = 'memory'
+os.environ.setdefault('METRICS_ENABLED', 'false')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_SAMPLE_RATE', '0')
+os.environ.setdefault('PRICE_HISTORY_ENABLED', 'false')
+os.environ.setdefault('ID_WORKER_ID', '1')
+os.environ.setdefault('AWS_REGION', 'us-east-2')
+
+import clients
+import dynamo_trace
+import event_publisher
+import idempotency
+import item_cache
+import key_sampler
+import promotion_index
+import table_backend
+
+PRODUCTS = 10000
+CUSTOMERS = 1000
+COMPETITORS = 3
+PROMOTIONS = 20
+
+# Latency differences below this many milliseconds are timer noise, not regressions
+MIN_LATENCY_DELTA_MS = 0.1
+
+# Metrics where a higher value is a regression (RecordsPerSecond is the other
+# way round), with the multiple of --tolerance each may drift; tail latency is
+# the noisiest and calls are deterministic, so any increase counts
+HIGHER_IS_WORSE = {'P50Ms': 1, 'P99Ms': 2, 'PeakKB': 1, 'CallsPerInvocation': 0}
+
+class Context:
+    aws_request_id = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+class StubClient:
+    # Records the calls made to one AWS service and answers them with success
+    def __init__(self):
+        self.calls = 0
+
+    def put_events(self, Entries):
+        self.calls += 1
+        return {'FailedEntryCount': 0, 'Entries': [{'EventId': str(i)} for i in range(len(Entries))]}
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'{}'):
+        self.calls += 1
+        if InvocationType == 'Event':
+            return {'StatusCode': 202}
+        products = json.loads(Payload).get('ActiveEvent', {}).get('AffectedProducts', '')
+        body = [{'ProductID': product_id} for product_id in products.split(',') if product_id]
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps({'statusCode': 200, 'body': json.dumps(body), 'FailedProducts': []}).encode())}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls += 1
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+STUBS = {service: StubClient() for service in ('events', 'lambda', 'sqs')}
+
+def stub_calls():
+    return sum(stub.calls for stub in STUBS.values())
+
+def load_dataset(seed):
+    # Fresh, seeded tables and cold per-container caches
+    rng = random.Random(seed)
+    table_backend.reset_local_tables()
+    item_cache.cache.clear()
+    idempotency.recent.clear()
+    key_sampler.invalidate()
+    promotion_index.invalidate()
+
+    dynamodb = table_backend.get_resource()
+    products = dynamodb.Table('Products')
+    current_prices = dynamodb.Table('CurrentPrice')
+    for i in range(PRODUCTS):
+        base_price = Decimal(rng.randint(500, 50000)).scaleb(-2)
+        products.put_item(Item={'ProductID': f'P{i:05d}', 'BasePrice': base_price,
+                                'Demand': Decimal(rng.randint(1, 100)), 'Stock': Decimal(rng.randint(1, 500))})
+        current_prices.put_item(Item={'ProductID': f'P{i:05d}', 'CurrentPrice': base_price, 'Version': 1})
+
+    customers = dynamodb.Table('Customer')
+    for i in range(CUSTOMERS):
+        customers.put_item(Item={'CustomerID': f'C{i:04d}', 'LoyaltyLevel': rng.choice(['Bronze', 'Silver', 'Gold', 'Platinum']),
+                                 'TotalSpent': Decimal(rng.randint(0, 1000))})
+
+    competitors = dynamodb.Table('Competitor')
+    for i in range(0, PRODUCTS, 10):
+        for competitor in range(COMPETITORS):
+            competitors.put_item(Item={'CompetitorID': f'X{competitor}', 'ProductID': f'P{i:05d}',
+                                       'CompetitorPrice': Decimal(rng.randint(500, 50000)).scaleb(-2)})
+
+    promotions = dynamodb.Table('EventsPromotions')
+    for i in range(PROMOTIONS):
+        start = rng.randint(1, 300)
+        affected = rng.sample(range(PRODUCTS), rng.randint(10, 200))
+        promotions.put_item(Item={
+            'EventID': str(i),
+            'StartDate': time.strftime('%d-%m-%Y', time.gmtime(1672531200 + start * 86400)),
+            'EndDate': time.strftime('%d-%m-%Y', time.gmtime(1672531200 + (start + rng.randint(1, 30)) * 86400)),
+            'AffectedProducts': ','.join(f'P{product:05d}' for product in affected),
+            'DiscountRate': str(rng.choice([Decimal('0.1'), Decimal('0.15'), Decimal('0.2')]))
+        })
+
+class Events:
+    # Seeded generators of synthetic handler events
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.sequence = 0
+
+    def _next_sequence(self):
+        self.sequence += 1
+        return str(self.sequence)
+
+    def product_id(self):
+        return f'P{self.rng.randrange(PRODUCTS):05d}'
+
+    def selections(self, size):
+        records = []
+        for _ in range(size):
+            sequence = self._next_sequence()
+            records.append({'eventName': 'INSERT', 'dynamodb': {'SequenceNumber': sequence, 'NewImage': {
+                'SelectionID': {'S': f'benchmark-{sequence}'},
+                'CustomerID': {'S': f'C{self.rng.randrange(CUSTOMERS):04d}'},
+                'ProductID': {'S': self.product_id()}
+            }}})
+        return {'Records': records}
+
+    def product_changes(self, size):
+        records = []
+        for _ in range(size):
+            product_id = self.product_id()
+            records.append({'eventName': 'MODIFY', 'dynamodb': {
+                'SequenceNumber': self._next_sequence(),
+                'Keys': {'ProductID': {'S': product_id}},
+                'NewImage': {
+                    'ProductID': {'S': product_id},
+                    'BasePrice': {'N': str(Decimal(self.rng.randint(500, 50000)).scaleb(-2))},
+                    'Demand': {'N': str(self.rng.randint(1, 100))},
+                    'Stock': {'N': str(self.rng.randint(1, 500))}
+                }
+            }})
+        return {'Records': records}
+
+    def competitor_updates(self, size):
+        updates = [{
+            'CompetitorID': f'X{self.rng.randrange(COMPETITORS)}',
+            'ProductID': f'P{self.rng.randrange(0, PRODUCTS, 10):05d}',
+            'NewCompetitorPrice': str(Decimal(self.rng.randint(500, 50000)).scaleb(-2))
+        } for _ in range(size)]
+        if size == 1:
+            return {'detail': updates[0]}
+        return {'detail': {'Version': event_publisher.ENVELOPE_VERSION, 'Updates': updates}}
+
+    def promotion(self, size):
+        return {'SelectedDate': '01-06-2023', 'ActiveEvent': {
+            'EventID': 'benchmark',
+            'AffectedProducts': ','.join(f'P{product:05d}' for product in self.rng.sample(range(PRODUCTS), size)),
+            'DiscountRate': '0.2',
+            'StartDate': '01-06-2023',
+            'EndDate': '30-06-2023'
+        }}
+
+    def trigger(self, size):
+        return {'Count': size} if size > 1 else {}
+
+def customer_call_budget(event):
+    # One BatchGetItem per 100 distinct keys, one spend update per customer
+    # and inline claim, and one loyalty level update per customer
+    customers = {}
+    products = set()
+    for record in event['Records']:
+        new_image = record['dynamodb']['NewImage']
+        customer_id = new_image['CustomerID']['S']
+        customers[customer_id] = customers.get(customer_id, 0) + 1
+        products.add(new_image['ProductID']['S'])
+    reads = -(-(len(customers) + len(products)) // 100)
+    updates = sum(-(-selections // idempotency.MAX_INLINE_KEYS) for selections in customers.values())
+    return reads + updates + len(customers)
+
+# Most calls an invocation of the handler may make, from its event
+CALL_BUDGETS = {
+    'customer': customer_call_budget
+}
+
+# (handler module, event generator, sizes); the size is the records, products
+# or updates in one event
+SCENARIOS = [
+    ('customer', Events.selections, (1, 10, 100, 1000)),
+    ('demand_and_supply', Events.product_changes, (1, 10, 100, 1000)),
+    ('competitor', Events.competitor_updates, (1, 10, 100, 1000)),
+    ('seasonal_sales', Events.promotion, (10, 100, 1000, 10000)),
+    ('customer_trigger', Events.trigger, (1, 100)),
+    ('competitor_trigger', Events.trigger, (1, 100)),
+    ('demand_supply_trigger', Events.trigger, (1,)),
+    ('seasonal_sales_trigger', Events.trigger, (1,))
+]
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run_scenario(module, generator, size, iterations, rounds, seed):
+    handler = __import__(module).lambda_handler
+    load_dataset(seed)
+    random.seed(seed)
+    events = Events(seed)
+    context = Context()
+
+    # Warm the caches and key indexes like a warm container
+    handler(generator(events, size), context)
+
+    # Keep the best of several rounds, the least disturbed by other load on the machine
+    medians = []
+    tails = []
+    calls = []
+    over_budget = 0
+    budget = CALL_BUDGETS.get(module)
+    for _ in range(rounds):
+        latencies = []
+        for _ in range(iterations):
+            event = generator(events, size)
+            stubbed = stub_calls()
+            start = time.perf_counter()
+            handler(event, context)
+            latencies.append((time.perf_counter() - start) * 1000)
+            rollup = dynamo_trace.last()
+            calls.append((rollup['Totals']['Calls'] if rollup else 0) + stub_calls() - stubbed)
+            if budget and calls[-1] > budget(event):
+                over_budget += 1
+        medians.append(statistics.median(latencies))
+        tails.append(_percentile(latencies, 0.99))
+
+    # Measure allocations separately, tracing slows the handler down
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(max(1, iterations // 10)):
+            event = generator(events, size)
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            handler(event, context)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    # Throughput from the median latency, so one slow outlier does not swing it
+    median = min(medians)
+    return {
+        'Handler': module,
+        'Size': size,
+        'Invocations': iterations * rounds,
+        'RecordsPerSecond': round(size * 1000 / median, 1) if median else None,
+        'P50Ms': round(median, 3),
+        'P99Ms': round(min(tails), 3),
+        'PeakKB': round(max(peaks) / 1024, 1),
+        'CallsPerInvocation': round(statistics.mean(calls), 2),
+        'OverCallBudget': over_budget
+    }
+
+def compare(results, baseline, tolerance):
+    # Return the regressions of results against baseline
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric, multiple in HIGHER_IS_WORSE.items():
+            allowed = previous[metric] * (1 + multiple * tolerance)
+            if metric.endswith('Ms'):
+                allowed = max(allowed, previous[metric] + MIN_LATENCY_DELTA_MS)
+            if result[metric] > allowed:
+                regressions.append(f"{name} {metric}: {previous[metric]} -> {result[metric]}")
+        if result['P50Ms'] > previous['P50Ms'] + MIN_LATENCY_DELTA_MS and \
+                result['RecordsPerSecond'] < previous['RecordsPerSecond'] / (1 + tolerance):
+            regressions.append(f"{name} RecordsPerSecond: {previous['RecordsPerSecond']} -> {result['RecordsPerSecond']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmark of the lambda handlers')
+    parser.add_argument('--iterations', type=int, default=30, help='measured invocations per round')
+    parser.add_argument('--rounds', type=int, default=3, help='rounds per scenario, the best one is reported')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--handler', action='append', help='only benchmark these handlers')
+    parser.add_argument('--max-size', type=int, help='skip scenarios with larger events')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before flagging')
+    args = parser.parse_args()
+
+    for service, stub in STUBS.items():
+        clients.register(service, stub)
+
+    results = {}
+    print(f"{'Scenario':<32}{'Records/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'Peak KB':>10}{'Calls':>10}")
+    for module, generator, sizes in SCENARIOS:
+        if args.handler and module not in args.handler:
+            continue
+        for size in sizes:
+            if args.max_size and size > args.max_size:
+                continue
+            result = run_scenario(module, generator, size, args.iterations, args.rounds, args.seed)
+            name = f'{module}/{size}'
+            results[name] = result
+            print(f"{name:<32}{result['RecordsPerSecond']:>12.1f}{result['P50Ms']:>10.3f}{result['P99Ms']:>10.3f}"
+                  f"{result['PeakKB']:>10.1f}{result['CallsPerInvocation']:>10.2f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    over_budget = [name for name, result in results.items() if result['OverCallBudget']]
+    for name in over_budget:
+        print(f"OVER CALL BUDGET {name}: {results[name]['OverCallBudget']} of {results[name]['Invocations']} invocations")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions or over_budget:
+            sys.exit(1)
+        print("No regressions against the baseline")
+    elif over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import os
+import time
+import uuid
+import random
+import threading
+import table_backend
+import telemetry
+
+# Snowflake-style 64-bit IDs: milliseconds since ID_EPOCH_MS (41 bits), the
+# worker ID (10 bits) and a per-millisecond sequence (12 bits). IDs from one
+# generator are strictly increasing, and two containers never share a worker
+# ID because each one leases its own from the IdGeneratorWorkers table; a
+# lease is renewed while IDs are generated and taken over only once expired.
+#
+# Set ID_WORKER_ID to pin the worker ID instead, e.g. in local runs.
+
+# 2024-01-01T00:00:00Z
+ID_EPOCH_MS = 1704067200000
+
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+WORKERS_TABLE = os.environ.get('ID_WORKERS_TABLE', 'IdGeneratorWorkers')
+LEASE_SECONDS = int(os.environ.get('ID_WORKER_LEASE_SECONDS', '900'))
+
+# Renew the lease once less than this much of it is left. The renewal is
+# conditional on still owning the worker ID, so IDs are never generated on a
+# lease another container has taken over.
+RENEW_BEFORE_SECONDS = LEASE_SECONDS / 2
+
+# How far the clock may step back before generation fails instead of waiting
+MAX_CLOCK_BACKWARDS_MS = 50
+
+MAX_LEASE_ATTEMPTS = 20
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+class WorkerLease:
+    # A worker ID leased from the workers table by this container
+    def __init__(self, dynamodb, table_name=WORKERS_TABLE, lease_seconds=LEASE_SECONDS):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self.worker_id = None
+        self.expires_at = 0
+
+    def _put(self, worker_id, condition, values):
+        expires_at = int(time.time()) + self.lease_seconds
+        self.dynamodb.Table(self.table_name).put_item(
+            Item={'WorkerID': worker_id, 'Owner': self.owner, 'LeaseExpiresAt': expires_at},
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values
+        )
+        self.worker_id = worker_id
+        self.expires_at = expires_at
+
+    def _acquire(self):
+        for _ in range(MAX_LEASE_ATTEMPTS):
+            worker_id = random.randint(0, MAX_WORKER_ID)
+            try:
+                self._put(worker_id, 'attribute_not_exists(WorkerID) OR LeaseExpiresAt < :now',
+                          {':now': int(time.time())})
+            except Exception as e:
+                if not table_backend.is_conditional_check_failed(e):
+                    raise
+                telemetry.count('WorkerIdCollisions')
+                continue
+            log.info("Leased worker ID", WorkerID=worker_id, LeaseExpiresAt=self.expires_at)
+            return
+        raise RuntimeError("Could not lease a free worker ID")
+
+    def _renew(self):
+        try:
+            self._put(self.worker_id, 'Owner = :owner', {':owner': self.owner})
+        except Exception as e:
+            if not table_backend.is_conditional_check_failed(e):
+                raise
+            log.warning("Lost the worker ID lease", WorkerID=self.worker_id)
+            self.worker_id = None
+            self._acquire()
+
+    def current(self):
+        # Return the leased worker ID, renewing or acquiring the lease as needed
+        if self.worker_id is None:
+            self._acquire()
+        elif self.expires_at - time.time() < RENEW_BEFORE_SECONDS:
+            self._renew()
+        return self.worker_id
+
+class FixedWorker:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker ID must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+
+    def current(self):
+        return self.worker_id
+
+class IdGenerator:
+    def __init__(self, worker):
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.next_sequence = 0
+        self.last_worker_id = None
+
+    def _now_ms(self):
+        return int(time.time() * 1000) - ID_EPOCH_MS
+
+    def _wait_for_clock(self):
+        # Never reuse a (millisecond, sequence) pair, even if the clock steps back
+        now_ms = self._now_ms()
+        if self.last_ms - now_ms > MAX_CLOCK_BACKWARDS_MS:
+            raise RuntimeError(f"Clock moved backwards by {self.last_ms - now_ms} ms")
+        while now_ms < self.last_ms:
+            time.sleep((self.last_ms - now_ms) / 1000)
+            now_ms = self._now_ms()
+        return now_ms
+
+    def next_ids(self, count):
+        # Allocate count increasing IDs in one call
+        ids = []
+        with self.lock:
+            worker_id = self.worker.current()
+            if worker_id != self.last_worker_id:
+                # Start a new worker ID on a fresh millisecond to keep the IDs increasing
+                self.last_worker_id = worker_id
+                self.next_sequence = MAX_SEQUENCE + 1
+            while len(ids) < count:
+                now_ms = self._wait_for_clock()
+                if now_ms > self.last_ms:
+                    self.last_ms = now_ms
+                    self.next_sequence = 0
+                elif self.next_sequence > MAX_SEQUENCE:
+                    # This millisecond is used up, wait for the next one
+                    time.sleep(0.0001)
+                    continue
+
+                # Hand out as much of this millisecond's sequence as needed at once
+                take = min(count - len(ids), MAX_SEQUENCE + 1 - self.next_sequence)
+                base = (now_ms << (WORKER_ID_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS)
+                ids.extend(base | sequence for sequence in range(self.next_sequence, self.next_sequence + take))
+                self.next_sequence += take
+        telemetry.count('IdsGenerated', count)
+        return ids
+
+    def next_id(self):
+        return self.next_ids(1)[0]
+
+_generator = None
+_generator_lock = threading.Lock()
+
+def get_generator():
+    # Generator shared by every handler in the container
+    global _generator
+    with _generator_lock:
+        if _generator is None:
+            if os.environ.get('ID_WORKER_ID'):
+                worker = FixedWorker(int(os.environ['ID_WORKER_ID']))
+            else:
+                worker = WorkerLease(table_backend.get_resource())
+            _generator = IdGenerator(worker)
+        return _generator
+
+def next_ids(count):
+    return get_generator().next_ids(count)
+
+def next_id():
+    return get_generator().next_id()
@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import dynamo_batch
+import table_backend
+import telemetry
+
+# Exactly-once application of redelivered stream records. A handler claims
+# the keys of its records before applying them and only applies the ones it
+# owns:
+#
+#   1. keys already applied in this container are skipped by a warm
+#      in-memory LRU set, without a DynamoDB round trip
+#   2. the rest are claimed with concurrent conditional puts into the
+#      ProcessedRecords table (TTL attribute ExpiresAt); a put that fails
+#      its condition marks a record another invocation already applied
+#
+# Claims whose effect could not be applied are released again, so the
+# redelivery applies them.
+#
+# A handler that applies its records with one UpdateItem per item can
+# claim inline instead (see inline_claim): the keys are added to a string
+# set on the updated item by the same update, conditional on none of them
+# being in it yet, so a claim costs no call of its own and can never
+# outlive a failed update.
+
+# Turn the deduplication off entirely
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+
+# Dedup table and how long its markers are kept; streams keep records for 24 hours
+IDEMPOTENCY_TABLE = os.environ.get('IDEMPOTENCY_TABLE', 'ProcessedRecords')
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(2 * 24 * 3600)))
+
+# Keys remembered per container
+IDEMPOTENCY_FILTER_SIZE = int(os.environ.get('IDEMPOTENCY_FILTER_SIZE', '100000'))
+
+# Inline claims go into one string set per UTC day, AppliedKeys<day>. An
+# update checks today's and yesterday's sets, which covers the 24 hour
+# stream retention, and removes the older sets it finds on the item.
+INLINE_MARKER_PREFIX = 'AppliedKeys'
+
+# Keys per inline claim: each key costs six operators of the condition, and
+# DynamoDB allows 300 per expression
+MAX_INLINE_KEYS = 25
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+class RecentKeys:
+    # Bounded LRU set of the keys applied in this container
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.keys:
+                return False
+            self.keys.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+# Filter shared by every handler in the container
+recent = RecentKeys(IDEMPOTENCY_FILTER_SIZE)
+
+def _record_id(scope, key):
+    return f'{scope}#{key}'
+
+def filter_recent(scope, keys):
+    # The distinct keys not applied in this container yet
+    keys = list(dict.fromkeys(keys))
+    if not IDEMPOTENCY_ENABLED:
+        return keys
+    fresh = [key for key in keys if _record_id(scope, key) not in recent]
+    telemetry.count('DuplicatesFiltered', len(keys) - len(fresh))
+    return fresh
+
+def remember(scope, keys):
+    # Skip keys in this container from now on; they are applied
+    if IDEMPOTENCY_ENABLED:
+        for key in keys:
+            recent.add(_record_id(scope, key))
+
+def claim(scope, keys):
+    # Return the set of keys this invocation owns and must apply. scope
+    # separates the handlers sharing the dedup table.
+    if not IDEMPOTENCY_ENABLED:
+        return set(dict.fromkeys(keys))
+
+    fresh = filter_recent(scope, keys)
+
+    expires_at = int(time.time()) + IDEMPOTENCY_TTL_SECONDS
+    owned = set()
+    duplicates = 0
+    errors = []
+    for key, _, error in dynamo_batch.map_concurrently(lambda key: dynamo_batch.worker_table(IDEMPOTENCY_TABLE).put_item(
+            Item={'RecordID': _record_id(scope, key), 'ExpiresAt': expires_at},
+            ConditionExpression='attribute_not_exists(RecordID)'), fresh):
+        if table_backend.is_conditional_check_failed(error):
+            duplicates += 1
+        elif error:
+            errors.append(error)
+            continue
+        else:
+            owned.add(key)
+        recent.add(_record_id(scope, key))
+
+    if errors:
+        # Every put has finished: release all the keys claimed, wherever they
+        # are in the list, so the caller can retry the whole batch
+        release(scope, owned)
+        raise errors[0]
+
+    telemetry.count('DuplicatesClaimed', duplicates)
+    if duplicates:
+        log.info("Skipped redelivered records", Scope=scope, Duplicates=duplicates)
+    return owned
+
+def release(scope, keys):
+    # Drop the claims of keys whose effect was not applied
+    keys = list(keys)
+    if not IDEMPOTENCY_ENABLED or not keys:
+        return
+    for key in keys:
+        recent.discard(_record_id(scope, key))
+    for key, _, error in dynamo_batch.map_concurrently(
+            lambda key: dynamo_batch.worker_table(IDEMPOTENCY_TABLE).delete_item(Key={'RecordID': _record_id(scope, key)}), keys):
+        if error:
+            log.error("Failed to release claim, the record will not be reapplied", Scope=scope, Key=key, Error=error)
+    telemetry.count('ClaimsReleased', len(keys))
+
+class InlineClaim:
+    # Clauses to merge into the UpdateItem that applies keys: add goes into
+    # its ADD clause, remove (possibly empty) into its REMOVE clause and
+    # condition into its ConditionExpression, with names and values
+    def __init__(self, add, remove, condition, names, values):
+        self.add = add
+        self.remove = remove
+        self.condition = condition
+        self.names = names
+        self.values = values
+
+def _marker_day(name):
+    suffix = name[len(INLINE_MARKER_PREFIX):]
+    return int(suffix) if name.startswith(INLINE_MARKER_PREFIX) and suffix.isdigit() else None
+
+def applied_keys(item):
+    # Every key an inline claim recorded on item
+    keys = set()
+    for name, value in (item or {}).items():
+        if _marker_day(name) is not None:
+            keys.update(value)
+    return keys
+
+def inline_claim(keys, item=None, now=None):
+    # Claim at most MAX_INLINE_KEYS keys in the update of the item they
+    # apply to; item, as last read, names the outdated sets to remove. An
+    # update failing its condition had a key applied already: see
+    # applied_keys on the item read again. None when deduplication is off.
+    if not IDEMPOTENCY_ENABLED:
+        return None
+    keys = list(dict.fromkeys(keys))
+    if not keys or len(keys) > MAX_INLINE_KEYS:
+        raise ValueError(f"An inline claim takes 1 to {MAX_INLINE_KEYS} keys, got {len(keys)}")
+
+    day = int((time.time() if now is None else now) // 86400)
+    names = {
+        '#applied_today': f'{INLINE_MARKER_PREFIX}{day}',
+        '#applied_yesterday': f'{INLINE_MARKER_PREFIX}{day - 1}'
+    }
+    values = {':applied_keys': set(keys)}
+    conditions = []
+    for position, key in enumerate(keys):
+        values[f':applied_key{position}'] = key
+        conditions.append(f'NOT contains(#applied_today, :applied_key{position})'
+                          f' AND NOT contains(#applied_yesterday, :applied_key{position})')
+
+    outdated = sorted(name for name in (item or {}) if _marker_day(name) is not None and _marker_day(name) < day - 1)
+    removals = []
+    for position, name in enumerate(outdated):
+        names[f'#applied_outdated{position}'] = name
+        removals.append(f'#applied_outdated{position}')
+
+    return InlineClaim('#applied_today :applied_keys', ', '.join(removals), ' AND '.join(conditions), names, values)
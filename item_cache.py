@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+import dynamo_batch
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Maximum number of items kept per container before the least recently used is evicted
+ITEM_CACHE_MAX_ITEMS = int(os.environ.get('ITEM_CACHE_MAX_ITEMS', '10000'))
+
+# Time to live in seconds for each cached table; tables not listed here are never cached.
+# A container drops the items of the stream records it handles (see
+# invalidate_stream_records); in every other container the TTL bounds how
+# stale a cached item can be. CurrentPrice writers guard on Version and
+# re-read consistently on a conflict, so a stale cached price costs a
+# retry, never a lost write.
+TABLE_TTL_SECONDS = {
+    'Products': float(os.environ.get('PRODUCTS_CACHE_TTL_SECONDS', '10')),
+    'CurrentPrice': float(os.environ.get('CURRENT_PRICE_CACHE_TTL_SECONDS', '5'))
+}
+
+def _cache_key(table_name, key):
+    return (table_name, tuple(sorted(key.items())))
+
+class ItemCache:
+    # Bounded LRU cache of DynamoDB items with a per-table TTL.
+    # A cached value of None records that the item does not exist. Handlers
+    # read it from pool threads too, so every access holds the lock.
+    def __init__(self, max_items, ttls):
+        self.max_items = max_items
+        self.ttls = ttls
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_cached_table(self, table_name):
+        return self.ttls.get(table_name, 0) > 0
+
+    def get(self, table_name, key):
+        # Returns (found, item)
+        cache_key = _cache_key(table_name, key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[cache_key]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, table_name, key, item):
+        if not self.is_cached_table(table_name):
+            return
+        cache_key = _cache_key(table_name, key)
+        with self.lock:
+            self.entries[cache_key] = (time.monotonic() + self.ttls[table_name], item)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, table_name, key):
+        with self.lock:
+            self.entries.pop(_cache_key(table_name, key), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'Size': len(self.entries),
+                'Hits': self.hits,
+                'Misses': self.misses,
+                'Evictions': self.evictions
+            }
+
+# Cache shared by every handler in the container
+cache = ItemCache(ITEM_CACHE_MAX_ITEMS, TABLE_TTL_SECONDS)
+
+def get_item(table, key):
+    # Read-through lookup of a single item; returns the item or None
+    if not cache.is_cached_table(table.name):
+        return table.get_item(Key=key).get('Item')
+
+    found, item = cache.get(table.name, key)
+    if not found:
+        item = table.get_item(Key=key).get('Item')
+        cache.put(table.name, key, item)
+    return item
+
+def batch_get_items(dynamodb, keys_by_table):
+    # Read-through version of dynamo_batch.batch_get_items: cached items are
+    # served from memory and only the misses are fetched with BatchGetItem
+    items = {table_name: [] for table_name in keys_by_table}
+    missing = {}
+    hits = misses = 0
+    for table_name, keys in keys_by_table.items():
+        if not cache.is_cached_table(table_name):
+            missing[table_name] = keys
+            continue
+        for key in keys:
+            found, item = cache.get(table_name, key)
+            if not found:
+                misses += 1
+                missing.setdefault(table_name, []).append(key)
+            else:
+                hits += 1
+                if item is not None:
+                    items[table_name].append(item)
+    telemetry.count('ItemCacheHits', hits)
+    telemetry.count('ItemCacheMisses', misses)
+
+    if not missing:
+        return items, {}
+
+    fetched, unprocessed = dynamo_batch.batch_get_items(dynamodb, missing)
+    for table_name, table_items in fetched.items():
+        items[table_name].extend(table_items)
+        if not cache.is_cached_table(table_name):
+            continue
+
+        # Cache the fetched items, and the absence of keys that were processed but not found
+        key_attributes = list(missing[table_name][0])
+        found_keys = set()
+        for item in table_items:
+            key = {attribute: item[attribute] for attribute in key_attributes}
+            found_keys.add(_cache_key(table_name, key))
+            cache.put(table_name, key, item)
+        unprocessed_keys = {_cache_key(table_name, key) for key in unprocessed.get(table_name, [])}
+        for key in missing[table_name]:
+            cache_key = _cache_key(table_name, key)
+            if cache_key not in found_keys and cache_key not in unprocessed_keys:
+                cache.put(table_name, key, None)
+
+    return items, unprocessed
+
+def _deserialize_key(keys):
+    # Convert a stream record key such as {'ProductID': {'S': 'P1'}} to {'ProductID': 'P1'}
+    key = {}
+    for attribute, value in keys.items():
+        if 'N' in value:
+            key[attribute] = Decimal(value['N'])
+        else:
+            key[attribute] = next(iter(value.values()))
+    return key
+
+def invalidate_stream_records(records, table_name):
+    # Drop every item touched by a DynamoDB stream batch of table_name from the cache
+    invalidated = 0
+    for record in records:
+        keys = (record.get('dynamodb') or {}).get('Keys')
+        if keys:
+            cache.invalidate(table_name, _deserialize_key(keys))
+            invalidated += 1
+    return invalidated
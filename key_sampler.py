@@ -0,0 +1,109 @@
+import os
+import time
+import random
+import dynamo_batch
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Rebuild a cached key index once it is older than this many seconds
+KEY_INDEX_TTL_SECONDS = float(os.environ.get('KEY_INDEX_TTL_SECONDS', '300'))
+
+# Number of parallel scan segments used to rebuild an index
+KEY_INDEX_SCAN_SEGMENTS = int(os.environ.get('KEY_INDEX_SCAN_SEGMENTS', '4'))
+
+# Key indexes cached across warm invocations, by table name
+_indexes = {}
+
+class KeyIndex:
+    # Compact set of primary keys supporting O(1) add, discard and uniform sampling
+    def __init__(self, key_attributes):
+        self.key_attributes = tuple(key_attributes)
+        self.keys = []
+        self.positions = {}
+        self.built_at = 0.0
+
+    def _key_tuple(self, key):
+        return tuple(key[attribute] for attribute in self.key_attributes)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        key_tuple = self._key_tuple(key)
+        if key_tuple not in self.positions:
+            self.positions[key_tuple] = len(self.keys)
+            self.keys.append(key_tuple)
+
+    def discard(self, key):
+        key_tuple = self._key_tuple(key)
+        position = self.positions.pop(key_tuple, None)
+        if position is None:
+            return
+        # Move the last key into the freed slot to keep the list dense
+        last = self.keys.pop()
+        if position < len(self.keys):
+            self.keys[position] = last
+            self.positions[last] = position
+
+    def sample(self):
+        if not self.keys:
+            return None
+        return dict(zip(self.key_attributes, random.choice(self.keys)))
+
+    def is_stale(self):
+        return time.monotonic() - self.built_at > KEY_INDEX_TTL_SECONDS
+
+def _scan_segment(table, key_attributes, segment, total_segments):
+    names = {f'#k{i}': attribute for i, attribute in enumerate(key_attributes)}
+    kwargs = {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+    keys = []
+    while True:
+        response = table.scan(**kwargs)
+        keys.extend(response['Items'])
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return keys
+        kwargs['ExclusiveStartKey'] = last_key
+
+def build_index(table, key_attributes, segments=None):
+    # Build a key index with a paginated parallel scan that only projects the key attributes
+    segments = segments or KEY_INDEX_SCAN_SEGMENTS
+    index = KeyIndex(key_attributes)
+    # Segments run on the shared batch pool, each worker scanning through its own table object
+    table_name = table.name
+    for _, keys, error in dynamo_batch.map_concurrently(
+            lambda segment: _scan_segment(dynamo_batch.worker_table(table_name), index.key_attributes, segment, segments),
+            list(range(segments))):
+        if error:
+            raise error
+        for key in keys:
+            index.add(key)
+    index.built_at = time.monotonic()
+    log.info("Built key index", Table=table.name, Keys=len(index))
+    return index
+
+def get_index(table, key_attributes):
+    # Return the cached key index for the table, rebuilding it when missing or stale
+    index = _indexes.get(table.name)
+    if index is None or index.is_stale() or index.key_attributes != tuple(key_attributes):
+        index = build_index(table, key_attributes)
+        _indexes[table.name] = index
+    return index
+
+def random_key(table, key_attributes):
+    # Pick a uniformly random primary key of the table, or None if it is empty
+    return get_index(table, key_attributes).sample()
+
+def invalidate(table_name=None):
+    # Drop the cached index for one table, or for every table
+    if table_name is None:
+        _indexes.clear()
+    else:
+        _indexes.pop(table_name, None)
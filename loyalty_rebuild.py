@@ -0,0 +1,420 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import threading
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+import customer
+import dynamo_batch
+import price
+import table_backend
+import telemetry
+
+# Rebuilds TotalSpent and LoyaltyLevel of every customer from the
+# CustomerProductSelection table, e.g. after LOYALTY_THRESHOLDS change or a
+# data repair. It runs in three phases:
+#
+#   1. selections: a parallel segmented Scan spills the selections to
+#      files, one per segment and partition of the customers, so memory
+#      holds one page at a time
+#   2. spend: partition by partition, each customer's selections are
+#      replayed in SelectionID order at the product's BasePrice, with
+#      customer.calculate_new_price and customer.determine_loyalty_level,
+#      the rules the stream handler applies, so the level reached so far
+#      prices the next selection
+#   3. customers: a parallel segmented Scan of Customer sets TotalSpent and
+#      LoyaltyLevel where they differ, with an update conditional on the
+#      TotalSpent that was scanned
+#
+# A customer whose TotalSpent the stream handler moves while the job runs
+# fails the condition and keeps the live value; it is counted in Conflicts
+# and a later run picks it up. Progress of phases 1 and 3 is checkpointed
+# per segment, so a run that is stopped (or a Lambda invocation that runs
+# out of time) resumes where it left off. The checkpoint holds scan
+# positions, counters and the length of each spill file, never selections.
+#
+#   python loyalty_rebuild.py --segments 16 --resume
+
+# Parallel scan segments, one worker each
+LOYALTY_SCAN_SEGMENTS = int(os.environ.get('LOYALTY_SCAN_SEGMENTS', '8'))
+
+SELECTION_TABLE = 'CustomerProductSelection'
+PRODUCTS_TABLE = 'Products'
+CUSTOMER_TABLE = 'Customer'
+
+# Where the checkpoint is kept, with the spill files in a directory next to
+# it; point it at EFS when running in Lambda
+LOYALTY_CHECKPOINT_PATH = os.environ.get('LOYALTY_CHECKPOINT_PATH', '/tmp/loyalty_rebuild.json')
+CHECKPOINT_INTERVAL_SECONDS = float(os.environ.get('LOYALTY_CHECKPOINT_INTERVAL_SECONDS', '5'))
+
+# Customer partitions of the spilled selections; phase 2 holds one in memory
+LOYALTY_SPILL_PARTITIONS = int(os.environ.get('LOYALTY_SPILL_PARTITIONS', '16'))
+
+# Stop this long before the Lambda deadline to leave time for the checkpoint
+DEADLINE_MARGIN_MS = 30000
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+class Checkpoint:
+    # Job progress, shared by the segment workers and saved atomically
+    def __init__(self, path, total_segments, state=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved_at = time.monotonic()
+        self.state = state or {'TotalSegments': total_segments, 'SpillPartitions': LOYALTY_SPILL_PARTITIONS}
+
+    @classmethod
+    def load(cls, path, total_segments):
+        # Resume from the checkpoint at path when it exists
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file, parse_float=Decimal)
+            log.info("Resuming from checkpoint", Path=path, TotalSegments=state['TotalSegments'])
+            return cls(path, state['TotalSegments'], state)
+        return cls(path, total_segments)
+
+    @property
+    def total_segments(self):
+        return self.state['TotalSegments']
+
+    def segment(self, phase, segment):
+        with self.lock:
+            return self.state.setdefault(phase, {}).setdefault(
+                str(segment), {'LastEvaluatedKey': None, 'Done': False})
+
+    def advance(self, phase, segment, merge=None, force=False, **progress):
+        # Record a finished page: merge(progress) folds its results in and
+        # progress moves the scan position, in one step under the lock, so a
+        # save never holds the results of a page without its position
+        with self.lock:
+            segment_progress = self.state[phase][str(segment)]
+            if merge:
+                merge(segment_progress)
+            segment_progress.update(progress)
+            if force or time.monotonic() - self.saved_at >= CHECKPOINT_INTERVAL_SECONDS:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.saved_at = time.monotonic()
+        if not self.path:
+            return
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            checkpoint_file.write(price.dumps(self.state))
+        os.replace(temporary_path, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class SelectionSpill:
+    # Selections of phase 1 as JSON lines of [CustomerID, SelectionID,
+    # ProductID], appended to one file per scan segment and customer
+    # partition. Only the segment's worker writes its files. The checkpoint
+    # keeps their lengths after the last recorded page, so a resumed run
+    # cuts off the pages it had not recorded.
+    def __init__(self, directory, partitions):
+        self.directory = directory
+        self.partitions = partitions
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, segment, partition):
+        return os.path.join(self.directory, f'{segment}-{partition}.jsonl')
+
+    def partition(self, customer_id):
+        return zlib.crc32(str(customer_id).encode()) % self.partitions
+
+    def truncate(self, segment, lengths):
+        # Drop what was appended to the segment's files after lengths were recorded
+        for partition in range(self.partitions):
+            path = self._path(segment, partition)
+            if os.path.exists(path):
+                with open(path, 'r+b') as spill_file:
+                    spill_file.truncate(lengths.get(str(partition), 0))
+
+    def append(self, segment, items):
+        # Append one page of selections; returns the new {partition: length}
+        # of the files it wrote to
+        lines = {}
+        for item in items:
+            lines.setdefault(self.partition(item['CustomerID']), []).append(
+                price.dumps([item['CustomerID'], item.get('SelectionID'), item['ProductID']]).encode() + b'\n')
+        lengths = {}
+        for partition, partition_lines in lines.items():
+            with open(self._path(segment, partition), 'ab') as spill_file:
+                spill_file.writelines(partition_lines)
+                lengths[str(partition)] = spill_file.tell()
+        return lengths
+
+    def read(self, partition, lengths):
+        # {customer_id: [[selection_id, product_id], ...]} of one partition,
+        # from every segment's file up to its recorded length
+        selections = {}
+        for segment, segment_lengths in lengths.items():
+            length = segment_lengths.get(str(partition), 0)
+            if not length:
+                continue
+            with open(self._path(segment, partition), 'rb') as spill_file:
+                data = spill_file.read(length)
+            for line in data.splitlines():
+                customer_id, selection_id, product_id = json.loads(line, parse_float=Decimal)
+                selections.setdefault(customer_id, []).append([selection_id, product_id])
+        return selections
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def _scan_pages(table, segment, total_segments, start_key, stop, **kwargs):
+    # Yield (items, last_evaluated_key) for the pages of one scan segment
+    kwargs.update(Segment=segment, TotalSegments=total_segments)
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+    while not stop.is_set():
+        response = table.scan(**kwargs)
+        last_key = response.get('LastEvaluatedKey')
+        yield response['Items'], last_key
+        if not last_key:
+            return
+        kwargs['ExclusiveStartKey'] = last_key
+
+def _collect_selections(checkpoint, spill, segment, stop):
+    # Spill the selections of one segment
+    phase = 'Selections'
+    progress = checkpoint.segment(phase, segment)
+    if progress['Done']:
+        return 0
+    spill.truncate(segment, progress.get('SpillLengths', {}))
+    collected = 0
+    # Segment workers run on their own threads, each with its own resource
+    table = table_backend.get_thread_resource().Table(SELECTION_TABLE)
+    for items, last_key in _scan_pages(
+            table, segment, checkpoint.total_segments, progress['LastEvaluatedKey'], stop,
+            ProjectionExpression='SelectionID, CustomerID, ProductID'):
+        lengths = spill.append(segment, [item for item in items if 'CustomerID' in item and 'ProductID' in item])
+
+        def merge(segment_progress):
+            segment_progress.setdefault('SpillLengths', {}).update(lengths)
+
+        checkpoint.advance(phase, segment, merge=merge, LastEvaluatedKey=last_key, Done=not last_key,
+                           force=not last_key)
+        collected += len(items)
+    return collected
+
+def _selection_order(selection):
+    # Snowflake SelectionIDs sort by creation time; older non-numeric IDs come after, by value
+    selection_id = str(selection[0])
+    return (0, int(selection_id), '') if selection_id.isdigit() else (1, 0, selection_id)
+
+def replay_spend(selections, base_prices):
+    # TotalSpent of every customer from {customer_id: [[selection_id, product_id], ...]}
+    # and {product_id: BasePrice}, as the stream handler would have added it
+    # up one selection at a time. Selections of unknown products add nothing.
+    prices = {}
+    spend = {}
+    for customer_id, customer_selections in selections.items():
+        total = price.ZERO
+        loyalty_level = customer.determine_loyalty_level(total.to_decimal())
+        for _, product_id in sorted(customer_selections, key=_selection_order):
+            if product_id not in base_prices:
+                continue
+            key = (product_id, loyalty_level)
+            if key not in prices:
+                prices[key] = price.Price.parse(customer.calculate_new_price(base_prices[product_id], loyalty_level))
+            total = total + prices[key]
+            loyalty_level = customer.determine_loyalty_level(total.to_decimal())
+        spend[customer_id] = total
+    return spend
+
+def _replay_partitions(spill, lengths):
+    # TotalSpent of every customer, replayed one spill partition at a time;
+    # base prices are read once per product
+    spend = {}
+    base_prices = {}
+    read_products = set()
+    for partition in range(spill.partitions):
+        selections = spill.read(partition, lengths)
+        unread = sorted({product_id for entries in selections.values() for _, product_id in entries} - read_products)
+        if unread:
+            base_prices.update(_read_base_prices(unread))
+            read_products.update(unread)
+        spend.update(replay_spend(selections, base_prices))
+    return spend
+
+def _read_base_prices(product_ids):
+    items, unprocessed = dynamo_batch.batch_get_items(
+        table_backend.get_resource(), {PRODUCTS_TABLE: [{'ProductID': product_id} for product_id in product_ids]})
+    if unprocessed:
+        raise RuntimeError(f"{len(unprocessed[PRODUCTS_TABLE])} products could not be read")
+    return {item['ProductID']: item['BasePrice'] for item in items[PRODUCTS_TABLE] if 'BasePrice' in item}
+
+def _rebuild_customers(checkpoint, spend, segment, stop):
+    # Set TotalSpent and LoyaltyLevel of every customer of one segment that is out of date.
+    # Returns (processed, written, conflicts).
+    phase = 'Customers'
+    progress = checkpoint.segment(phase, segment)
+    if progress['Done']:
+        return 0, 0, 0
+    processed = written = conflicts = 0
+    table = table_backend.get_thread_resource().Table(CUSTOMER_TABLE)
+    for items, last_key in _scan_pages(
+            table, segment, checkpoint.total_segments, progress['LastEvaluatedKey'], stop,
+            ProjectionExpression='CustomerID, TotalSpent, LoyaltyLevel'):
+        updates = []
+        for item in items:
+            total_spent = spend.get(item['CustomerID'], price.ZERO).to_decimal()
+            loyalty_level = customer.determine_loyalty_level(total_spent)
+            if item.get('TotalSpent') == total_spent and item.get('LoyaltyLevel') == loyalty_level:
+                continue
+            # Only replace the TotalSpent that was scanned, never a live ADD made since
+            if 'TotalSpent' in item:
+                condition, values = 'TotalSpent = :seen', {':seen': item['TotalSpent']}
+            else:
+                condition, values = 'attribute_exists(CustomerID) AND attribute_not_exists(TotalSpent)', {}
+            updates.append((item['CustomerID'], {
+                'Key': {'CustomerID': item['CustomerID']},
+                'UpdateExpression': 'SET TotalSpent = :total, LoyaltyLevel = :level',
+                'ConditionExpression': condition,
+                'ExpressionAttributeValues': dict(values, **{':total': total_spent, ':level': loyalty_level})
+            }))
+
+        page_written = page_conflicts = 0
+        for customer_id, _, error in dynamo_batch.update_items(table, updates):
+            if table_backend.is_conditional_check_failed(error):
+                log.info("TotalSpent changed during the rebuild, keeping the live value", CustomerID=customer_id)
+                page_conflicts += 1
+            elif error:
+                # Leave the checkpoint at the previous page so a resumed run retries it
+                raise error
+            else:
+                page_written += 1
+
+        processed += len(items)
+        written += page_written
+        conflicts += page_conflicts
+        checkpoint.advance(phase, segment, LastEvaluatedKey=last_key, Done=not last_key, force=not last_key,
+                           Processed=progress.get('Processed', 0) + len(items),
+                           Written=progress.get('Written', 0) + page_written,
+                           Conflicts=progress.get('Conflicts', 0) + page_conflicts)
+    return processed, written, conflicts
+
+def _run_segments(function, segments, stop):
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(telemetry.propagate(function), *segment, stop) for segment in segments]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            # Stop the other workers at their next page
+            stop.set()
+            raise
+
+def rebuild(total_segments=None, checkpoint_path=LOYALTY_CHECKPOINT_PATH, resume=True, deadline=None):
+    # Run (or resume) the rebuild. deadline() returns True when the job must
+    # stop; progress is then checkpointed and Complete is False.
+    total_segments = total_segments or LOYALTY_SCAN_SEGMENTS
+    spill_directory = checkpoint_path + '.selections' if checkpoint_path else tempfile.mkdtemp(prefix='loyalty_rebuild')
+    if not resume and checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint.load(checkpoint_path, total_segments)
+    total_segments = checkpoint.total_segments
+    if 'Selections' not in checkpoint.state:
+        # Nothing recorded: spilled pages from an earlier run count for nothing
+        shutil.rmtree(spill_directory, ignore_errors=True)
+    spill = SelectionSpill(spill_directory, checkpoint.state.setdefault('SpillPartitions', LOYALTY_SPILL_PARTITIONS))
+
+    stop = threading.Event()
+    watcher = None
+    if deadline:
+        def watch():
+            while not stop.wait(1):
+                if deadline():
+                    log.warning("Stopping at the deadline")
+                    stop.set()
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+
+    summary = {'TotalSegments': total_segments, 'Selections': 0, 'Customers': 0, 'Written': 0, 'Conflicts': 0}
+    start = time.perf_counter()
+    try:
+        # Phase 1: selections per customer
+        collected = _run_segments(lambda segment, stop: _collect_selections(checkpoint, spill, segment, stop),
+                                  [(segment,) for segment in range(total_segments)], stop)
+        summary['Selections'] = sum(collected)
+        spend_seconds = time.perf_counter() - start
+
+        if not stop.is_set():
+            # Phase 2: spend per customer
+            spend = _replay_partitions(spill, {
+                segment: progress.get('SpillLengths', {}) for segment, progress in checkpoint.state['Selections'].items()
+            })
+
+            # Phase 3: customers
+            results = _run_segments(lambda segment, stop: _rebuild_customers(checkpoint, spend, segment, stop),
+                                    [(segment,) for segment in range(total_segments)], stop)
+            summary['Customers'] = sum(processed for processed, _, _ in results)
+            summary['Written'] = sum(written for _, written, _ in results)
+            summary['Conflicts'] = sum(conflicts for _, _, conflicts in results)
+    finally:
+        stop_requested = stop.is_set()
+        stop.set()
+        if watcher:
+            watcher.join()
+        checkpoint.save()
+
+    elapsed = time.perf_counter() - start
+    customers_seconds = elapsed - spend_seconds
+    summary.update(
+        Complete=not stop_requested,
+        Seconds=round(elapsed, 3),
+        SelectionsPerSecond=round(summary['Selections'] / spend_seconds, 1) if spend_seconds else None,
+        CustomersPerSecond=round(summary['Customers'] / customers_seconds, 1) if customers_seconds and summary['Customers'] else None
+    )
+    if summary['Complete']:
+        checkpoint.remove()
+        spill.remove()
+    telemetry.count('CustomersRebuilt', summary['Customers'])
+    telemetry.count('CustomersWritten', summary['Written'])
+    telemetry.count('RebuildConflicts', summary['Conflicts'])
+    log.info("Loyalty rebuild", **summary)
+    return summary
+
+@telemetry.instrument
+def lambda_handler(event, context):
+    # Re-invoke with the same event until Complete is True
+    deadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = lambda: context.get_remaining_time_in_millis() < DEADLINE_MARGIN_MS
+    try:
+        summary = rebuild(total_segments=event.get('TotalSegments'), resume=event.get('Resume', True),
+                          deadline=deadline)
+    except Exception as e:
+        log.exception("Loyalty rebuild failed, progress is kept in the checkpoint", Error=e)
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Loyalty rebuild failed: {e}")
+        }
+    return {
+        'statusCode': 200 if summary['Complete'] else 202,
+        'body': price.dumps(summary)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild TotalSpent and LoyaltyLevel of every customer')
+    parser.add_argument('--segments', type=int, default=LOYALTY_SCAN_SEGMENTS, help='parallel scan segments')
+    parser.add_argument('--checkpoint', default=LOYALTY_CHECKPOINT_PATH, help='checkpoint file')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint instead of starting over')
+    args = parser.parse_args()
+
+    summary = rebuild(total_segments=args.segments, checkpoint_path=args.checkpoint, resume=args.resume)
+    print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    main()
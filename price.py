@@ -0,0 +1,121 @@
+import json
+from decimal import Decimal, ROUND_HALF_EVEN
+
+# Fixed-point money: a Price holds a whole number of cents, so sums and
+# comparisons are integer operations. Values with more than two decimal
+# places are rounded half-even to the cent, the same rule the pricing
+# engine applies. In DynamoDB a price is always a number with two places.
+
+ROUNDING = ROUND_HALF_EVEN
+
+_ONE = Decimal(1)
+
+class Price:
+    __slots__ = ('cents',)
+
+    def __init__(self, cents):
+        self.cents = int(cents)
+
+    @classmethod
+    def parse(cls, value):
+        # Build a Price from a Price, Decimal, int, float or str amount in
+        # dollars, or a DynamoDB stream attribute such as {'N': '12.34'}
+        if isinstance(value, Price):
+            return value
+        if isinstance(value, dict):
+            value = value['N']
+        if isinstance(value, float):
+            value = repr(value)
+        if not isinstance(value, Decimal):
+            value = Decimal(value)
+        if not value.is_finite():
+            raise ValueError(f"Not a valid price: {value}")
+        cents = value.scaleb(2)
+        if cents.as_tuple().exponent < 0:
+            cents = cents.quantize(_ONE, rounding=ROUNDING)
+        return cls(int(cents))
+
+    def to_decimal(self):
+        # Decimal with exactly two places, as stored in DynamoDB number attributes
+        return Decimal(self.cents).scaleb(-2)
+
+    def to_attribute(self):
+        # DynamoDB JSON, as found in stream images
+        return {'N': str(self)}
+
+    def __str__(self):
+        sign = '-' if self.cents < 0 else ''
+        dollars, cents = divmod(abs(self.cents), 100)
+        return f'{sign}{dollars}.{cents:02d}'
+
+    def __repr__(self):
+        return f'Price({self})'
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __eq__(self, other):
+        if isinstance(other, Price):
+            return self.cents == other.cents
+        return NotImplemented
+
+    def __lt__(self, other):
+        return self.cents < other.cents
+
+    def __le__(self, other):
+        return self.cents <= other.cents
+
+    def __gt__(self, other):
+        return self.cents > other.cents
+
+    def __ge__(self, other):
+        return self.cents >= other.cents
+
+    def __add__(self, other):
+        if isinstance(other, Price):
+            return Price(self.cents + other.cents)
+        if other == 0:
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Price):
+            return Price(self.cents - other.cents)
+        return NotImplemented
+
+    def __neg__(self):
+        return Price(-self.cents)
+
+ZERO = Price(0)
+
+def to_decimal(value):
+    # Normalize an amount to a two-place Decimal for a DynamoDB write
+    return Price.parse(value).to_decimal()
+
+class PriceEncoder(json.JSONEncoder):
+    # JSON encoder for handler responses and events: prices and fractional
+    # Decimals become numbers, integral Decimals become integers and sets become lists
+    def default(self, obj):
+        if isinstance(obj, Price):
+            return obj.cents / 100
+        if isinstance(obj, Decimal):
+            return int(obj) if obj == obj.to_integral_value() else float(obj)
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj)
+        return super().default(obj)
+
+_encoder = PriceEncoder()
+
+def dumps(obj, **kwargs):
+    # json.dumps with PriceEncoder, reusing one encoder for the default settings
+    if kwargs:
+        return json.dumps(obj, cls=PriceEncoder, **kwargs)
+    return _encoder.encode(obj)
@@ -0,0 +1,212 @@
+import os
+import time
+from decimal import Decimal
+import dynamo_batch
+import item_cache
+import price
+import price_history
+import pricing_engine
+import table_backend
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# When enabled, demand_and_supply, competitor and seasonal_sales write their
+# prices to the PriceSignals table instead of CurrentPrice. This module's
+# lambda_handler consumes the PriceSignals stream over a tumbling window
+# (TumblingWindowInSeconds on the event source mapping) and writes at most
+# one combined CurrentPrice per product per window.
+PRICE_AGGREGATION_ENABLED = os.environ.get('PRICE_AGGREGATION_ENABLED', 'false').lower() == 'true'
+
+SIGNALS_TABLE = 'PriceSignals'
+CURRENT_PRICE_TABLE = 'CurrentPrice'
+PRODUCTS_TABLE = 'Products'
+SIGNALS = ('demand_and_supply', 'competitor', 'seasonal_sales')
+
+# 'precedence' takes the price of the first signal in SIGNAL_PRECEDENCE that
+# has one; 'blend' takes the SIGNAL_WEIGHTS weighted mean of the signals present
+AGGREGATION_MODE = os.environ.get('PRICE_AGGREGATION_MODE', 'precedence')
+SIGNAL_PRECEDENCE = tuple(
+    os.environ.get('PRICE_SIGNAL_PRECEDENCE', 'seasonal_sales,competitor,demand_and_supply').split(',')
+)
+SIGNAL_WEIGHTS = {
+    signal: Decimal(weight)
+    for signal, weight in (
+        entry.split(':') for entry in
+        os.environ.get('PRICE_SIGNAL_WEIGHTS', 'demand_and_supply:2,competitor:1,seasonal_sales:1').split(',')
+    )
+}
+
+# How long a signal counts after it was submitted, in seconds. An older one
+# is ignored when combining, so a stale competitor price cannot outrank
+# fresh demand and supply prices; it is also written as the ExpiresAt TTL
+# attribute so DynamoDB deletes it. Promotions lapse at their own end date.
+SIGNAL_MAX_AGE_SECONDS = {
+    signal: int(max_age)
+    for signal, max_age in (
+        entry.split(':') for entry in
+        os.environ.get('PRICE_SIGNAL_MAX_AGE_SECONDS', 'demand_and_supply:86400,competitor:21600').split(',')
+    )
+}
+
+def submit_signals(signal, prices, expires_at=None):
+    # Record the latest price of a signal for each product. prices is a list
+    # of (request_id, product_id, Price) with distinct products; expires_at
+    # (epoch seconds) drops the signal from aggregation once passed, and
+    # defaults to the signal's SIGNAL_MAX_AGE_SECONDS.
+    # Returns (request_id, None, error) tuples like dynamo_batch.update_items.
+    updated_at = int(time.time() * 1000)
+    if expires_at is None and signal in SIGNAL_MAX_AGE_SECONDS:
+        expires_at = updated_at / 1000 + SIGNAL_MAX_AGE_SECONDS[signal]
+    items = []
+    for _, product_id, new_price in prices:
+        item = {'ProductID': product_id, 'Signal': signal, 'Price': new_price.to_decimal(), 'UpdatedAt': updated_at}
+        if expires_at is not None:
+            item['ExpiresAt'] = int(expires_at)
+        items.append(item)
+
+    # The resource is fetched on use: the producers import this module even
+    # when aggregation is off
+    dynamodb = table_backend.get_resource()
+    unprocessed = {item['ProductID'] for item in dynamo_batch.batch_put_items(dynamodb, SIGNALS_TABLE, items)}
+    telemetry.count('SignalsSubmitted', len(items) - len(unprocessed))
+    return [
+        (request_id, None, RuntimeError("Signal write was not processed") if product_id in unprocessed else None)
+        for request_id, product_id, _ in prices
+    ]
+
+def combine(signals):
+    # Combine {signal: Price} into one Price, or None when there is no signal
+    if not signals:
+        return None
+    if AGGREGATION_MODE == 'blend':
+        weights = {signal: SIGNAL_WEIGHTS.get(signal, Decimal(0)) for signal in signals}
+        total_weight = sum(weights.values())
+        if total_weight:
+            cents = sum(weights[signal] * signal_price.cents for signal, signal_price in signals.items())
+            return price.Price.parse(cents / total_weight / 100)
+    for signal in SIGNAL_PRECEDENCE:
+        if signal in signals:
+            return signals[signal]
+    return next(iter(signals.values()))
+
+def read_signals(product_ids):
+    # Current, unexpired signals of the products as {product_id: {signal: Price}}
+    items, unprocessed = dynamo_batch.batch_get_items(table_backend.get_resource(), {
+        SIGNALS_TABLE: [{'ProductID': product_id, 'Signal': signal} for product_id in product_ids for signal in SIGNALS]
+    })
+    if unprocessed:
+        raise RuntimeError(f"Could not read price signals: {unprocessed}")
+
+    now = time.time()
+    signals = {}
+    stale = 0
+    for item in items[SIGNALS_TABLE]:
+        # DynamoDB deletes expired items only eventually, so check both here
+        max_age = SIGNAL_MAX_AGE_SECONDS.get(item['Signal'])
+        if ('ExpiresAt' in item and item['ExpiresAt'] <= now) or \
+                (max_age is not None and item.get('UpdatedAt', 0) / 1000 + max_age <= now):
+            stale += 1
+            continue
+        signals.setdefault(item['ProductID'], {})[item['Signal']] = price.Price.parse(item['Price'])
+    telemetry.count('StaleSignals', stale)
+    return signals
+
+def fallback_prices(product_ids):
+    # Price of products left without an unexpired signal, as {product_id:
+    # (Price, pricing inputs)}: the demand and supply price of the product,
+    # or its BasePrice when that is undefined
+    items, unprocessed = dynamo_batch.batch_get_items(table_backend.get_resource(), {
+        PRODUCTS_TABLE: [{'ProductID': product_id} for product_id in product_ids]
+    })
+    if unprocessed:
+        raise RuntimeError(f"Could not read products: {unprocessed}")
+
+    fallbacks = {}
+    demand_priced = []
+    for item in items[PRODUCTS_TABLE]:
+        if 'BasePrice' not in item:
+            continue
+        base_price = price.Price.parse(item['BasePrice'])
+        fallbacks[item['ProductID']] = (base_price, {'base_price': base_price})
+        if 'Demand' in item and 'Stock' in item:
+            demand_priced.append((item, base_price))
+
+    new_prices = pricing_engine.to_prices(pricing_engine.price_batch(
+        base_price=[base_price for _, base_price in demand_priced],
+        demand=[item['Demand'] for item, _ in demand_priced],
+        stock=[item['Stock'] for item, _ in demand_priced]
+    )) if demand_priced else []
+    for (item, base_price), new_price in zip(demand_priced, new_prices):
+        if new_price is not None:
+            fallbacks[item['ProductID']] = (new_price, {'base_price': base_price, 'demand': item['Demand'], 'stock': item['Stock']})
+    return fallbacks
+
+def aggregate(product_ids):
+    # Write one combined CurrentPrice per product; writes that would not
+    # change the stored price are skipped by the condition. A product whose
+    # signals all expired goes back to its fallback price rather than
+    # keeping the last combined one.
+    signals = read_signals(product_ids)
+    unsignalled = [product_id for product_id in product_ids if not signals.get(product_id)]
+    fallbacks = fallback_prices(unsignalled) if unsignalled else {}
+    writes = []
+    for product_id in product_ids:
+        combined = combine(signals.get(product_id, {}))
+        inputs = {}
+        if combined is None:
+            if product_id not in fallbacks:
+                log.warning("No signal and no BasePrice to price the product", ProductID=product_id)
+                continue
+            combined, inputs = fallbacks[product_id]
+        writes.append(((product_id, combined, inputs), {
+            'Key': {'ProductID': product_id},
+            'UpdateExpression': 'SET CurrentPrice = :price ADD Version :one',
+            'ConditionExpression': 'attribute_not_exists(CurrentPrice) OR CurrentPrice <> :price',
+            'ExpressionAttributeValues': {':price': combined.to_decimal(), ':one': 1}
+        }))
+
+    summary = {'Products': len(product_ids), 'Written': 0, 'Unchanged': 0, 'Fallbacks': len(fallbacks), 'Failed': []}
+    dynamodb = table_backend.get_resource()
+    current_price_table = dynamodb.Table(CURRENT_PRICE_TABLE)
+    for (product_id, combined, inputs), _, error in dynamo_batch.update_items(current_price_table, writes):
+        if table_backend.is_conditional_check_failed(error):
+            summary['Unchanged'] += 1
+            continue
+        item_cache.cache.invalidate(CURRENT_PRICE_TABLE, {'ProductID': product_id})
+        if error:
+            log.error("Failed to write aggregated CurrentPrice", ProductID=product_id, Error=error)
+            summary['Failed'].append(product_id)
+            continue
+        log.debug("Wrote aggregated CurrentPrice", ProductID=product_id, CurrentPrice=combined,
+                  Signals=signals.get(product_id))
+        price_history.record(product_id, combined, 'aggregated', **inputs)
+        summary['Written'] += 1
+
+    telemetry.count('AggregatedWrites', summary['Written'])
+    telemetry.count('AggregatedUnchanged', summary['Unchanged'])
+    return summary
+
+@telemetry.instrument
+def lambda_handler(event, context):
+    # Collect the products whose signals changed in the window
+    state = event.get('state') or {}
+    product_ids = set(state.get('Products', []))
+    records = event.get('Records', [])
+    for record in records:
+        # A REMOVE is usually a signal expiring: combine what is left
+        product_ids.add(record['dynamodb']['Keys']['ProductID']['S'])
+    telemetry.count('SignalRecords', len(records))
+
+    # Carry the products over until the window closes; without a tumbling
+    # window every invocation is a window of its own
+    if 'window' in event and not event.get('isFinalInvokeForWindow'):
+        return {'state': {'Products': sorted(product_ids)}, 'batchItemFailures': []}
+
+    summary = aggregate(sorted(product_ids))
+    log.info("Aggregated price signals", Window=event.get('window'), **summary)
+    if summary['Failed']:
+        # Fail the invocation so the stream retries the window
+        raise RuntimeError(f"Failed to write CurrentPrice for {len(summary['Failed'])} products")
+    return {'state': {}, 'batchItemFailures': [], 'statusCode': 200, 'body': price.dumps(summary)}
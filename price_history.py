@@ -0,0 +1,357 @@
+import os
+import time
+import fcntl
+import threading
+import numpy as np
+import pricing_engine
+import telemetry
+from price import Price
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Append-only history of every price the handlers compute. Entries are
+# buffered during an invocation and appended in one batch when it ends.
+#
+# The store is a directory of fixed-capacity segment files. A segment holds
+# one array per column, preceded by a header with the row count and the
+# min/max timestamp and product code of its rows, so range queries skip
+# segments without touching their columns. Segments are memory-mapped;
+# rows are only ever appended, and the row count is written last.
+
+PRICE_HISTORY_ENABLED = os.environ.get('PRICE_HISTORY_ENABLED', 'true').lower() == 'true'
+
+def store_directory(environ, enabled=True):
+    # Directory of the store. In Lambda, /tmp lives and dies with the
+    # container, so PRICE_HISTORY_DIR must name durable shared storage (an
+    # EFS mount); elsewhere it defaults to a local directory.
+    directory = environ.get('PRICE_HISTORY_DIR')
+    if not enabled or 'AWS_LAMBDA_FUNCTION_NAME' not in environ:
+        return directory or '/tmp/price_history'
+    if not directory or os.path.commonpath(['/tmp', os.path.abspath(directory)]) == '/tmp':
+        raise RuntimeError(
+            "PRICE_HISTORY_DIR must name durable storage such as an EFS mount in Lambda, not "
+            f"{directory or 'the default /tmp/price_history'}; set PRICE_HISTORY_ENABLED=false to run without price history"
+        )
+    return directory
+
+PRICE_HISTORY_DIR = store_directory(os.environ, PRICE_HISTORY_ENABLED)
+
+# Rows per segment file
+SEGMENT_CAPACITY = int(os.environ.get('PRICE_HISTORY_SEGMENT_CAPACITY', '65536'))
+
+# Signals that produce prices, and the aggregator's combined price; codes
+# are positions, so new sources go at the end
+SOURCES = ('demand_and_supply', 'competitor', 'customer', 'seasonal_sales', 'aggregated')
+SOURCE_CODES = {source: code for code, source in enumerate(SOURCES)}
+
+# Columns of a segment. Pricing inputs that do not apply to an entry are
+# NaN, or NO_LOYALTY for loyalty_level.
+COLUMNS = (
+    ('timestamp', np.int64),
+    ('product', np.uint32),
+    ('price_cents', np.int64),
+    ('source', np.uint8),
+    ('base_price', np.float64),
+    ('demand', np.float64),
+    ('stock', np.float64),
+    ('competitor_price', np.float64),
+    ('loyalty_level', np.int8),
+    ('discount', np.float64)
+)
+INPUT_COLUMNS = ('base_price', 'demand', 'stock', 'competitor_price', 'discount')
+
+SEGMENT_MAGIC = b'PRICEHS1'
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('count', '<i8'),
+    ('capacity', '<i8'),
+    ('min_timestamp', '<i8'),
+    ('max_timestamp', '<i8'),
+    ('min_product', '<u4'),
+    ('max_product', '<u4'),
+    ('sorted', 'u1')
+])
+HEADER_SIZE = 64
+
+def _column_offsets(capacity):
+    offsets = {}
+    position = HEADER_SIZE
+    for name, dtype in COLUMNS:
+        offsets[name] = position
+        size = np.dtype(dtype).itemsize * capacity
+        position += (size + 7) // 8 * 8
+    return offsets, position
+
+class Segment:
+    # One memory-mapped segment file
+    def __init__(self, path, writable=False):
+        self.path = path
+        mode = 'r+' if writable else 'r'
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode=mode, shape=(1,))
+        if self.header['magic'][0] != SEGMENT_MAGIC:
+            raise ValueError(f"Not a price history segment: {path}")
+        capacity = int(self.header['capacity'][0])
+        offsets, _ = _column_offsets(capacity)
+        self.columns = {
+            name: np.memmap(path, dtype=dtype, mode=mode, offset=offsets[name], shape=(capacity,))
+            for name, dtype in COLUMNS
+        }
+
+    @classmethod
+    def create(cls, path, capacity):
+        _, size = _column_offsets(capacity)
+        with open(path, 'wb') as segment_file:
+            segment_file.truncate(size)
+        header = np.memmap(path, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        header[0] = (SEGMENT_MAGIC, 0, capacity, np.iinfo(np.int64).max, np.iinfo(np.int64).min,
+                     np.iinfo(np.uint32).max, 0, 1)
+        header.flush()
+        return cls(path, writable=True)
+
+    @property
+    def count(self):
+        return int(self.header['count'][0])
+
+    @property
+    def capacity(self):
+        return int(self.header['capacity'][0])
+
+    def overlaps(self, start, end, product):
+        # Decide from the header alone whether the segment can hold matching rows
+        header = self.header[0]
+        if not header['count']:
+            return False
+        if start is not None and header['max_timestamp'] < start:
+            return False
+        if end is not None and header['min_timestamp'] > end:
+            return False
+        if product is not None and not header['min_product'] <= product <= header['max_product']:
+            return False
+        return True
+
+    def append(self, rows):
+        # Write the rows after the last one, then publish them by updating the header
+        count = self.count
+        size = len(rows['timestamp'])
+        for name, _ in COLUMNS:
+            self.columns[name][count:count + size] = rows[name]
+            self.columns[name].flush()
+
+        header = self.header
+        timestamps = rows['timestamp']
+        header['sorted'][0] = header['sorted'][0] and timestamps[0] >= header['max_timestamp'][0]
+        header['min_timestamp'][0] = min(header['min_timestamp'][0], timestamps[0])
+        header['max_timestamp'][0] = max(header['max_timestamp'][0], timestamps[-1])
+        header['min_product'][0] = min(header['min_product'][0], rows['product'].min())
+        header['max_product'][0] = max(header['max_product'][0], rows['product'].max())
+        header['count'][0] = count + size
+        header.flush()
+
+    def select(self, start, end, product):
+        # Column views of the matching rows
+        count = self.count
+        timestamps = self.columns['timestamp'][:count]
+        low, high = 0, count
+        if self.header['sorted'][0]:
+            if start is not None:
+                low = int(np.searchsorted(timestamps, start, side='left'))
+            if end is not None:
+                high = int(np.searchsorted(timestamps, end, side='right'))
+            mask = None
+        else:
+            mask = np.ones(count, dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps <= end
+
+        columns = {name: column[low:high] for name, column in self.columns.items()}
+        if product is not None:
+            product_mask = columns['product'] == product
+            mask = product_mask if mask is None else mask[low:high] & product_mask
+        elif mask is not None:
+            mask = mask[low:high]
+        if mask is not None:
+            columns = {name: column[mask] for name, column in columns.items()}
+        return columns
+
+class PriceHistoryStore:
+    def __init__(self, directory, segment_capacity=SEGMENT_CAPACITY):
+        self.directory = directory
+        self.segment_capacity = segment_capacity
+        self.products = []
+        self.product_codes = {}
+        self.segments = {}
+        self._products_offset = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._products_path = os.path.join(directory, 'products.txt')
+        self._lock_path = os.path.join(directory, '.lock')
+        self._load_products()
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f'segment-{number:06d}.col')
+
+    def _segment_numbers(self):
+        return sorted(
+            int(name[8:14]) for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.col')
+        )
+
+    def _segment(self, number, writable=False):
+        # Segments are mapped once; the active one is mapped writable by appenders
+        key = (number, writable)
+        if key not in self.segments:
+            self.segments[key] = Segment(self._segment_path(number), writable)
+        return self.segments[key]
+
+    def _load_products(self):
+        # Product codes are line numbers of the append-only product dictionary
+        if not os.path.exists(self._products_path):
+            return
+        with open(self._products_path, 'rb') as products_file:
+            products_file.seek(self._products_offset)
+            data = products_file.read()
+        # Only whole lines are taken, a line being appended is read next time
+        data = data[:data.rfind(b'\n') + 1]
+        self._products_offset += len(data)
+        for product_id in data.decode().splitlines():
+            self.product_codes[product_id] = len(self.products)
+            self.products.append(product_id)
+
+    def _product_codes(self, product_ids):
+        # Codes for product_ids, registering unknown products; call with the file lock held
+        self._load_products()
+        new = [product_id for product_id in dict.fromkeys(product_ids) if product_id not in self.product_codes]
+        if new:
+            with open(self._products_path, 'a') as products_file:
+                products_file.write(''.join(f'{product_id}\n' for product_id in new))
+            self._load_products()
+        return np.fromiter((self.product_codes[product_id] for product_id in product_ids),
+                           dtype=np.uint32, count=len(product_ids))
+
+    def append(self, entries):
+        # Append a batch of entries (see record()) as one write per segment touched
+        if not entries:
+            return
+        entries = sorted(entries, key=lambda entry: entry[0])
+        with self.lock, open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                rows = {
+                    'timestamp': np.fromiter((entry[0] for entry in entries), dtype=np.int64, count=len(entries)),
+                    'product': self._product_codes([entry[1] for entry in entries]),
+                    'price_cents': np.fromiter((entry[2] for entry in entries), dtype=np.int64, count=len(entries)),
+                    'source': np.fromiter((entry[3] for entry in entries), dtype=np.uint8, count=len(entries)),
+                    'loyalty_level': np.fromiter((entry[4] for entry in entries), dtype=np.int8, count=len(entries))
+                }
+                inputs = np.array([entry[5] for entry in entries], dtype=np.float64).reshape(len(entries), -1)
+                for position, name in enumerate(INPUT_COLUMNS):
+                    rows[name] = inputs[:, position]
+
+                numbers = self._segment_numbers()
+                number = numbers[-1] if numbers else 0
+                written = 0
+                while written < len(entries):
+                    if not os.path.exists(self._segment_path(number)):
+                        self.segments[(number, True)] = Segment.create(self._segment_path(number), self.segment_capacity)
+                    segment = self._segment(number, writable=True)
+                    room = segment.capacity - segment.count
+                    if room <= 0:
+                        number += 1
+                        continue
+                    size = min(room, len(entries) - written)
+                    segment.append({name: column[written:written + size] for name, column in rows.items()})
+                    written += size
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def scan_columns(self, start=None, end=None, product_id=None):
+        # Yield the matching rows of each segment as a dict of column arrays.
+        # start and end are epoch milliseconds, both inclusive.
+        product = None
+        if product_id is not None:
+            self._load_products()
+            product = self.product_codes.get(product_id)
+            if product is None:
+                return
+        for number in self._segment_numbers():
+            segment = self._segment(number)
+            if segment.overlaps(start, end, product):
+                columns = segment.select(start, end, product)
+                if len(columns['timestamp']):
+                    yield columns
+
+    def query(self, product_id=None, start=None, end=None):
+        # Entries matching the product and time range, ordered by timestamp
+        entries = []
+        self._load_products()
+        for columns in self.scan_columns(start, end, product_id):
+            loyalty_levels = columns['loyalty_level'].tolist()
+            inputs = {name: columns[name].tolist() for name in INPUT_COLUMNS}
+            for row, (timestamp, product, cents, source) in enumerate(zip(
+                    columns['timestamp'].tolist(), columns['product'].tolist(),
+                    columns['price_cents'].tolist(), columns['source'].tolist())):
+                entry_inputs = {name: values[row] for name, values in inputs.items() if values[row] == values[row]}
+                if loyalty_levels[row] != pricing_engine.NO_LOYALTY:
+                    entry_inputs['loyalty_level'] = pricing_engine.LOYALTY_LEVELS[loyalty_levels[row]]
+                entries.append({
+                    'ProductID': self.products[product],
+                    'Timestamp': timestamp,
+                    'Price': Price(cents),
+                    'Source': SOURCES[source],
+                    'Inputs': entry_inputs
+                })
+        entries.sort(key=lambda entry: entry['Timestamp'])
+        return entries
+
+# Entries recorded during the current invocation
+_buffer = []
+_buffer_lock = threading.Lock()
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = PriceHistoryStore(PRICE_HISTORY_DIR)
+    return _store
+
+def _input(value):
+    return float('nan') if value is None else float(value)
+
+def record(product_id, new_price, source, base_price=None, demand=None, stock=None,
+           competitor_price=None, loyalty_level=None, discount=None, timestamp=None):
+    # Buffer one price change; it is written when the invocation ends
+    if not PRICE_HISTORY_ENABLED:
+        return
+    entry = (
+        int(time.time() * 1000) if timestamp is None else timestamp,
+        product_id,
+        new_price.cents,
+        SOURCE_CODES[source],
+        pricing_engine.NO_LOYALTY if loyalty_level is None else pricing_engine.LOYALTY_CODES.get(
+            loyalty_level, pricing_engine.LOYALTY_CODES[pricing_engine.DEFAULT_LOYALTY_LEVEL]),
+        tuple(_input(value) for value in (base_price, demand, stock, competitor_price, discount))
+    )
+    with _buffer_lock:
+        _buffer.append(entry)
+
+def flush():
+    # Append every buffered entry to the store in one batch
+    global _buffer
+    with _buffer_lock:
+        entries, _buffer = _buffer, []
+    if entries:
+        with telemetry.timer('PriceHistoryFlushLatency'):
+            get_store().append(entries)
+        telemetry.count('PriceHistoryEntries', len(entries))
+
+def query(product_id=None, start=None, end=None):
+    return get_store().query(product_id, start, end)
+
+def changes_since(seconds):
+    # Every entry of the last `seconds` seconds
+    return query(start=int((time.time() - seconds) * 1000))
+
+telemetry.on_invocation(lambda invocation: None, lambda invocation, state: flush())
@@ -0,0 +1,129 @@
+import os
+import json
+import base64
+import time
+import item_cache
+import price
+import pricing_engine
+import rate_limiter
+import table_backend
+import telemetry
+
+# Read path behind API Gateway: quotes a customer's personalized prices for
+# a cart in one call. CurrentPrice, Products and Customer are read with one
+# batched, concurrent BatchGetItem (hot products and prices come from the
+# warm item cache). Each quote is what customer.py charges when the
+# selection is made: the customer's loyalty coefficient applied to the
+# product's BasePrice (pricing_engine.customer_prices), priced in one batch.
+# The product's CurrentPrice is returned alongside it.
+#
+#   POST {"CustomerID": "C1", "ProductIDs": ["P1", "P2"]}
+#   GET  ?CustomerID=C1&ProductIDs=P1,P2
+
+# Largest cart accepted in one request
+MAX_QUOTE_ITEMS = int(os.environ.get('MAX_QUOTE_ITEMS', '100'))
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+def parse_request(event):
+    # Return (customer_id, product_ids) from an API Gateway proxy event or a direct invocation
+    if event.get('body'):
+        body = event['body']
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        request = json.loads(body)
+    elif event.get('queryStringParameters'):
+        request = dict(event['queryStringParameters'])
+    else:
+        request = event
+
+    product_ids = request.get('ProductIDs') or []
+    if isinstance(product_ids, str):
+        product_ids = product_ids.split(',')
+    # Deduplicate product IDs while keeping their original order
+    product_ids = list(dict.fromkeys(str(product_id).strip() for product_id in product_ids if str(product_id).strip()))
+    return request.get('CustomerID'), product_ids
+
+def quote(customer_id, product_ids):
+    # Returns (status, body)
+    items, unprocessed = item_cache.batch_get_items(table_backend.get_resource(), {
+        'CurrentPrice': [{'ProductID': product_id} for product_id in product_ids],
+        'Products': [{'ProductID': product_id} for product_id in product_ids],
+        'Customer': [{'CustomerID': customer_id}]
+    })
+    if unprocessed:
+        log.warning("Unprocessed keys after retries", UnprocessedKeys=unprocessed)
+        return 503, {'message': 'Prices are temporarily unavailable, retry the request'}
+
+    if not items['Customer']:
+        return 404, {'message': f"Customer not found: {customer_id}"}
+    loyalty_level = items['Customer'][0].get('LoyaltyLevel')
+
+    current_prices = {item['ProductID']: item['CurrentPrice'] for item in items['CurrentPrice'] if 'CurrentPrice' in item}
+    base_prices = {item['ProductID']: item['BasePrice'] for item in items['Products'] if 'BasePrice' in item}
+
+    found = []
+    not_found = []
+    for product_id in product_ids:
+        if product_id in base_prices:
+            found.append(product_id)
+        else:
+            not_found.append(product_id)
+
+    quoted_prices = pricing_engine.customer_prices(
+        [base_prices[product_id] for product_id in found], [loyalty_level] * len(found)
+    )
+
+    quotes = [
+        {
+            'ProductID': product_id,
+            'BasePrice': price.Price.parse(base_prices[product_id]),
+            'CurrentPrice': price.Price.parse(current_prices[product_id]) if product_id in current_prices else None,
+            'Price': quoted_price
+        }
+        for product_id, quoted_price in zip(found, quoted_prices)
+    ]
+    return 200, {
+        'CustomerID': customer_id,
+        'LoyaltyLevel': loyalty_level,
+        'Quotes': quotes,
+        'NotFound': not_found,
+        'Total': sum(quote['Price'] for quote in quotes)
+    }
+
+@telemetry.instrument
+def lambda_handler(event, context):
+    start = time.perf_counter()
+    try:
+        customer_id, product_ids = parse_request(event)
+        if not customer_id or not product_ids:
+            status, body = 400, {'message': 'CustomerID and ProductIDs are required'}
+        elif len(product_ids) > MAX_QUOTE_ITEMS:
+            status, body = 400, {'message': f"At most {MAX_QUOTE_ITEMS} ProductIDs can be quoted at once"}
+        else:
+            status, body = quote(customer_id, product_ids)
+    except ValueError as e:
+        status, body = 400, {'message': f"Invalid request: {e}"}
+    except Exception as e:
+        if rate_limiter.is_throttle(e):
+            # Still throttled after the retries: ask the caller to retry rather than failing
+            log.warning("Throttled quoting prices", Error=e)
+            status, body = 503, {'message': 'Prices are temporarily unavailable, retry the request'}
+        else:
+            log.exception("Error quoting prices", Error=e)
+            status, body = 500, {'message': f"Internal server error: {e}"}
+
+    # Report the latency of every request, as a metric and to the caller
+    latency_ms = (time.perf_counter() - start) * 1000
+    telemetry.observe('QuoteLatency', latency_ms)
+    telemetry.count('QuotedItems', len(body.get('Quotes', [])))
+    log.debug("Quoted prices", Status=status, LatencyMs=latency_ms, Items=len(body.get('Quotes', [])))
+    headers = {'Content-Type': 'application/json', 'Server-Timing': f'quote;dur={latency_ms:.1f}'}
+    if status == 503:
+        headers['Retry-After'] = '1'
+    return {
+        'statusCode': status,
+        'headers': headers,
+        'body': price.dumps(body)
+    }
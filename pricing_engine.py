@@ -0,0 +1,153 @@
+import numpy as np
+from decimal import Decimal
+from price import Price
+
+# Demand/supply rule: price = base * (1 + DEMAND_COEFFICIENT * demand / stock)
+DEMAND_COEFFICIENT = Decimal('0.05')
+
+# Loyalty rule: price = base * (1 + coefficient of the customer's level)
+LOYALTY_COEFFICIENTS = {
+    'Bronze': Decimal('0.02'),
+    'Silver': Decimal('0.05'),
+    'Gold': Decimal('0.10'),
+    'Platinum': Decimal('0.15')
+}
+DEFAULT_LOYALTY_LEVEL = 'Bronze'
+
+# Competitor rule: price = competitor price + one of these offsets
+COMPETITOR_OFFSETS = (-1, 1)
+
+# Loyalty levels as small integer codes, so a batch can index a coefficient array
+LOYALTY_LEVELS = tuple(LOYALTY_COEFFICIENTS)
+LOYALTY_CODES = {level: code for code, level in enumerate(LOYALTY_LEVELS)}
+NO_LOYALTY = -1
+_LOYALTY_FACTORS = np.array([1 + float(LOYALTY_COEFFICIENTS[level]) for level in LOYALTY_LEVELS])
+
+def loyalty_codes(levels):
+    # Encode loyalty level names; unknown levels price as Bronze and None applies no loyalty rule
+    default = LOYALTY_CODES[DEFAULT_LOYALTY_LEVEL]
+    return np.fromiter(
+        (NO_LOYALTY if level is None else LOYALTY_CODES.get(level, default) for level in levels),
+        dtype=np.int8
+    )
+
+def _as_array(values, size=None):
+    if values is None:
+        return None
+    array = np.asarray(values, dtype=np.float64)
+    if array.ndim == 0 and size is not None:
+        array = np.full(size, float(array))
+    return array
+
+# Prices that land this close to a half cent are re-evaluated with Decimal,
+# so ties round exactly as the per-item Decimal rules do
+_TIE_TOLERANCE = 1e-6
+CENT = Decimal('0.01')
+
+def _decimal(value):
+    return Decimal(repr(float(value)))
+
+def _exact_price(base_price, demand, stock, loyalty_level, competitor_price, competitor_offset, discount):
+    # Decimal evaluation of one element, using the same rules as price_batch
+    if competitor_price is not None and not np.isnan(competitor_price):
+        price = _decimal(competitor_price) + (_decimal(competitor_offset) if competitor_offset is not None else 0)
+    else:
+        price = _decimal(base_price)
+    if demand is not None and not np.isnan(demand):
+        price *= Decimal(1) + DEMAND_COEFFICIENT * (_decimal(demand) / _decimal(stock))
+    if loyalty_level is not None and loyalty_level != NO_LOYALTY:
+        price *= Decimal('1.0') + LOYALTY_COEFFICIENTS[LOYALTY_LEVELS[loyalty_level]]
+    if discount is not None and not np.isnan(discount):
+        price *= 1 - _decimal(discount)
+    return price.quantize(CENT)
+
+def price_batch(base_price=None, demand=None, stock=None, loyalty_level=None,
+                competitor_price=None, competitor_offset=None, discount=None):
+    # Evaluate every pricing rule over whole arrays at once.
+    #
+    # The price starts from competitor_price + competitor_offset where a
+    # competitor price is given (not NaN) and from base_price otherwise, and
+    # is then scaled by the demand/supply, loyalty and discount factors of
+    # whichever inputs are given. A NaN demand, a NO_LOYALTY code or a NaN
+    # discount leaves that rule out for the element. Scalars are broadcast.
+    # loyalty_level takes codes from loyalty_codes().
+    #
+    # Returns a float64 array of prices rounded half-even to the cent, with
+    # NaN where the price is undefined, e.g. for a stock of zero.
+    if base_price is None and competitor_price is None:
+        raise ValueError("price_batch needs base_price or competitor_price")
+    size = max(np.size(values) for values in
+               (base_price, demand, stock, loyalty_level, competitor_price, competitor_offset, discount)
+               if values is not None)
+
+    base_price = _as_array(base_price, size)
+    demand = _as_array(demand, size)
+    stock = _as_array(stock, size)
+    competitor_price = _as_array(competitor_price, size)
+    competitor_offset = _as_array(competitor_offset, size)
+    discount = _as_array(discount, size)
+    if loyalty_level is not None:
+        loyalty_level = np.asarray(loyalty_level, dtype=np.int8)
+        if loyalty_level.ndim == 0:
+            loyalty_level = np.full(size, loyalty_level, dtype=np.int8)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if competitor_price is None:
+            price = base_price.copy()
+        else:
+            price = competitor_price + (competitor_offset if competitor_offset is not None else 0.0)
+            if base_price is not None:
+                price = np.where(np.isnan(competitor_price), base_price, price)
+
+        if demand is not None:
+            factor = 1.0 + float(DEMAND_COEFFICIENT) * (demand / stock)
+            price *= np.where(np.isnan(demand), 1.0, factor)
+
+        if loyalty_level is not None:
+            price *= np.where(loyalty_level == NO_LOYALTY, 1.0, _LOYALTY_FACTORS[loyalty_level])
+
+        if discount is not None:
+            price *= 1.0 - np.nan_to_num(discount)
+
+    price[~np.isfinite(price)] = np.nan
+
+    # Settle near-ties exactly before rounding the whole array
+    cents = price * 100
+    near_ties = np.flatnonzero(np.abs(cents - np.floor(cents) - 0.5) < _TIE_TOLERANCE)
+    inputs = (base_price, demand, stock, loyalty_level, competitor_price, competitor_offset, discount)
+    for i in near_ties.tolist():
+        price[i] = float(_exact_price(*(None if values is None else values[i] for values in inputs)))
+
+    return np.round(price, 2)
+
+def to_decimal(price):
+    # Convert one price from a price_batch result to a Decimal with two places
+    return Decimal(int(round(price * 100))).scaleb(-2)
+
+def to_decimals(prices):
+    return [None if np.isnan(price) else to_decimal(price) for price in prices.tolist()]
+
+def to_prices(prices):
+    # Convert a price_batch result to integer-cent Prices, None where the price is undefined
+    undefined = np.isnan(prices)
+    cents = np.rint(np.where(undefined, 0.0, prices) * 100).astype(np.int64)
+    return [None if missing else Price(value) for value, missing in zip(cents.tolist(), undefined.tolist())]
+
+def customer_prices(base_prices, loyalty_levels):
+    # What each customer pays: the loyalty rule applied to the product's
+    # BasePrice, never to its CurrentPrice. A customer without a level pays
+    # as Bronze. Returns integer-cent Prices, as to_prices does.
+    if not base_prices:
+        return []
+    return to_prices(price_batch(
+        base_price=base_prices,
+        loyalty_level=loyalty_codes(level or DEFAULT_LOYALTY_LEVEL for level in loyalty_levels)
+    ))
+
+def price_one(**inputs):
+    # Price a single item with the same rules as price_batch; returns a Decimal or None
+    price = price_batch(**{
+        name: loyalty_codes([value]) if name == 'loyalty_level' else [value]
+        for name, value in inputs.items()
+    })[0]
+    return None if np.isnan(price) else to_decimal(price)
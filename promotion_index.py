@@ -0,0 +1,191 @@
+import os
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Date format of StartDate and EndDate in the EventsPromotions table
+DATE_FORMAT = '%d-%m-%Y'
+
+# Rebuild the cached index once it is older than this many seconds, even
+# if no change to the table has been reported
+PROMOTION_INDEX_TTL_SECONDS = float(os.environ.get('PROMOTION_INDEX_TTL_SECONDS', '3600'))
+
+# A change to EventsPromotions reaches one container through the stream, and
+# that container bumps the IndexVersion of a marker item in the table. Every
+# container compares its index with the marker with one consistent GetItem
+# at most this often, so the others see the change within seconds instead
+# of at the TTL.
+PROMOTION_INDEX_CHECK_SECONDS = float(os.environ.get('PROMOTION_INDEX_CHECK_SECONDS', '10'))
+
+# EventID of the marker item; it is no promotion
+VERSION_EVENT_ID = '#PromotionIndexVersion'
+
+# Index cached across warm invocations
+_index = None
+
+def parse_date(value):
+    return datetime.strptime(value, DATE_FORMAT).toordinal()
+
+class _Node:
+    # Node of a centered interval tree. Intervals containing center are kept
+    # here, sorted by start and by end; the others go to the left or right child.
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, intervals):
+        endpoints = sorted(endpoint for start, end, _ in intervals for endpoint in (start, end))
+        self.center = endpoints[len(endpoints) // 2]
+        here = [interval for interval in intervals if interval[0] <= self.center <= interval[1]]
+        left = [interval for interval in intervals if interval[1] < self.center]
+        right = [interval for interval in intervals if interval[0] > self.center]
+        self.by_start = sorted(here, key=lambda interval: interval[0])
+        self.by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        self.left = _Node(left) if left else None
+        self.right = _Node(right) if right else None
+
+class PromotionIndex:
+    # Interval tree over the promotions' [StartDate, EndDate] ranges. A date
+    # lookup costs O(log n + k) for k matching promotions.
+    def __init__(self, events, version=0):
+        self.events = list(events)
+        self.version = version
+        self.invalid = []
+        intervals = []
+        for position, event in enumerate(self.events):
+            try:
+                intervals.append((parse_date(event['StartDate']), parse_date(event['EndDate']), position))
+            except (KeyError, ValueError) as e:
+                self.invalid.append(event)
+                log.warning("Skipping promotion with invalid dates", EventID=event.get('EventID'), Error=e)
+        self.root = _Node(intervals) if intervals else None
+        self.built_at = self.checked_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.events)
+
+    def active_on(self, date):
+        # Return every promotion active on date (a datetime or date), ordered by StartDate
+        point = date.toordinal()
+        matches = []
+        node = self.root
+        while node is not None:
+            if point < node.center:
+                for start, end, position in node.by_start:
+                    if start > point:
+                        break
+                    matches.append((start, position))
+                node = node.left
+            elif point > node.center:
+                for start, end, position in node.by_end:
+                    if end < point:
+                        break
+                    matches.append((start, position))
+                node = node.right
+            else:
+                matches.extend((start, position) for start, end, position in node.by_start)
+                break
+        return [self.events[position] for _, position in sorted(matches)]
+
+    def is_stale(self):
+        return time.monotonic() - self.built_at > PROMOTION_INDEX_TTL_SECONDS
+
+    def needs_check(self):
+        return time.monotonic() - self.checked_at > PROMOTION_INDEX_CHECK_SECONDS
+
+def _precedence(event):
+    try:
+        discount_rate = Decimal(str(event['DiscountRate']))
+    except (KeyError, InvalidOperation):
+        discount_rate = Decimal('-Infinity')
+    return discount_rate, parse_date(event['StartDate']), str(event.get('EventID', ''))
+
+def resolve_overlaps(events):
+    # Give every product the discount of one promotion only, when several
+    # active ones list it: the highest DiscountRate wins, then the latest
+    # StartDate, then the highest EventID. Returns the promotions that win
+    # products, in the order given, each with its AffectedProducts cut down
+    # to the products it won.
+    winners = {}
+    for position, event in enumerate(events):
+        for product_id in event['AffectedProducts'].split(','):
+            product_id = product_id.strip()
+            if not product_id:
+                continue
+            current = winners.get(product_id)
+            if current is None or _precedence(event) > _precedence(events[current]):
+                winners[product_id] = position
+
+    won = {}
+    for product_id, position in winners.items():
+        won.setdefault(position, []).append(product_id)
+    return [dict(event, AffectedProducts=','.join(won[position]))
+            for position, event in enumerate(events) if position in won]
+
+def _scan_all(table):
+    kwargs = {}
+    items = []
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response['Items'])
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return items
+        kwargs['ExclusiveStartKey'] = last_key
+
+def read_version(table):
+    # The IndexVersion of the marker item, 0 before the first change
+    item = table.get_item(Key={'EventID': VERSION_EVENT_ID}, ConsistentRead=True).get('Item')
+    return (item or {}).get('IndexVersion', 0)
+
+def bump_version(table):
+    # Tell every container its index is outdated
+    table.update_item(
+        Key={'EventID': VERSION_EVENT_ID},
+        UpdateExpression='ADD IndexVersion :one',
+        ExpressionAttributeValues={':one': 1}
+    )
+
+def get_index(table):
+    # Return the cached promotion index, rebuilding it when missing,
+    # invalidated, stale or older than the marker's version
+    global _index
+    if _index is not None and not _index.is_stale():
+        if not _index.needs_check():
+            return _index
+        version = read_version(table)
+        if version == _index.version:
+            _index.checked_at = time.monotonic()
+            return _index
+    else:
+        version = read_version(table)
+
+    # The version is read before the scan, so a change made during the scan
+    # bumps it past this index's and the next check rebuilds again
+    events = [item for item in _scan_all(table) if item.get('EventID') != VERSION_EVENT_ID]
+    _index = PromotionIndex(events, version)
+    log.info("Built promotion index", Table=table.name, Events=len(_index), Version=version)
+    return _index
+
+def invalidate():
+    # Drop the cached index so the next lookup rebuilds it
+    global _index
+    _index = None
+
+def is_change_event(event, table_name='EventsPromotions'):
+    # True for a DynamoDB stream batch from the promotions table
+    records = event.get('Records') or []
+    return any(
+        record.get('eventSource') == 'aws:dynamodb' and f':table/{table_name}/' in record.get('eventSourceARN', '')
+        for record in records
+    )
+
+def changes_promotions(event, table_name='EventsPromotions'):
+    # True when a change batch touches a promotion and not only the marker
+    return any(
+        ((record.get('dynamodb') or {}).get('Keys') or {}).get('EventID', {}).get('S') != VERSION_EVENT_ID
+        for record in event.get('Records') or []
+        if f':table/{table_name}/' in record.get('eventSourceARN', '')
+    )
@@ -0,0 +1,280 @@
+import os
+import time
+import random
+import threading
+import telemetry
+
+# Client-side rate limiting shared by every handler in the container. Each
+# DynamoDB table and each rate-limited AWS operation gets an adaptive token
+# bucket; every call takes tokens from it (one per item for batch calls).
+#
+# Throttling errors (ProvisionedThroughputExceeded, ThrottlingException, ...)
+# are told apart from real errors: they are retried here with jittered
+# exponential backoff, while any other error is raised at once. A bucket
+# starts unlimited; the first throttle sets its rate just below the measured
+# throughput, every further throttle shrinks it multiplicatively and every
+# success grows it additively (AIMD), so sustained load settles just under
+# the provisioned capacity. Unprocessed batch items and throttled PutEvents
+# entries count as throttles too.
+#
+# The clients of rate-limited services make a single attempt (see clients),
+# so this is the only place their calls are retried. Transient server and
+# connection errors are retried here with the same backoff, as botocore's
+# standard mode would, but they do not shrink the rate.
+
+# Turn the limiter off entirely
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+
+# Lower bound of a bucket's rate, in tokens per second
+RATE_LIMIT_MIN_RATE = float(os.environ.get('RATE_LIMIT_MIN_RATE', '1'))
+
+# Additive increase, in tokens per second gained per second at full rate,
+# and multiplicative decrease applied on a throttle
+RATE_LIMIT_INCREASE = float(os.environ.get('RATE_LIMIT_INCREASE', '10'))
+RATE_LIMIT_DECREASE = float(os.environ.get('RATE_LIMIT_DECREASE', '0.8'))
+
+# Close to the rate of the last throttle the increase slows down by this
+# factor, so the rate lingers near the capacity instead of overshooting it
+NEAR_CAPACITY = 0.95
+NEAR_CAPACITY_INCREASE = 0.2
+
+# Throttles within this many seconds of a decrease belong to the same burst
+# and do not shrink the rate again
+DECREASE_COOLDOWN_SECONDS = 1.0
+
+# Throughput is measured over windows of this length
+MEASURE_WINDOW_SECONDS = 1.0
+
+# Attempts of a throttled call, and its backoff
+RATE_LIMIT_MAX_ATTEMPTS = int(os.environ.get('RATE_LIMIT_MAX_ATTEMPTS', '6'))
+BASE_BACKOFF_SECONDS = 0.05
+MAX_BACKOFF_SECONDS = 2.0
+
+# Errors and HTTP statuses worth retrying that are not throttles
+TRANSIENT_CODES = {
+    'InternalServerError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'RequestTimeout',
+    'RequestTimeoutException'
+}
+TRANSIENT_STATUS_CODES = {500, 502, 503, 504}
+
+THROTTLING_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'LimitExceededException'
+}
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+def error_code(error):
+    # The AWS error code of a botocore ClientError or a local backend error
+    return ((getattr(error, 'response', None) or {}).get('Error') or {}).get('Code')
+
+def is_throttle(error):
+    return error_code(error) in THROTTLING_CODES
+
+def is_transient(error):
+    if error_code(error) in TRANSIENT_CODES:
+        return True
+    status = ((getattr(error, 'response', None) or {}).get('ResponseMetadata') or {}).get('HTTPStatusCode')
+    if status in TRANSIENT_STATUS_CODES:
+        return True
+    # botocore's connection and timeout errors, matched by name so botocore is not imported here
+    return any(cls.__module__ == 'botocore.exceptions' and cls.__name__ in ('ConnectionError', 'HTTPClientError')
+               for cls in type(error).__mro__)
+
+def _partially_throttled(response):
+    # Batch responses report throttling per item instead of raising
+    if not isinstance(response, dict):
+        return False
+    if response.get('UnprocessedItems') or response.get('UnprocessedKeys'):
+        return True
+    if response.get('FailedEntryCount'):
+        return any(entry.get('ErrorCode') in THROTTLING_CODES for entry in response.get('Entries', []))
+    return False
+
+def _backoff(attempt):
+    # Full jitter, so throttled callers do not retry in lockstep
+    time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * (2 ** attempt))))
+
+class AdaptiveLimiter:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        # None until the first throttle: calls are not held back
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.window_start = self.updated
+        self.window_units = 0
+        self.measured_rate = 0.0
+        self.last_decrease = 0.0
+        self.throttled_rate = None
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.wait_seconds = 0.0
+
+    def _measure(self, now, units):
+        self.window_units += units
+        elapsed = now - self.window_start
+        if elapsed >= MEASURE_WINDOW_SECONDS:
+            current = self.window_units / elapsed
+            self.measured_rate = current if not self.measured_rate else 0.7 * self.measured_rate + 0.3 * current
+            self.window_start = now
+            self.window_units = 0
+
+    def _throughput(self, now):
+        # Best estimate of the current throughput, including the open window.
+        # A window younger than MEASURE_WINDOW_SECONDS is taken as a full one,
+        # so a short burst does not read as a huge rate.
+        current = self.window_units / max(now - self.window_start, MEASURE_WINDOW_SECONDS)
+        return max(current, self.measured_rate)
+
+    def acquire(self, units=1):
+        # Take units tokens, sleeping until the bucket has them. Tokens are
+        # reserved up front, so concurrent callers queue in arrival order.
+        with self.lock:
+            now = time.monotonic()
+            self._measure(now, units)
+            if self.rate is None:
+                return 0.0
+            # The bucket holds at most one second of tokens
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.wait_seconds += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self, units=1):
+        with self.lock:
+            self.successes += 1
+            if self.rate is None:
+                return
+            # Additive increase, never far above what is actually being sent
+            increase = RATE_LIMIT_INCREASE * units / self.rate
+            if self.rate >= NEAR_CAPACITY * self.throttled_rate:
+                increase *= NEAR_CAPACITY_INCREASE
+            ceiling = max(2 * self._throughput(time.monotonic()), self.rate)
+            self.rate = min(ceiling, self.rate + increase)
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.last_decrease < DECREASE_COOLDOWN_SECONDS:
+                return
+            self.last_decrease = now
+            base = self.rate if self.rate is not None else self._throughput(now)
+            self.throttled_rate = base
+            self.rate = max(RATE_LIMIT_MIN_RATE, (base or RATE_LIMIT_MIN_RATE) * RATE_LIMIT_DECREASE)
+            self.tokens = min(self.tokens, 0.0)
+            rate = self.rate
+        log.warning("Throttled, reducing the rate", Limiter=self.name, Rate=round(rate, 1))
+
+    def state(self):
+        with self.lock:
+            return {
+                'Rate': round(self.rate, 1) if self.rate is not None else None,
+                'MeasuredRate': round(self.measured_rate, 1),
+                'Successes': self.successes,
+                'Throttles': self.throttles,
+                'Retries': self.retries,
+                'WaitMs': round(self.wait_seconds * 1000, 1)
+            }
+
+# Limiters by name, shared by every handler in the container
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get(name):
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(name, AdaptiveLimiter(name))
+    return limiter
+
+def call(name, function, kwargs, units=1):
+    # Call function(**kwargs) through the limiter called name, retrying throttles
+    # and transient errors
+    if not RATE_LIMIT_ENABLED:
+        return function(**kwargs)
+
+    limiter = get(name)
+    attempt = 0
+    while True:
+        wait = limiter.acquire(units)
+        if wait:
+            telemetry.observe('RateLimiterWait', wait * 1000)
+        try:
+            response = function(**kwargs)
+        except Exception as e:
+            if is_throttle(e):
+                limiter.on_throttle()
+                telemetry.count('Throttles')
+            elif is_transient(e):
+                telemetry.count('TransientErrors')
+            else:
+                raise
+            if attempt + 1 >= RATE_LIMIT_MAX_ATTEMPTS:
+                raise
+            with limiter.lock:
+                limiter.retries += 1
+            _backoff(attempt)
+            attempt += 1
+            continue
+
+        if _partially_throttled(response):
+            limiter.on_throttle()
+            telemetry.count('Throttles')
+        else:
+            limiter.on_success(units)
+        if attempt and isinstance(response, dict):
+            # Report the retries made here where botocore reports its own
+            response.setdefault('ResponseMetadata', {})['RetryAttempts'] = attempt
+        return response
+
+def state():
+    # State of every limiter, for reporting
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.state() for limiter in limiters}
+
+class LimitedClient:
+    # Client proxy whose listed operations go through the limiter of the operation
+    def __init__(self, client, service, operations):
+        self._client = client
+        self._service = service
+        self._operations = operations
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in self._operations:
+            return attribute
+
+        def limited(**kwargs):
+            return call(f'{self._service}:{name}', attribute, kwargs, units=len(kwargs.get('Entries') or ()) or 1)
+        return limited
+
+def _start(invocation):
+    return {name: limiter_state['Throttles'] for name, limiter_state in state().items()}
+
+def _end(invocation, throttles_before):
+    # Report the limiters that were throttled during the invocation
+    throttled = {
+        name: limiter_state for name, limiter_state in state().items()
+        if limiter_state['Throttles'] > throttles_before.get(name, 0)
+    }
+    if throttled:
+        log.info("Rate limiter state", Limiters=throttled)
+
+telemetry.on_invocation(_start, _end)
@@ -0,0 +1,73 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import telemetry
+
+# Runs the per-record work of a stream batch concurrently: items with
+# different keys (ProductID, CustomerID, ...) run in parallel on a pool
+# shared by every handler in the container, while items with the same key
+# run one after another in batch order. Once an item fails, the later items
+# of its key are skipped, so a retry never applies them out of order.
+#
+# Do not call process from inside a function it runs: the nested call would
+# wait on the same pool. The function runs on pool threads, so it must get
+# its tables from dynamo_batch.worker_table rather than close over shared ones.
+
+# Upper bound on the items in flight at once
+RECORD_CONCURRENCY = int(os.environ.get('RECORD_CONCURRENCY', '32'))
+
+class SkippedRecord(Exception):
+    # An earlier item with the same key failed
+    pass
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    # The pool is created on first use and kept warm across invocations
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=RECORD_CONCURRENCY, thread_name_prefix='record')
+        return _executor
+
+def _run_key(function, items):
+    results = []
+    failed = None
+    for item in items:
+        if failed is not None:
+            results.append((item, None, SkippedRecord(f"Skipped after an earlier failure: {failed}")))
+            continue
+        try:
+            with telemetry.timer('RecordLatency'):
+                results.append((item, function(item), None))
+        except Exception as e:
+            failed = e
+            results.append((item, None, e))
+    return results
+
+def process(items, key, function):
+    # Call function(item) for every item, in batch order within each key(item).
+    # Returns a list of (item, result, error) tuples in the order of items,
+    # where exactly one of result and error is set.
+    groups = {}
+    for position, item in enumerate(items):
+        groups.setdefault(key(item), []).append((position, item))
+    if not groups:
+        return []
+
+    def run(group):
+        return zip((position for position, _ in group), _run_key(function, [item for _, item in group]))
+
+    results = [None] * len(items)
+    if len(groups) == 1:
+        outcomes = [run(group) for group in groups.values()]
+    else:
+        outcomes = get_executor().map(telemetry.propagate(run), groups.values())
+    for outcome in outcomes:
+        for position, result in outcome:
+            results[position] = result
+
+    skipped = sum(1 for _, _, error in results if isinstance(error, SkippedRecord))
+    telemetry.count('RecordsSkipped', skipped)
+    return results
@@ -0,0 +1,132 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import clients
+import price
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# How seasonal_sales_trigger hands promotions to seasonal_sales:
+#   'sync'      - RequestResponse invocations, one per shard, in parallel
+#   'async'     - Event invocations, one per shard, completion reported through
+#                 the function's Lambda destination and/or SEASONAL_CALLBACK_FUNCTION
+#   'queue'     - one SQS message per shard on SEASONAL_QUEUE_URL
+#   'inprocess' - direct calls to seasonal_sales.lambda_handler, one thread per shard
+DISPATCH_MODE = os.environ.get('SEASONAL_DISPATCH_MODE', 'sync')
+SEASONAL_FUNCTION_NAME = os.environ.get('SEASONAL_FUNCTION_NAME', 'seasonalsales')
+SEASONAL_QUEUE_URL = os.environ.get('SEASONAL_QUEUE_URL')
+SEASONAL_CALLBACK_FUNCTION = os.environ.get('SEASONAL_CALLBACK_FUNCTION')
+
+# Maximum number of AffectedProducts per shard, and shards dispatched at once
+SHARD_SIZE = int(os.environ.get('SEASONAL_SHARD_SIZE', '500'))
+MAX_PARALLEL_SHARDS = int(os.environ.get('SEASONAL_MAX_PARALLEL_SHARDS', '16'))
+
+# SQS SendMessageBatch limit
+SQS_BATCH_LIMIT = 10
+
+def shard_payloads(selected_date, active_event, shard_size=None):
+    # Split a promotion into payloads of at most shard_size AffectedProducts each
+    shard_size = shard_size or SHARD_SIZE
+    products = [product_id for product_id in active_event['AffectedProducts'].split(',') if product_id.strip()]
+    shards = [products[start:start + shard_size] for start in range(0, len(products), shard_size)] or [[]]
+    payloads = []
+    for number, shard in enumerate(shards):
+        payload = {
+            'SelectedDate': selected_date,
+            'ActiveEvent': dict(active_event, AffectedProducts=','.join(shard)),
+            'Shard': number,
+            'ShardCount': len(shards)
+        }
+        if SEASONAL_CALLBACK_FUNCTION:
+            payload['Callback'] = SEASONAL_CALLBACK_FUNCTION
+        payloads.append(payload)
+    return payloads
+
+def _parallel(function, payloads):
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_PARALLEL_SHARDS, len(payloads)))) as executor:
+        return list(executor.map(telemetry.propagate(function), payloads))
+
+def _invoke_sync(payload):
+    response = clients.client('lambda').invoke(
+        FunctionName=SEASONAL_FUNCTION_NAME,
+        InvocationType='RequestResponse',
+        Payload=price.dumps(payload)
+    )
+    return json.loads(response['Payload'].read())
+
+def _invoke_async(payload):
+    response = clients.client('lambda').invoke(
+        FunctionName=SEASONAL_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=price.dumps(payload)
+    )
+    return {'Shard': payload['Shard'], 'statusCode': response['StatusCode']}
+
+def _invoke_inprocess(payload):
+    import seasonal_sales
+    return seasonal_sales.lambda_handler(json.loads(price.dumps(payload)), None)
+
+def _enqueue(payloads):
+    if not SEASONAL_QUEUE_URL:
+        raise ValueError("SEASONAL_QUEUE_URL must be set for the queue dispatch mode")
+    results = []
+    for start in range(0, len(payloads), SQS_BATCH_LIMIT):
+        batch = payloads[start:start + SQS_BATCH_LIMIT]
+        response = clients.client('sqs').send_message_batch(
+            QueueUrl=SEASONAL_QUEUE_URL,
+            Entries=[
+                {'Id': str(payload['Shard']), 'MessageBody': price.dumps(payload)}
+                for payload in batch
+            ]
+        )
+        results.extend({'Shard': int(entry['Id']), 'MessageId': entry['MessageId']} for entry in response.get('Successful', []))
+        for entry in response.get('Failed', []):
+            log.error("Failed to enqueue shard", Shard=entry['Id'], Error=entry.get('Message'))
+            results.append({'Shard': int(entry['Id']), 'Error': entry.get('Message')})
+    return results
+
+def dispatch(selected_date, active_event, mode=None, on_complete=None):
+    # Hand a promotion to seasonal_sales in shards using the configured mode.
+    # Returns one result per shard: the seasonal_sales response for 'sync' and
+    # 'inprocess', the invocation status for 'async' and the message ID for 'queue'.
+    # on_complete(payload, response) is called per shard when the response is known here.
+    mode = mode or DISPATCH_MODE
+    payloads = shard_payloads(selected_date, active_event)
+    log.info("Dispatching promotion", EventID=active_event.get('EventID'), Shards=len(payloads), Mode=mode)
+
+    if mode == 'queue':
+        return _enqueue(payloads)
+    if mode == 'async':
+        return _parallel(_invoke_async, payloads)
+    if mode == 'sync':
+        invoke = _invoke_sync
+    elif mode == 'inprocess':
+        invoke = _invoke_inprocess
+    else:
+        raise ValueError(f"Unknown dispatch mode: {mode}")
+
+    def run(payload):
+        response = invoke(payload)
+        if on_complete:
+            on_complete(payload, response)
+        return response
+
+    return _parallel(run, payloads)
+
+def notify_completion(payload, response):
+    # Report a finished shard to the callback function named in its payload
+    callback = payload.get('Callback')
+    if not callback:
+        return
+    clients.client('lambda').invoke(
+        FunctionName=callback,
+        InvocationType='Event',
+        Payload=price.dumps({
+            'EventID': payload.get('ActiveEvent', {}).get('EventID'),
+            'Shard': payload.get('Shard'),
+            'ShardCount': payload.get('ShardCount'),
+            'Response': response
+        })
+    )
@@ -1,26 +1,33 @@
 import json
-import boto3
-import logging
-from decimal import Decimal, Context, ROUND_HALF_EVEN
+from datetime import datetime, timedelta, timezone
+import dynamo_batch
+import item_cache
+import price
+import price_aggregator
+import price_history
+import pricing_engine
+import promotion_index
+import seasonal_dispatch
+import table_backend
+import telemetry
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+def promotion_expiry(active_event):
+    # Epoch seconds at the end of the promotion's EndDate (UTC), or None
+    if not active_event.get('EndDate'):
+        return None
+    end_date = datetime.strptime(active_event['EndDate'], promotion_index.DATE_FORMAT).replace(tzinfo=timezone.utc)
+    return (end_date + timedelta(days=1)).timestamp()
 
-def lambda_handler(event, context):
-    # Extract event details from the input
-    event_details = event
+def apply_promotion(event_details):
+    # Apply the discount of event_details['ActiveEvent'] to its AffectedProducts
     selected_date = event_details['SelectedDate']
     active_event = event_details['ActiveEvent']
 
     if not active_event:
-        logger.info(f"No active event on the selected date: {selected_date}")
+        log.info("No active event on the selected date", SelectedDate=selected_date)
         return {
             'statusCode': 200,
             'body': json.dumps({
@@ -28,38 +35,76 @@ def lambda_handler(event, context):
             })
         }
 
-    affected_products = active_event['AffectedProducts'].split(',')
+    # Deduplicate product IDs while keeping their original order
+    affected_products = list(dict.fromkeys(
+        product_id.strip() for product_id in active_event['AffectedProducts'].split(',') if product_id.strip()
+    ))
     discount_rate = float(active_event['DiscountRate'])
-    logger.info(f"Processing {len(affected_products)} affected products with a discount rate of {discount_rate}.")
+    log.debug("Processing affected products", EventID=active_event.get('EventID'), Products=len(affected_products), DiscountRate=discount_rate)
 
-    dynamodb = boto3.resource('dynamodb')
-    products_table = dynamodb.Table('Products')
+    # The shared resource is created on first use, not at import
+    dynamodb = table_backend.get_resource()
     current_price_table = dynamodb.Table('CurrentPrice')
     updated_products = []
+    failed_products = []
 
-    # Define the context for Decimal to handle precision issues
-    context = Context(prec=10, rounding=ROUND_HALF_EVEN)
+    # Fetch all product details with batched reads, serving hot products from the warm cache
+    items, unprocessed = item_cache.batch_get_items(
+        dynamodb, {'Products': [{'ProductID': product_id} for product_id in affected_products]}
+    )
+    products = {item['ProductID']: item for item in items['Products']}
+    unprocessed_ids = {key['ProductID'] for key in unprocessed.get('Products', [])}
 
+    found_products = []
     for product_id in affected_products:
-        # Fetch the product details
-        response = products_table.get_item(Key={'ProductID': product_id})
-        product = response.get('Item')
+        product = products.get(product_id)
 
         if not product:
-            logger.warning(f"ProductID {product_id} not found in Products table.")
+            if product_id in unprocessed_ids:
+                log.warning("Product could not be read from Products table", ProductID=product_id)
+                failed_products.append({'ProductID': product_id, 'Reason': 'Product read was not processed'})
+            else:
+                log.warning("Product not found in Products table", ProductID=product_id)
+                failed_products.append({'ProductID': product_id, 'Reason': 'Product not found'})
             continue
 
-        base_price = context.create_decimal(product['BasePrice'])
-        new_current_price = base_price * (1 - context.create_decimal(discount_rate))
+        found_products.append((product_id, price.Price.parse(product['BasePrice'])))
+
+    # Apply the discount to every found product in one batch
+    new_current_prices = pricing_engine.to_prices(pricing_engine.price_batch(
+        base_price=[base_price for _, base_price in found_products],
+        discount=discount_rate
+    )) if found_products else []
+
+    updates = []
+    for (product_id, base_price), new_current_price in zip(found_products, new_current_prices):
+        updates.append(((product_id, base_price, new_current_price), {
+            'Key': {'ProductID': product_id},
+            'UpdateExpression': "set CurrentPrice = :c add Version :one",
+            'ExpressionAttributeValues': {':c': new_current_price.to_decimal(), ':one': 1}
+        }))
 
-        # Update the CurrentPrice table
-        current_price_table.update_item(
-            Key={'ProductID': product_id},
-            UpdateExpression="set CurrentPrice = :c",
-            ExpressionAttributeValues={':c': str(new_current_price)}
+    # Update the CurrentPrice table with concurrent writes, or hand the
+    # prices to the aggregator as a signal that lapses with the promotion
+    if price_aggregator.PRICE_AGGREGATION_ENABLED:
+        outcomes = price_aggregator.submit_signals(
+            'seasonal_sales', [(request, request[0], request[2]) for request, _ in updates],
+            expires_at=promotion_expiry(active_event)
         )
+    else:
+        outcomes = dynamo_batch.update_items(current_price_table, updates)
+
+    for (product_id, base_price, new_current_price), _, error in outcomes:
+        item_cache.cache.invalidate('CurrentPrice', {'ProductID': product_id})
+        if error:
+            log.error("Failed to update CurrentPrice", ProductID=product_id, Error=error)
+            failed_products.append({'ProductID': product_id, 'Reason': str(error)})
+            continue
 
-        logger.info(f"Updated ProductID {product_id} from BasePrice {base_price} to NewCurrentPrice {new_current_price}.")
+        if not price_aggregator.PRICE_AGGREGATION_ENABLED:
+            # The aggregator records the price it writes, not the signal
+            price_history.record(product_id, new_current_price, 'seasonal_sales',
+                                 base_price=base_price, discount=discount_rate)
 
         # Append the product update details to the list
         updated_products.append({
@@ -69,8 +114,37 @@ def lambda_handler(event, context):
             'DiscountRate': discount_rate
         })
 
-    # Return the details of updated products
+    telemetry.count('PricesUpdated', len(updated_products))
+    telemetry.count('ProductsFailed', len(failed_products))
+    log.info("Applied promotion", EventID=active_event.get('EventID'), Shard=event_details.get('Shard'),
+             Updated=len(updated_products), Failed=len(failed_products), ItemCache=item_cache.cache.stats())
+
+    # Return the details of updated products, as before; products that could
+    # not be updated are listed next to the body
     return {
         'statusCode': 200,
-        'body': json.dumps(updated_products, cls=DecimalEncoder)
+        'body': price.dumps(updated_products),
+        'FailedProducts': failed_products
     }
+
+@telemetry.instrument
+def lambda_handler(event, context):
+    # Shards queued by seasonal_dispatch arrive as SQS messages
+    records = event.get('Records') or []
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        failures = []
+        for record in records:
+            try:
+                payload = json.loads(record['body'])
+                response = apply_promotion(payload)
+                seasonal_dispatch.notify_completion(payload, response)
+            except Exception as e:
+                log.exception("Error applying promotion shard", MessageID=record['messageId'], Error=e)
+                telemetry.count('ShardFailures')
+                failures.append({'itemIdentifier': record['messageId']})
+        return {'batchItemFailures': failures}
+
+    # Otherwise the event is a single promotion payload
+    response = apply_promotion(event)
+    seasonal_dispatch.notify_completion(event, response)
+    return response
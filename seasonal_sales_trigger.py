@@ -1,77 +1,102 @@
 import json
 import random
-import boto3
-import logging
 from datetime import datetime, timedelta
-from decimal import Decimal
+import price
+import promotion_index
+import seasonal_dispatch
+import table_backend
+import telemetry
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
 
+@telemetry.instrument
 def lambda_handler(event, context):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('EventsPromotions')
-    lambda_client = boto3.client('lambda')
+    # The shared resource is created on first use, not at import
+    table = table_backend.get_resource().Table('EventsPromotions')
 
-    # Fetch all events from DynamoDB table
+    # A change to the promotions table only needs the cached indexes
+    # dropped: this container's now, the others' at their next version check.
+    # The marker's own change comes back through the stream and is ignored.
+    if promotion_index.is_change_event(event):
+        if not promotion_index.changes_promotions(event):
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': 'Promotion index version changed.'})
+            }
+        promotion_index.invalidate()
+        try:
+            promotion_index.bump_version(table)
+        except Exception as e:
+            # Report the batch so the stream delivers it again
+            log.exception("Error bumping the promotion index version", Error=e)
+            return {
+                'statusCode': 500,
+                'body': json.dumps({'error': str(e)}),
+                'batchItemFailures': [
+                    {'itemIdentifier': record['dynamodb']['SequenceNumber']}
+                    for record in event['Records'] if 'SequenceNumber' in record.get('dynamodb', {})
+                ]
+            }
+        log.info("EventsPromotions changed, promotion index invalidated")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'Promotion index invalidated.'})
+        }
+
+    # Fetch the cached promotion index, rebuilding it from DynamoDB when needed
     try:
-        response = table.scan()
-        events = response['Items']
-        logger.info(f"Fetched {len(events)} events from EventsPromotions table.")
+        index = promotion_index.get_index(table)
     except Exception as e:
-        logger.error(f"Error fetching events from DynamoDB: {str(e)}")
+        log.exception("Error fetching events from DynamoDB", Error=e)
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
         }
 
     # Randomly select a date
-    if random.random() < 0.5:
+    if random.random() < 0.5 or not index.events:
         # Generate a random date
         start_date = datetime(2023, 1, 1)
         end_date = datetime(2023, 12, 31)
         random_date = start_date + timedelta(days=random.randint(0, (end_date - start_date).days))
         selected_date = random_date.strftime('%d-%m-%Y')
-        logger.info(f"Randomly selected date: {selected_date}")
+        log.debug("Randomly selected date", SelectedDate=selected_date)
     else:
         # Select a specific date from events
-        selected_event = random.choice(events)
+        selected_event = random.choice(index.events)
         selected_date = selected_event['StartDate']
-        logger.info(f"Selected date from event: {selected_date}")
+        log.debug("Selected date from event", SelectedDate=selected_date)
 
-    # Check if any event is active on the selected date
-    active_event = None
+    # Find every event active on the selected date
     selected_date_obj = datetime.strptime(selected_date, '%d-%m-%Y')
-    for event in events:
-        start_date_obj = datetime.strptime(event['StartDate'], '%d-%m-%Y')
-        end_date_obj = datetime.strptime(event['EndDate'], '%d-%m-%Y')
-        if start_date_obj <= selected_date_obj <= end_date_obj:
-            active_event = event
-            logger.info(f"Active event found: {event['EventName']} (EventID: {event['EventID']})")
-            break
+    active_events = index.active_on(selected_date_obj)
+    log.info("Active events found", SelectedDate=selected_date,
+             EventIDs=[active_event['EventID'] for active_event in active_events])
+    telemetry.count('ActiveEvents', len(active_events))
 
     response_payload = {
         'SelectedDate': selected_date,
-        'ActiveEvent': active_event
+        'ActiveEvent': active_events[0] if active_events else None,
+        'ActiveEvents': active_events
     }
 
-    if active_event:
-        # Invoke the second Lambda function
+    if active_events:
+        response_payload['UpdatedProducts'] = []
+
+    # Where promotions overlap, each product gets the discount of one of them
+    for active_event in promotion_index.resolve_overlaps(active_events):
+        # Hand the event to the seasonal sales function, split into shards
         try:
-            response = lambda_client.invoke(
-                FunctionName='seasonalsales',
-                InvocationType='RequestResponse',
-                Payload=json.dumps(response_payload, cls=DecimalEncoder)
-            )
-            response_body = json.loads(response['Payload'].read())
-            logger.info(f"Second Lambda function response: {response_body}")
-            response_payload['UpdatedProducts'] = response_body
+            shard_results = seasonal_dispatch.dispatch(selected_date, active_event)
+            log.debug("Seasonal sales dispatch results", EventID=active_event['EventID'], Results=shard_results)
+            telemetry.count('ShardsDispatched', len(shard_results))
+            response_payload['UpdatedProducts'].extend(shard_results)
         except Exception as e:
-            logger.error(f"Error invoking second Lambda function: {str(e)}")
+            log.exception("Error dispatching to second Lambda function", EventID=active_event['EventID'], Error=e)
+            telemetry.count('DispatchErrors')
+
+    return {
+        'statusCode': 200,
+        'body': price.dumps(response_payload)
+    }
@@ -0,0 +1,437 @@
+import os
+import json
+import base64
+import sqlite3
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
+from decimal import Decimal
+from zlib import crc32
+import dynamo_expressions
+import dynamo_trace
+import rate_limiter
+import telemetry
+
+# Initialize a structured logger
+log = telemetry.get_logger(__name__)
+
+# Storage behind dynamodb.Table(): 'dynamodb' (AWS), 'memory' or 'sqlite'
+TABLE_BACKEND = os.environ.get('TABLE_BACKEND', 'dynamodb')
+
+# Database file used by the sqlite backend
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'local_tables.db')
+
+# Maximum number of items returned by one local scan page, standing in for the 1 MB limit
+SCAN_PAGE_SIZE = int(os.environ.get('LOCAL_SCAN_PAGE_SIZE', '1000'))
+
+# Primary key attributes of the tables used by the handlers
+KEY_SCHEMAS = {
+    'Products': ('ProductID',),
+    'CurrentPrice': ('ProductID',),
+    'Customer': ('CustomerID',),
+    'Competitor': ('CompetitorID', 'ProductID'),
+    'CustomerProductSelection': ('SelectionID',),
+    'PurchaseHistory': ('SelectionID',),
+    'EventsPromotions': ('EventID',),
+    'PriceSignals': ('ProductID', 'Signal'),
+    'ProcessedRecords': ('RecordID',),
+    'IdGeneratorWorkers': ('WorkerID',)
+}
+
+class BackendError(Exception):
+    # Mirrors botocore's ClientError: the error code is in response['Error']['Code']
+    def __init__(self, message):
+        super().__init__(f"An error occurred ({type(self).__name__}): {message}")
+        self.response = {'Error': {'Code': type(self).__name__, 'Message': message}}
+
+class ConditionalCheckFailedException(BackendError):
+    pass
+
+class ValidationException(BackendError):
+    pass
+
+class ResourceNotFoundException(BackendError):
+    pass
+
+def is_conditional_check_failed(error):
+    # Matched on the error code, not the class: every boto3 session has its
+    # own exception classes, so an error raised through a pool thread's
+    # resource is no instance of the shared resource's class
+    return rate_limiter.error_code(error) == 'ConditionalCheckFailedException'
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    ValidationException = ValidationException
+    ResourceNotFoundException = ResourceNotFoundException
+
+class _Client:
+    exceptions = _Exceptions
+
+class _Meta:
+    client = _Client
+
+def _normalize(value):
+    # Store values the way boto3 returns them: numbers as Decimal, floats rejected
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {key: _normalize(inner) for key, inner in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(inner) for inner in value]
+    if isinstance(value, (set, frozenset)):
+        return {_normalize(inner) for inner in value}
+    raise TypeError(f"Unsupported type {type(value).__name__} for value {value!r}")
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(inner) for key, inner in value.items()}
+    if isinstance(value, list):
+        return [_copy(inner) for inner in value]
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+class LocalTable:
+    # Table API shared by the local backends. Subclasses provide storage
+    # through _load, _store, _delete and _scan_rows; every read-check-write
+    # runs inside self.transaction() so condition expressions are atomic.
+    def __init__(self, name, key_attributes):
+        self.name = name
+        self.key_attributes = tuple(key_attributes)
+        self.lock = threading.RLock()
+
+    def transaction(self):
+        return self.lock
+
+    def _key(self, key):
+        try:
+            key_tuple = tuple(_normalize(key[attribute]) for attribute in self.key_attributes)
+        except KeyError as e:
+            raise ValidationException(f"The provided key element does not match the schema: missing {e}")
+        if len(key) != len(self.key_attributes):
+            raise ValidationException("The provided key element does not match the schema")
+        return key_tuple
+
+    def _check(self, condition, item, names, values):
+        if not condition:
+            return
+        try:
+            holds = dynamo_expressions.evaluate_condition(condition, item, names, values)
+        except dynamo_expressions.ExpressionError as e:
+            raise ValidationException(str(e))
+        if not holds:
+            raise ConditionalCheckFailedException("The conditional request failed")
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        with self.transaction():
+            item = self._load(self._key(Key))
+        if item is None:
+            return {}
+        if ProjectionExpression:
+            item = dynamo_expressions.project(ProjectionExpression, item, ExpressionAttributeNames)
+        return {'Item': _copy(item)}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        item = _normalize(Item)
+        key_tuple = self._key({attribute: item.get(attribute) for attribute in self.key_attributes})
+        values = _normalize(ExpressionAttributeValues or {})
+        with self.transaction():
+            old_item = self._load(key_tuple)
+            self._check(ConditionExpression, old_item or {}, ExpressionAttributeNames, values)
+            self._store(key_tuple, item)
+        if ReturnValues == 'ALL_OLD' and old_item is not None:
+            return {'Attributes': _copy(old_item)}
+        return {}
+
+    def update_item(self, Key, UpdateExpression=None, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        key_tuple = self._key(Key)
+        values = _normalize(ExpressionAttributeValues or {})
+        with self.transaction():
+            old_item = self._load(key_tuple)
+            current = old_item if old_item is not None else dict(zip(self.key_attributes, key_tuple))
+            self._check(ConditionExpression, old_item or {}, ExpressionAttributeNames, values)
+            try:
+                new_item, touched = dynamo_expressions.apply_update(
+                    UpdateExpression or '', current, ExpressionAttributeNames, values
+                )
+            except dynamo_expressions.ExpressionError as e:
+                raise ValidationException(str(e))
+            if any(name in self.key_attributes for name in touched):
+                raise ValidationException("Cannot update attribute that is part of the key")
+            self._store(key_tuple, new_item)
+
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': _copy(new_item)}
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {name: _copy(new_item[name]) for name in touched if name in new_item}}
+        if ReturnValues == 'ALL_OLD' and old_item is not None:
+            return {'Attributes': _copy(old_item)}
+        if ReturnValues == 'UPDATED_OLD' and old_item is not None:
+            return {'Attributes': {name: _copy(old_item[name]) for name in touched if name in old_item}}
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        key_tuple = self._key(Key)
+        values = _normalize(ExpressionAttributeValues or {})
+        with self.transaction():
+            old_item = self._load(key_tuple)
+            self._check(ConditionExpression, old_item or {}, ExpressionAttributeNames, values)
+            if old_item is not None:
+                self._delete(key_tuple)
+        if ReturnValues == 'ALL_OLD' and old_item is not None:
+            return {'Attributes': _copy(old_item)}
+        return {}
+
+    def scan(self, ProjectionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+             FilterExpression=None, Segment=0, TotalSegments=1, ExclusiveStartKey=None, Limit=None, **kwargs):
+        # Items come back in key order; Segment/TotalSegments split them by key hash
+        start = self._key(ExclusiveStartKey) if ExclusiveStartKey else None
+        page_size = min(Limit or SCAN_PAGE_SIZE, SCAN_PAGE_SIZE)
+        values = _normalize(ExpressionAttributeValues or {})
+
+        items = []
+        scanned = 0
+        last_key = None
+        with self.transaction():
+            for key_tuple, item in self._scan_rows(start):
+                if TotalSegments > 1 and crc32(repr(key_tuple).encode()) % TotalSegments != Segment:
+                    continue
+                scanned += 1
+                last_key = key_tuple
+                if not FilterExpression or dynamo_expressions.evaluate_condition(
+                        FilterExpression, item, ExpressionAttributeNames, values):
+                    if ProjectionExpression:
+                        item = dynamo_expressions.project(ProjectionExpression, item, ExpressionAttributeNames)
+                    items.append(_copy(item))
+                if scanned >= page_size:
+                    break
+            else:
+                last_key = None
+
+        response = {'Items': items, 'Count': len(items), 'ScannedCount': scanned}
+        if last_key is not None:
+            response['LastEvaluatedKey'] = dict(zip(self.key_attributes, last_key))
+        return response
+
+class MemoryTable(LocalTable):
+    def __init__(self, name, key_attributes):
+        super().__init__(name, key_attributes)
+        self.items = {}
+        # Keys in scan order, rebuilt lazily after an insert or delete
+        self.order = None
+
+    def _load(self, key_tuple):
+        return self.items.get(key_tuple)
+
+    def _store(self, key_tuple, item):
+        if key_tuple not in self.items:
+            self.order = None
+        self.items[key_tuple] = item
+
+    def _delete(self, key_tuple):
+        if self.items.pop(key_tuple, None) is not None:
+            self.order = None
+
+    def _scan_rows(self, start):
+        if self.order is None:
+            self.order = sorted((repr(key_tuple), key_tuple) for key_tuple in self.items)
+        position = 0 if start is None else bisect_right(self.order, (repr(start), start))
+        for _, key_tuple in self.order[position:]:
+            yield key_tuple, self.items[key_tuple]
+
+def _encode(value):
+    # JSON encoding that keeps DynamoDB types apart
+    if isinstance(value, Decimal):
+        return {'N': str(value)}
+    if isinstance(value, bytes):
+        return {'B': base64.b64encode(value).decode()}
+    if isinstance(value, set):
+        if all(isinstance(inner, Decimal) for inner in value):
+            return {'NS': sorted(str(inner) for inner in value)}
+        if all(isinstance(inner, bytes) for inner in value):
+            return {'BS': sorted(base64.b64encode(inner).decode() for inner in value)}
+        return {'SS': sorted(value)}
+    if isinstance(value, dict):
+        return {'M': {key: _encode(inner) for key, inner in value.items()}}
+    if isinstance(value, list):
+        return {'L': [_encode(inner) for inner in value]}
+    return value
+
+def _decode(value):
+    if isinstance(value, dict):
+        (kind, inner), = value.items()
+        if kind == 'N':
+            return Decimal(inner)
+        if kind == 'B':
+            return base64.b64decode(inner)
+        if kind == 'NS':
+            return {Decimal(element) for element in inner}
+        if kind == 'BS':
+            return {base64.b64decode(element) for element in inner}
+        if kind == 'SS':
+            return set(inner)
+        if kind == 'M':
+            return {key: _decode(element) for key, element in inner.items()}
+        return [_decode(element) for element in inner]
+    return value
+
+class SQLiteTable(LocalTable):
+    # One SQLite table per DynamoDB table, holding each item as JSON under its encoded key
+    def __init__(self, name, key_attributes, connection, connection_lock):
+        super().__init__(name, key_attributes)
+        self.connection = connection
+        self.lock = connection_lock
+        with self.lock:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{name}" (pk TEXT PRIMARY KEY, item TEXT NOT NULL)'
+            )
+
+    @contextmanager
+    def transaction(self):
+        # Hold the write lock of the database file for the whole read-check-write
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def _pk(self, key_tuple):
+        return json.dumps([_encode(value) for value in key_tuple])
+
+    def _load(self, key_tuple):
+        row = self.connection.execute(
+            f'SELECT item FROM "{self.name}" WHERE pk = ?', (self._pk(key_tuple),)
+        ).fetchone()
+        return None if row is None else {key: _decode(value) for key, value in json.loads(row[0]).items()}
+
+    def _store(self, key_tuple, item):
+        self.connection.execute(
+            f'INSERT OR REPLACE INTO "{self.name}" (pk, item) VALUES (?, ?)',
+            (self._pk(key_tuple), json.dumps({key: _encode(value) for key, value in item.items()}))
+        )
+
+    def _delete(self, key_tuple):
+        self.connection.execute(f'DELETE FROM "{self.name}" WHERE pk = ?', (self._pk(key_tuple),))
+
+    def _scan_rows(self, start):
+        query = f'SELECT pk, item FROM "{self.name}"'
+        parameters = ()
+        if start is not None:
+            query += ' WHERE pk > ?'
+            parameters = (self._pk(start),)
+        for pk, item in self.connection.execute(query + ' ORDER BY pk', parameters).fetchall():
+            key_tuple = tuple(_decode(value) for value in json.loads(pk))
+            yield key_tuple, {key: _decode(value) for key, value in json.loads(item).items()}
+
+class LocalResource:
+    # Stand-in for boto3.resource('dynamodb') backed by local tables
+    meta = _Meta
+
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def _new_table(self, name, key_attributes):
+        raise NotImplementedError
+
+    def create_table(self, name, key_attributes):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = self._new_table(name, key_attributes)
+            return self.tables[name]
+
+    def Table(self, name):
+        table = self.tables.get(name)
+        if table is not None:
+            return table
+        if name not in KEY_SCHEMAS:
+            raise ResourceNotFoundException(f"Requested resource not found: Table: {name} not found")
+        return self.create_table(name, KEY_SCHEMAS[name])
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            if len(request['Keys']) > 100:
+                raise ValidationException("Too many items requested for the BatchGetItem call")
+            table_items = responses.setdefault(table_name, [])
+            for key in request['Keys']:
+                response = table.get_item(
+                    Key=key,
+                    ProjectionExpression=request.get('ProjectionExpression'),
+                    ExpressionAttributeNames=request.get('ExpressionAttributeNames')
+                )
+                if 'Item' in response:
+                    table_items.append(response['Item'])
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise ValidationException("Too many items requested for the BatchWriteItem call")
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    table.put_item(Item=request['PutRequest']['Item'])
+                else:
+                    table.delete_item(Key=request['DeleteRequest']['Key'])
+        return {'UnprocessedItems': {}}
+
+class MemoryResource(LocalResource):
+    def _new_table(self, name, key_attributes):
+        return MemoryTable(name, key_attributes)
+
+class SQLiteResource(LocalResource):
+    def __init__(self, path):
+        super().__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection_lock = threading.RLock()
+
+    def _new_table(self, name, key_attributes):
+        return SQLiteTable(name, key_attributes, self.connection, self.connection_lock)
+
+# Local resource shared by every handler in the process
+_local_resource = None
+
+def get_resource(**kwargs):
+    # Return the DynamoDB resource selected by TABLE_BACKEND, with every table
+    # call instrumented by dynamo_trace; kwargs are passed to boto3
+    global _local_resource
+    if TABLE_BACKEND == 'dynamodb':
+        import clients
+        return dynamo_trace.instrument_resource(clients.resource('dynamodb', **kwargs))
+
+    if _local_resource is None:
+        if TABLE_BACKEND == 'memory':
+            _local_resource = MemoryResource()
+        elif TABLE_BACKEND == 'sqlite':
+            _local_resource = SQLiteResource(SQLITE_PATH)
+        else:
+            raise ValueError(f"Unknown TABLE_BACKEND: {TABLE_BACKEND}")
+        log.info("Using local table backend", Backend=TABLE_BACKEND)
+    return dynamo_trace.instrument_resource(_local_resource)
+
+def get_thread_resource():
+    # Like get_resource, for code running on pool threads: against AWS the
+    # calling thread gets a resource of its own, the local backends are
+    # shared under their locks
+    if TABLE_BACKEND == 'dynamodb':
+        import clients
+        return dynamo_trace.instrument_resource(clients.thread_resource('dynamodb'))
+    return get_resource()
+
+def reset_local_tables():
+    # Drop every table of the local backend, e.g. between benchmark runs
+    if _local_resource is not None:
+        with _local_resource.lock:
+            _local_resource.tables.clear()
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import functools
+import contextvars
+from decimal import Decimal
+from contextlib import contextmanager
+
+# Structured JSON logging and embedded-metric-format (EMF) metrics shared by
+# the handlers. Messages are constant strings with their values passed as
+# fields, so nothing is formatted unless the line is written. Debug lines
+# (full events, per-record details) are written for a sampled fraction of
+# invocations only, and metrics are aggregated in memory and written as a
+# single EMF line when the invocation ends.
+
+# Minimum level written for every invocation
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Fraction of invocations whose debug lines are written. A handler can
+# override it with LOG_SAMPLE_RATE_<MODULE>, e.g. LOG_SAMPLE_RATE_COMPETITOR.
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+# CloudWatch namespace of the metrics, and whether they are written at all
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DynamicPricing')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# EMF accepts at most 100 values per metric and 100 metrics per line
+MAX_HISTOGRAM_VALUES = 100
+MAX_METRICS_PER_LINE = 100
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return str(obj)
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line: timestamp, level, logger, message, the
+    # current request ID and the fields passed with the message
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            'timestamp': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=_json_default)
+
+_logger = logging.getLogger('telemetry')
+_logger.setLevel(LOG_LEVEL)
+_logger.propagate = False
+if not _logger.handlers:
+    _stream_handler = logging.StreamHandler(sys.stdout)
+    _stream_handler.setFormatter(JsonFormatter())
+    _logger.addHandler(_stream_handler)
+
+class Metrics:
+    # Counters and latency histograms of one invocation
+    def __init__(self, handler):
+        self.handler = handler
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, milliseconds):
+        with self.lock:
+            self.histograms.setdefault(name, []).append(milliseconds)
+
+    def flush(self, request_id=None):
+        # Write everything recorded so far as EMF lines and start over
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+        if not METRICS_ENABLED or not (counters or histograms):
+            return
+
+        metrics = [(name, 'Count', value) for name, value in counters.items()]
+        metrics += [(name, 'Milliseconds', _histogram(values)) for name, values in histograms.items()]
+        for start in range(0, len(metrics), MAX_METRICS_PER_LINE):
+            chunk = metrics[start:start + MAX_METRICS_PER_LINE]
+            line = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['Handler']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, unit, _ in chunk]
+                    }]
+                },
+                'Handler': self.handler
+            }
+            if request_id:
+                line['RequestId'] = request_id
+            line.update((name, value) for name, _, value in chunk)
+            sys.stdout.write(json.dumps(line) + '\n')
+        sys.stdout.flush()
+
+def _histogram(values):
+    # Collapse latencies into at most MAX_HISTOGRAM_VALUES distinct values,
+    # keeping as many significant digits as fit
+    for digits in (3, 2, 1):
+        buckets = {}
+        for value in values:
+            bucket = float(f'{value:.{digits}g}')
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        if len(buckets) <= MAX_HISTOGRAM_VALUES:
+            break
+    bucket_values = sorted(buckets)[:MAX_HISTOGRAM_VALUES]
+    return {'Values': bucket_values, 'Counts': [buckets[value] for value in bucket_values]}
+
+class _Invocation:
+    def __init__(self, handler, request_id, sampled):
+        self.handler = handler
+        self.request_id = request_id
+        self.sampled = sampled
+        self.metrics = Metrics(handler)
+
+# Invocation in progress; outside a handler metrics are dropped and debug
+# lines follow LOG_LEVEL only. It is held per thread and per context, so
+# handlers running concurrently in one process each see their own; pool
+# workers see the caller's through propagate().
+_idle = _Invocation(None, None, False)
+_current = contextvars.ContextVar('telemetry_invocation', default=_idle)
+
+def propagate(function):
+    # Wrap function so it runs in the caller's context (current invocation,
+    # dynamo_trace rollup, ...) on whichever thread calls it. Each call gets
+    # its own copy, so pool workers can run it concurrently.
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+def sample_rate(handler):
+    override = os.environ.get(f"LOG_SAMPLE_RATE_{handler.upper()}")
+    return float(override) if override is not None else LOG_SAMPLE_RATE
+
+class StructuredLogger:
+    # Logger whose messages are constant strings and whose values are
+    # passed as keyword fields, e.g. log.info("Updated price", ProductID=product_id)
+    def __init__(self, name):
+        self.name = name
+
+    def _emit(self, level, message, fields, exc_info=None):
+        record = _logger.makeRecord(self.name, level, '', 0, message, None, exc_info)
+        record.fields = fields
+        record.request_id = _current.get().request_id
+        _logger.handle(record)
+
+    def debug(self, message, **fields):
+        # Written when LOG_LEVEL is DEBUG or the invocation is sampled
+        if _current.get().sampled or _logger.isEnabledFor(logging.DEBUG):
+            self._emit(logging.DEBUG, message, fields)
+
+    def info(self, message, **fields):
+        if _logger.isEnabledFor(logging.INFO):
+            self._emit(logging.INFO, message, fields)
+
+    def warning(self, message, **fields):
+        if _logger.isEnabledFor(logging.WARNING):
+            self._emit(logging.WARNING, message, fields)
+
+    def error(self, message, **fields):
+        if _logger.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, message, fields)
+
+    def exception(self, message, **fields):
+        if _logger.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, message, fields, exc_info=sys.exc_info())
+
+_loggers = {}
+
+def get_logger(name):
+    if name not in _loggers:
+        _loggers[name] = StructuredLogger(name)
+    return _loggers[name]
+
+def count(name, value=1):
+    # Add value to a counter of the current invocation
+    invocation = _current.get()
+    if invocation is not _idle:
+        invocation.metrics.count(name, value)
+
+def observe(name, milliseconds):
+    # Record a latency sample of the current invocation
+    invocation = _current.get()
+    if invocation is not _idle:
+        invocation.metrics.observe(name, milliseconds)
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000)
+
+def is_sampled():
+    return _current.get().sampled
+
+# (start, end) callbacks run around every instrumented invocation: start(invocation)
+# returns a state that is passed back as end(invocation, state)
+_invocation_hooks = []
+
+def on_invocation(start, end):
+    _invocation_hooks.append((start, end))
+
+def instrument(function):
+    # Decorate a lambda_handler: decide whether the invocation is sampled,
+    # count invocations and errors, time it and flush its metrics at the end
+    handler = function.__module__
+
+    @functools.wraps(function)
+    def wrapper(event, context):
+        invocation = _Invocation(
+            handler,
+            getattr(context, 'aws_request_id', None),
+            random.random() < sample_rate(handler)
+        )
+        token = _current.set(invocation)
+        hook_states = [(end, begin(invocation)) for begin, end in _invocation_hooks]
+        start = time.perf_counter()
+        try:
+            response = function(event, context)
+            status = response.get('statusCode') if isinstance(response, dict) else None
+            if status is not None and status >= 500:
+                invocation.metrics.count('Errors')
+            return response
+        except Exception:
+            invocation.metrics.count('Errors')
+            raise
+        finally:
+            invocation.metrics.count('Invocations')
+            invocation.metrics.observe('Duration', (time.perf_counter() - start) * 1000)
+            for end, state in reversed(hook_states):
+                try:
+                    end(invocation, state)
+                except Exception as e:
+                    get_logger(__name__).exception("Invocation hook failed", Error=e)
+            invocation.metrics.flush(invocation.request_id)
+            _current.reset(token)
+
+    return wrapper
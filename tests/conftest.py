@@ -0,0 +1,26 @@
+import os
+import sys
+
+# The handlers read their settings at import: run them against the in-memory
+# table backend, without metrics, before any of them is imported
+os.environ.setdefault('TABLE_BACKEND', 'memory')
+os.environ.setdefault('METRICS_ENABLED', 'false')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-2')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import item_cache
+import table_backend
+
+@pytest.fixture
+def dynamodb():
+    # A fresh in-memory resource for each test
+    table_backend.reset_local_tables()
+    item_cache.cache.clear()
+    yield table_backend.get_resource()
+    table_backend.reset_local_tables()
+    item_cache.cache.clear()
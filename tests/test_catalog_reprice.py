@@ -0,0 +1,32 @@
+from decimal import Decimal
+import catalog_reprice
+import pricing_engine
+
+def _product(number):
+    return {'ProductID': f'P{number}', 'BasePrice': Decimal(100 + number), 'Demand': Decimal(number % 7), 'Stock': Decimal(10)}
+
+def test_reprice_writes_only_the_prices_that_moved(dynamodb):
+    products = [_product(number) for number in range(40)]
+    for item in products:
+        dynamodb.Table('Products').put_item(Item=item)
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P-no-stock', 'BasePrice': Decimal(5)})
+    expected = {item['ProductID']: pricing_engine.price_one(base_price=item['BasePrice'], demand=item['Demand'], stock=item['Stock'])
+                for item in products}
+    # P0 already holds its price
+    dynamodb.Table('CurrentPrice').put_item(Item={'ProductID': 'P0', 'CurrentPrice': expected['P0'], 'Version': 3})
+
+    summary = catalog_reprice.reprice(total_segments=3, wcu=100000)
+    assert (summary['Priced'], summary['Written'], summary['Skipped'], summary['Conflicts']) == (40, 39, 1, 0)
+    for product_id, expected_price in expected.items():
+        assert dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': product_id})['Item']['CurrentPrice'] == expected_price
+    assert dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': 'P0'})['Item']['Version'] == 3
+
+def test_a_write_that_loses_a_race_rereads_and_retries(dynamodb):
+    table = dynamodb.Table('CurrentPrice')
+    table.put_item(Item={'ProductID': 'P1', 'CurrentPrice': Decimal('1.00'), 'Version': 2})
+    stale = {'ProductID': 'P1', 'CurrentPrice': Decimal('1.00'), 'Version': 1}
+    budget = catalog_reprice.WriteBudget(1000)
+    new_price = catalog_reprice.price.Price.parse('9.99')
+    assert catalog_reprice.write_price(table, 'P1', new_price, stale, budget) == 'Written'
+    assert table.get_item(Key={'ProductID': 'P1'})['Item'] == {'ProductID': 'P1', 'CurrentPrice': Decimal('9.99'), 'Version': 3}
+    assert catalog_reprice.write_price(table, 'P1', new_price, table.get_item(Key={'ProductID': 'P1'})['Item'], budget) == 'Unchanged'
@@ -0,0 +1,41 @@
+import threading
+import pytest
+import clients
+import rate_limiter
+
+@pytest.fixture
+def fresh_clients():
+    clients.reset()
+    yield
+    clients.reset()
+
+def test_clients_are_created_once_and_shared(fresh_clients):
+    first = clients.client('sqs')
+    assert clients.client('sqs') is first
+    assert clients.client('sqs', endpoint_url='http://localhost:4566') is not first
+    assert clients.resource('dynamodb') is clients.resource('dynamodb')
+
+def test_each_thread_gets_its_own_resource(fresh_clients):
+    resources = []
+    workers = [threading.Thread(target=lambda: resources.append(clients.thread_resource('dynamodb'))) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert resources[0] is not resources[1]
+    assert clients.thread_resource('dynamodb') is clients.thread_resource('dynamodb')
+
+def test_registered_stubs_replace_clients(fresh_clients):
+    stub = object()
+    clients.register('lambda', stub)
+    assert clients.client('lambda') is stub
+
+def test_rate_limited_services_leave_retries_to_the_limiter(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'RATE_LIMIT_ENABLED', True)
+    assert clients.config('dynamodb').retries['max_attempts'] == 1
+    assert clients.config('sqs').retries['max_attempts'] == clients.MAX_ATTEMPTS
+    assert clients.config('sqs').max_pool_connections == clients.MAX_POOL_CONNECTIONS
+
+def test_rate_limited_operations_go_through_the_limiter(fresh_clients, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'RATE_LIMIT_ENABLED', True)
+    assert isinstance(clients.client('events'), rate_limiter.LimitedClient)
@@ -0,0 +1,55 @@
+import json
+import threading
+from decimal import Decimal
+import competitor
+import price
+
+def _stats():
+    return dict(competitor.OCC_STATS)
+
+def test_racing_writers_each_apply_once(dynamodb, monkeypatch):
+    monkeypatch.setattr(competitor, 'MAX_WRITE_ATTEMPTS', 50)
+    table = dynamodb.Table('CurrentPrice')
+    table.put_item(Item={'ProductID': 'P1', 'CurrentPrice': Decimal('10.00')})
+    stale = table.get_item(Key={'ProductID': 'P1'})['Item']
+    before = _stats()
+
+    statuses = []
+    workers = [threading.Thread(target=lambda cents=cents: statuses.append(
+        competitor.write_price(table, 'P1', price.Price(cents), stale)[0])) for cents in range(1000, 1008)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert statuses == [200] * 8
+    assert table.get_item(Key={'ProductID': 'P1'})['Item']['Version'] == 8
+    after = _stats()
+    assert after['Writes'] - before['Writes'] == 8 + after['Conflicts'] - before['Conflicts']
+
+def test_a_write_gives_up_after_its_attempts(dynamodb, monkeypatch):
+    monkeypatch.setattr(competitor, 'MAX_WRITE_ATTEMPTS', 3)
+    monkeypatch.setattr(competitor.time, 'sleep', lambda seconds: None)
+    table = dynamodb.Table('CurrentPrice')
+    table.put_item(Item={'ProductID': 'P1', 'CurrentPrice': Decimal('10.00'), 'Version': 1})
+    # Every re-read sees a version that another writer has moved on from
+    monkeypatch.setattr(table, 'get_item', lambda **kwargs: {'Item': {'ProductID': 'P1', 'Version': 0}})
+    before = _stats()
+
+    assert competitor.write_price(table, 'P1', price.Price(900), {'ProductID': 'P1', 'Version': 0}) == (409, None)
+    after = _stats()
+    assert (after['Conflicts'] - before['Conflicts'], after['Retries'] - before['Retries'],
+            after['Exhausted'] - before['Exhausted']) == (3, 2, 1)
+    assert dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': 'P1'})['Item']['CurrentPrice'] == Decimal('10.00')
+
+def test_handler_reports_missing_products(dynamodb):
+    response = competitor.lambda_handler({'detail': {'ProductID': 'P404', 'NewCompetitorPrice': '5.00'}}, None)
+    assert response['statusCode'] == 404
+
+def test_handler_bumps_the_version(dynamodb):
+    dynamodb.Table('CurrentPrice').put_item(Item={'ProductID': 'P1', 'CurrentPrice': Decimal('10.00'), 'Version': 7})
+    response = competitor.lambda_handler({'detail': {'ProductID': 'P1', 'NewCompetitorPrice': '5.00'}}, None)
+    assert response['statusCode'] == 200
+    item = dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': 'P1'})['Item']
+    assert item['Version'] == 8
+    assert item['CurrentPrice'] == Decimal(json.loads(response['body'])['NewCurrentPrice'])
@@ -0,0 +1,51 @@
+import boto3
+from botocore.stub import Stubber
+import price
+import table_backend
+import competitor
+
+def _stubbed_table(session):
+    table = session.resource('dynamodb', region_name='us-east-2').Table('CurrentPrice')
+    return table, Stubber(table.meta.client)
+
+def test_exception_classes_differ_between_sessions():
+    first = boto3.session.Session().client('dynamodb', region_name='us-east-2')
+    second = boto3.session.Session().client('dynamodb', region_name='us-east-2')
+    assert first.exceptions.ConditionalCheckFailedException is not second.exceptions.ConditionalCheckFailedException
+
+def test_conditional_check_failed_matches_across_sessions():
+    shared = boto3.session.Session().resource('dynamodb', region_name='us-east-2')
+    table, stubber = _stubbed_table(boto3.session.Session())
+    stubber.add_client_error('put_item', service_error_code='ConditionalCheckFailedException')
+    with stubber:
+        try:
+            table.put_item(Item={'ProductID': 'P1'}, ConditionExpression='attribute_not_exists(ProductID)')
+        except Exception as e:
+            error = e
+    assert not isinstance(error, shared.meta.client.exceptions.ConditionalCheckFailedException)
+    assert table_backend.is_conditional_check_failed(error)
+
+def test_other_errors_do_not_match(dynamodb):
+    table, stubber = _stubbed_table(boto3.session.Session())
+    stubber.add_client_error('put_item', service_error_code='ValidationException')
+    with stubber:
+        try:
+            table.put_item(Item={'ProductID': 'P1'})
+        except Exception as e:
+            error = e
+    assert not table_backend.is_conditional_check_failed(error)
+    assert not table_backend.is_conditional_check_failed(RuntimeError('boom'))
+    assert table_backend.is_conditional_check_failed(table_backend.ConditionalCheckFailedException('local'))
+
+def test_write_price_retries_a_conflict_raised_by_another_session(monkeypatch):
+    # The shared resource is the local one, the table comes from a session of its own
+    monkeypatch.setattr(competitor, 'BASE_BACKOFF_SECONDS', 0)
+    table, stubber = _stubbed_table(boto3.session.Session())
+    stubber.add_client_error('update_item', service_error_code='ConditionalCheckFailedException')
+    stubber.add_response('get_item', {'Item': {'ProductID': {'S': 'P1'}, 'CurrentPrice': {'N': '12'}, 'Version': {'N': '4'}}})
+    stubber.add_response('update_item', {'Attributes': {'ProductID': {'S': 'P1'}, 'CurrentPrice': {'N': '9.5'}, 'Version': {'N': '5'}}})
+    with stubber:
+        status, attributes = competitor.write_price(table, 'P1', price.Price.parse('9.50'), {'ProductID': 'P1', 'Version': 3})
+        stubber.assert_no_pending_responses()
+    assert status == 200
+    assert attributes['Version'] == 5
@@ -0,0 +1,93 @@
+import time
+from decimal import Decimal
+import pytest
+import customer
+import dynamo_batch
+import idempotency
+import item_cache
+import price
+
+@pytest.fixture(autouse=True)
+def fresh_filter():
+    idempotency.recent.clear()
+    yield
+    idempotency.recent.clear()
+
+def _record(selection_id, sequence_number, customer_id='C1', product_id='P1'):
+    return {'eventName': 'INSERT', 'dynamodb': {'SequenceNumber': sequence_number, 'NewImage': {
+        'SelectionID': {'S': selection_id}, 'CustomerID': {'S': customer_id}, 'ProductID': {'S': product_id}}}}
+
+@pytest.fixture
+def tables(dynamodb):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('100')})
+    dynamodb.Table('Customer').put_item(Item={'CustomerID': 'C1', 'LoyaltyLevel': 'Bronze', 'TotalSpent': Decimal(0)})
+    return dynamodb
+
+def _total_spent(dynamodb):
+    return dynamodb.Table('Customer').get_item(Key={'CustomerID': 'C1'})['Item']['TotalSpent']
+
+def test_applies_each_selection_once(tables):
+    event = {'Records': [_record('S1', '1'), _record('S2', '2')]}
+    assert customer.lambda_handler(event, None)['batchItemFailures'] == []
+    assert customer.lambda_handler(event, None)['batchItemFailures'] == []
+    assert _total_spent(tables) == Decimal('204.00')
+
+def test_error_reports_every_record(tables, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("read failed")
+    monkeypatch.setattr(item_cache, 'batch_get_items', fail)
+    response = customer.lambda_handler({'Records': [_record('S1', '1'), _record('S2', '2')]}, None)
+    assert response['statusCode'] == 500
+    assert response['batchItemFailures'] == [{'itemIdentifier': '1'}, {'itemIdentifier': '2'}]
+
+    # The redelivery applies both selections
+    monkeypatch.undo()
+    assert customer.lambda_handler({'Records': [_record('S1', '1'), _record('S2', '2')]}, None)['batchItemFailures'] == []
+    assert _total_spent(tables) == Decimal('204.00')
+
+def test_missing_product_is_applied_once_it_exists(tables):
+    customer.lambda_handler({'Records': [_record('S1', '1'), _record('S2', '2', product_id='P2')]}, None)
+    assert _total_spent(tables) == Decimal('102.00')
+    tables.Table('Products').put_item(Item={'ProductID': 'P2', 'BasePrice': Decimal('10')})
+    item_cache.cache.clear()
+    idempotency.recent.clear()
+    customer.lambda_handler({'Records': [_record('S2', '2', product_id='P2')]}, None)
+    assert _total_spent(tables) == Decimal('112.50')
+
+def test_redelivery_to_another_container_is_skipped(tables):
+    event = {'Records': [_record('S1', '1'), _record('S2', '2')]}
+    customer.lambda_handler(event, None)
+    idempotency.recent.clear()
+    item_cache.cache.clear()
+    assert customer.lambda_handler(event, None)['batchItemFailures'] == []
+    assert _total_spent(tables) == Decimal('204.00')
+
+def test_condition_catches_keys_missing_from_a_stale_read(tables):
+    customer_table = dynamo_batch.worker_table('Customer')
+    stale = customer_table.get_item(Key={'CustomerID': 'C1'})['Item']
+    spends = [('S1', price.Price.parse('102.00'))]
+    assert customer.apply_spend(customer_table, 'C1', spends, stale) == (['S1'], [])
+    spends.append(('S2', price.Price.parse('50.00')))
+    assert customer.apply_spend(customer_table, 'C1', spends, stale) == (['S2'], ['S1'])
+    assert _total_spent(tables) == Decimal('152.00')
+    assert customer_table.get_item(Key={'CustomerID': 'C1'})['Item']['LoyaltyLevel'] == 'Silver'
+
+def test_outdated_key_sets_are_removed(tables):
+    day = int(time.time() // 86400)
+    tables.Table('Customer').update_item(Key={'CustomerID': 'C1'}, UpdateExpression='SET #old = :keys',
+                                         ExpressionAttributeNames={'#old': f'AppliedKeys{day - 2}'},
+                                         ExpressionAttributeValues={':keys': {'S0'}})
+    customer.lambda_handler({'Records': [_record('S1', '1')]}, None)
+    item = tables.Table('Customer').get_item(Key={'CustomerID': 'C1'})['Item']
+    assert f'AppliedKeys{day - 2}' not in item
+    assert item[f'AppliedKeys{day}'] == {'S1'}
+
+def test_large_batches_claim_in_chunks(tables, monkeypatch):
+    updates = []
+    original = customer.apply_spend
+    monkeypatch.setattr(customer, 'apply_spend', lambda table, customer_id, spends, item:
+                        updates.append(len(spends)) or original(table, customer_id, spends, item))
+    records = [_record(f'S{number}', str(number)) for number in range(60)]
+    assert customer.lambda_handler({'Records': records}, None)['batchItemFailures'] == []
+    assert sorted(updates) == [10, 25, 25]
+    assert _total_spent(tables) == Decimal('6120.00')
@@ -0,0 +1,38 @@
+from decimal import Decimal
+import demand_and_supply
+
+def _modify(sequence_number, product_id, demand, stock, base_price='10.00'):
+    return {'eventName': 'MODIFY', 'dynamodb': {'SequenceNumber': sequence_number, 'NewImage': {
+        'ProductID': {'S': product_id}, 'BasePrice': {'N': base_price},
+        'Demand': {'N': str(demand)}, 'Stock': {'N': str(stock)}}}}
+
+def _current_price(dynamodb, product_id):
+    return dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': product_id}).get('Item')
+
+def test_coalesces_to_the_latest_image_per_product(dynamodb):
+    records = [_modify('1', 'P1', 1, 10), _modify('2', 'P2', 2, 10), _modify('3', 'P1', 10, 10)]
+    latest, malformed = demand_and_supply.coalesce_records(records)
+    assert latest == {'P1': records[2], 'P2': records[1]}
+    assert malformed == []
+
+    response = demand_and_supply.lambda_handler({'Records': records}, None)
+    assert response['batchItemFailures'] == []
+    # 10 * (1 + 0.05 * 10 / 10)
+    assert _current_price(dynamodb, 'P1')['CurrentPrice'] == Decimal('10.50')
+    assert _current_price(dynamodb, 'P1')['Version'] == 1
+
+def test_reports_a_record_that_cannot_be_priced(dynamodb):
+    records = [_modify('1', 'P1', 1, 10), _modify('2', 'P2', 5, 0), _modify('3', 'P3', 1, 10)]
+    response = demand_and_supply.lambda_handler({'Records': records}, None)
+    assert response['statusCode'] == 200
+    assert response['batchItemFailures'] == [{'itemIdentifier': '2'}]
+    assert _current_price(dynamodb, 'P2') is None
+    assert _current_price(dynamodb, 'P3') is not None
+
+def test_skips_records_that_cannot_be_parsed(dynamodb):
+    malformed = {'eventName': 'MODIFY', 'dynamodb': {'SequenceNumber': '1', 'NewImage': {}}}
+    unreadable = _modify('2', 'P2', 1, 10)
+    del unreadable['dynamodb']['NewImage']['Stock']
+    response = demand_and_supply.lambda_handler({'Records': [malformed, unreadable, _modify('3', 'P3', 1, 10)]}, None)
+    assert response['batchItemFailures'] == []
+    assert _current_price(dynamodb, 'P3') is not None
@@ -0,0 +1,53 @@
+from decimal import Decimal
+import pytest
+import dynamo_expressions
+from dynamo_expressions import ExpressionError, apply_update, evaluate_condition, project
+
+ITEM = {'ProductID': 'P1', 'Price': Decimal('10'), 'Tags': {'a', 'b'}, 'Name': 'red shoe'}
+
+@pytest.mark.parametrize('expression, expected', [
+    ('Price = :ten', True),
+    ('Price <> :ten', False),
+    ('Price < :ten OR Price >= :ten', True),
+    ('Price BETWEEN :one AND :ten', True),
+    ('Price IN (:one, :ten)', True),
+    ('NOT (Price > :one AND attribute_exists(ProductID))', False),
+    ('attribute_not_exists(Missing) AND begins_with(Name, :red)', True),
+    ('contains(Tags, :a) AND contains(Name, :shoe)', True),
+    ('NOT contains(Missing, :a)', True),
+    ('size(Tags) = :two', True),
+    ('Missing = :ten OR Missing <> :ten', False),
+])
+def test_conditions(expression, expected):
+    values = {':ten': Decimal('10'), ':one': Decimal('1'), ':two': Decimal('2'), ':a': 'a', ':red': 'red', ':shoe': 'shoe'}
+    assert evaluate_condition(expression, ITEM, values=values) is expected
+
+def test_names_are_resolved():
+    assert evaluate_condition('#p = :ten', ITEM, names={'#p': 'Price'}, values={':ten': Decimal('10')})
+    with pytest.raises(ExpressionError):
+        evaluate_condition('#p = :ten', ITEM, values={':ten': Decimal('10')})
+
+def test_update_clauses():
+    new_item, touched = apply_update(
+        'SET Price = Price + :one, Label = if_not_exists(Label, :name) REMOVE Name ADD Tags :c, Count :one DELETE Tags :a',
+        ITEM, values={':one': Decimal('1'), ':name': 'shoe', ':c': {'c'}, ':a': {'a'}})
+    assert new_item == {'ProductID': 'P1', 'Price': Decimal('11'), 'Label': 'shoe', 'Tags': {'b', 'c'}, 'Count': Decimal('1')}
+    assert set(touched) == {'Price', 'Label', 'Name', 'Tags', 'Count'}
+    # The input item is not modified
+    assert ITEM['Price'] == Decimal('10') and 'Name' in ITEM
+
+def test_set_operands_read_the_item_before_the_update():
+    new_item, _ = apply_update('SET A = B, B = A', {'A': 1, 'B': 2})
+    assert new_item == {'A': 2, 'B': 1}
+
+def test_projection():
+    assert project('ProductID, #n, Missing', ITEM, names={'#n': 'Name'}) == {'ProductID': 'P1', 'Name': 'red shoe'}
+
+@pytest.mark.parametrize('expression', ['Price = ', 'Price === :ten', 'foo(Price)', 'Price = :ten extra'])
+def test_invalid_expressions(expression):
+    with pytest.raises(ExpressionError):
+        evaluate_condition(expression, ITEM, values={':ten': Decimal('10')})
+
+def test_adding_to_a_non_number_fails():
+    with pytest.raises(ExpressionError):
+        dynamo_expressions.apply_update('ADD Name :one', ITEM, values={':one': Decimal('1')})
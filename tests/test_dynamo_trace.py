@@ -0,0 +1,57 @@
+import json
+import pytest
+import dynamo_trace
+import rate_limiter
+import table_backend
+import telemetry
+
+class _Throttled(Exception):
+    response = {'Error': {'Code': 'ProvisionedThroughputExceededException'}, 'ResponseMetadata': {'RetryAttempts': 3}}
+
+def test_rolls_up_the_calls_of_an_invocation(dynamodb, tmp_path, monkeypatch):
+    trace_file = tmp_path / 'trace.jsonl'
+    monkeypatch.setattr(dynamo_trace, 'DYNAMO_TRACE_FILE', str(trace_file))
+
+    @telemetry.instrument
+    def handler(event, context):
+        resource = table_backend.get_resource()
+        resource.Table('Products').put_item(Item={'ProductID': 'P1'})
+        resource.Table('Products').get_item(Key={'ProductID': 'P1'})
+        resource.Table('Products').get_item(Key={'ProductID': 'P2'})
+        resource.batch_get_item(RequestItems={'Products': {'Keys': [{'ProductID': 'P1'}, {'ProductID': 'P2'}]}})
+        return {'statusCode': 200}
+
+    handler({}, None)
+    rollup = dynamo_trace.last()
+    products = rollup['Tables']['Products']
+    assert (products['put_item']['Calls'], products['get_item']['Calls']) == (1, 2)
+    assert products['put_item']['Errors'] == {}
+    assert rollup['Totals']['Calls'] == 4
+    assert json.loads(trace_file.read_text())['Totals'] == rollup['Totals']
+
+def test_records_the_error_code_and_retries_of_a_failed_call(request, monkeypatch):
+    # The throttles slow down the named table's limiter; keep it to this test
+    monkeypatch.setattr(rate_limiter.time, 'sleep', lambda seconds: None)
+    rollup = dynamo_trace.Rollup()
+    token = dynamo_trace._rollup.set(rollup)
+
+    def throttled(**kwargs):
+        raise _Throttled()
+
+    try:
+        with pytest.raises(_Throttled):
+            dynamo_trace._call(request.node.name, 'update_item', throttled, {})
+    finally:
+        dynamo_trace._rollup.reset(token)
+    stats = rollup.as_dict()['Tables'][request.node.name]['update_item']
+    assert (stats['Calls'], stats['Errors'], stats['Retries']) == (1, {'ProvisionedThroughputExceededException': 1}, 3)
+
+def test_capacity_is_split_into_reads_and_writes():
+    rollup = dynamo_trace.Rollup()
+    rollup.record('Products', 'query', 1.0, 0, dynamo_trace._capacity_units({'CapacityUnits': 2.5}))
+    rollup.record('Products', 'batch_write_item', 1.0, 1,
+                  dynamo_trace._capacity_units([{'CapacityUnits': 4}, {'CapacityUnits': 1}]))
+    totals = rollup.totals()
+    assert (totals['ReadCapacityUnits'], totals['WriteCapacityUnits'], totals['Retries']) == (2.5, 5.0, 1)
+    assert dynamo_trace._units('batch_write_item', {'RequestItems': {'A': [1, 2], 'B': [3]}}) == 3
+    assert dynamo_trace._units('batch_get_item', {'RequestItems': {'A': {'Keys': [1, 2]}}}) == 2
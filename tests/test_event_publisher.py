@@ -0,0 +1,51 @@
+import json
+from decimal import Decimal
+import competitor
+import event_publisher
+import price
+
+class _EventBridge:
+    # Fails the entries whose detail is listed in failing, once each
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def put_events(self, Entries):
+        self.calls.append([json.loads(entry['Detail']) for entry in Entries])
+        results = []
+        for entry in Entries:
+            if entry['Detail'] in self.failing:
+                self.failing.discard(entry['Detail'])
+                results.append({'ErrorCode': 'ThrottlingException'})
+            else:
+                results.append({'EventId': 'id'})
+        return {'FailedEntryCount': sum(1 for result in results if 'ErrorCode' in result), 'Entries': results}
+
+def test_envelopes_stay_under_the_size_limit():
+    updates = [{'ProductID': f'P{number:05d}', 'NewCompetitorPrice': '12.34'} for number in range(1000)]
+    envelopes = list(event_publisher.pack_envelopes(updates, max_bytes=4096))
+    assert all(len(price.dumps(envelope)) <= 4096 for envelope in envelopes)
+    assert [update for envelope in envelopes for update in envelope['Updates']] == updates
+
+def test_publisher_batches_entries_and_retries_only_failed_ones(monkeypatch):
+    monkeypatch.setattr(event_publisher.time, 'sleep', lambda seconds: None)
+    client = _EventBridge(failing=[price.dumps({'n': 3})])
+    publisher = event_publisher.EventPublisher(client, 'competitor', 'update')
+    for number in range(12):
+        publisher.add({'n': number})
+    publisher.flush()
+    assert [len(call) for call in client.calls] == [10, 1, 2]
+    assert client.calls[1] == [{'n': 3}]
+    assert publisher.stats() == {'Published': 12, 'Failed': 0, 'PutEventsCalls': 3}
+
+def test_competitor_applies_every_update_of_an_envelope(dynamodb):
+    for number in range(3):
+        dynamodb.Table('CurrentPrice').put_item(Item={'ProductID': f'P{number}', 'CurrentPrice': Decimal('10.00'), 'Version': 1})
+    detail = {'Version': event_publisher.ENVELOPE_VERSION, 'Updates': [
+        {'CompetitorID': 'X1', 'ProductID': f'P{number}', 'NewCompetitorPrice': '20.00'} for number in range(4)]}
+    response = competitor.lambda_handler({'detail': detail}, None)
+    statuses = {result['ProductID']: result['Status'] for result in json.loads(response['body'])['Results']}
+    assert statuses == {'P0': 200, 'P1': 200, 'P2': 200, 'P3': 404}
+    for number in range(3):
+        item = dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': f'P{number}'})['Item']
+        assert item['CurrentPrice'] in (Decimal('19.00'), Decimal('21.00')) and item['Version'] == 2
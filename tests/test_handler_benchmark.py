@@ -0,0 +1,33 @@
+import handler_benchmark
+
+RESULT = {'RecordsPerSecond': 1000.0, 'P50Ms': 10.0, 'P99Ms': 20.0, 'PeakKB': 100.0, 'CallsPerInvocation': 4.0}
+
+def test_compare_flags_only_real_regressions():
+    baseline = {'customer/100': RESULT}
+    noise = dict(RESULT, P50Ms=11.0, P99Ms=27.0, PeakKB=110.0, RecordsPerSecond=910.0)
+    assert handler_benchmark.compare({'customer/100': noise, 'customer/1000': RESULT}, baseline, 0.2) == []
+
+    slower = dict(RESULT, P50Ms=13.0, RecordsPerSecond=770.0, CallsPerInvocation=4.5)
+    assert handler_benchmark.compare({'customer/100': slower}, baseline, 0.2) == [
+        'customer/100 P50Ms: 10.0 -> 13.0',
+        'customer/100 CallsPerInvocation: 4.0 -> 4.5',
+        'customer/100 RecordsPerSecond: 1000.0 -> 770.0'
+    ]
+
+def test_sub_timer_resolution_latencies_are_not_regressions():
+    fast = dict(RESULT, P50Ms=0.01, P99Ms=0.02)
+    assert handler_benchmark.compare({'x': dict(fast, P50Ms=0.05, P99Ms=0.1)}, {'x': fast}, 0.2) == []
+
+def _selection(customer_id, product_id):
+    return {'dynamodb': {'NewImage': {'CustomerID': {'S': customer_id}, 'ProductID': {'S': product_id}}}}
+
+def test_customer_call_budget():
+    # One read of 62 keys, three spend updates for C1's 60 selections and one
+    # for C2's, and a level update per customer
+    records = [_selection('C1', f'P{number}') for number in range(60)] + [_selection('C2', 'P0')]
+    assert handler_benchmark.customer_call_budget({'Records': records}) == 1 + 4 + 2
+
+def test_customer_scenario_stays_within_its_call_budget(dynamodb):
+    result = handler_benchmark.run_scenario('customer', handler_benchmark.Events.selections, 10, 3, 1, 42)
+    assert result['OverCallBudget'] == 0
+    assert result['Invocations'] == 3
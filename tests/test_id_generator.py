@@ -0,0 +1,43 @@
+import threading
+import pytest
+import id_generator
+
+def test_ids_are_unique_and_increasing_across_threads():
+    generator = id_generator.IdGenerator(id_generator.FixedWorker(7))
+    batches = []
+
+    def generate():
+        batches.append(generator.next_ids(5000))
+    threads = [threading.Thread(target=generate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ids = [id_ for batch in batches for id_ in batch]
+    assert len(set(ids)) == len(ids) == 20000
+    assert all(batch == sorted(batch) for batch in batches)
+    assert all((id_ >> id_generator.SEQUENCE_BITS) & id_generator.MAX_WORKER_ID == 7 for id_ in ids)
+
+def test_fixed_worker_ids_are_bounded():
+    with pytest.raises(ValueError):
+        id_generator.FixedWorker(id_generator.MAX_WORKER_ID + 1)
+
+def test_containers_lease_distinct_worker_ids(dynamodb):
+    leases = [id_generator.WorkerLease(dynamodb) for _ in range(20)]
+    assert len({lease.current() for lease in leases}) == 20
+
+def test_a_lost_lease_is_replaced(dynamodb, monkeypatch):
+    lease = id_generator.WorkerLease(dynamodb)
+    worker_id = lease.current()
+    # Another container took the worker ID over after the lease expired
+    dynamodb.Table(id_generator.WORKERS_TABLE).put_item(Item={'WorkerID': worker_id, 'Owner': 'other', 'LeaseExpiresAt': 0})
+    lease.expires_at = 0
+    monkeypatch.setattr(id_generator.random, 'randint', lambda low, high: (worker_id + 1) % (high + 1))
+    assert lease.current() == (worker_id + 1) % (id_generator.MAX_WORKER_ID + 1)
+
+def test_generation_fails_when_the_clock_jumps_back(monkeypatch):
+    generator = id_generator.IdGenerator(id_generator.FixedWorker(1))
+    generator.next_id()
+    generator.last_ms += id_generator.MAX_CLOCK_BACKWARDS_MS + 1000
+    with pytest.raises(RuntimeError):
+        generator.next_id()
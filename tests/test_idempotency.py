@@ -0,0 +1,75 @@
+import pytest
+import dynamo_batch
+import idempotency
+import table_backend
+
+@pytest.fixture(autouse=True)
+def fresh_filter():
+    idempotency.recent.clear()
+    yield
+    idempotency.recent.clear()
+
+def _claims(dynamodb):
+    return sorted(item['RecordID'] for item in dynamodb.Table(idempotency.IDEMPOTENCY_TABLE).scan()['Items'])
+
+def test_claim_owns_fresh_keys_and_skips_duplicates(dynamodb):
+    assert idempotency.claim('test', ['a', 'b', 'a']) == {'a', 'b'}
+    # Another container: its in-memory filter has not seen the keys
+    idempotency.recent.clear()
+    assert idempotency.claim('test', ['a', 'c']) == {'c'}
+    assert _claims(dynamodb) == ['test#a', 'test#b', 'test#c']
+
+def test_claim_scopes_are_separate(dynamodb):
+    assert idempotency.claim('one', ['a']) == {'a'}
+    assert idempotency.claim('two', ['a']) == {'a'}
+
+def test_release_lets_a_redelivery_claim_again(dynamodb):
+    idempotency.claim('test', ['a', 'b'])
+    idempotency.release('test', ['a'])
+    assert _claims(dynamodb) == ['test#b']
+    assert idempotency.claim('test', ['a', 'b']) == {'a'}
+
+class _FailingTable:
+    # Fails the put of one record, passes everything else to the real table
+    def __init__(self, table, failing_record_id):
+        self.table = table
+        self.failing_record_id = failing_record_id
+
+    def put_item(self, **kwargs):
+        if kwargs['Item']['RecordID'] == self.failing_record_id:
+            raise table_backend.ValidationException("put failed")
+        return self.table.put_item(**kwargs)
+
+    def delete_item(self, **kwargs):
+        return self.table.delete_item(**kwargs)
+
+def test_claim_releases_every_claimed_key_on_a_partial_error(dynamodb, monkeypatch):
+    worker_table = dynamo_batch.worker_table
+    monkeypatch.setattr(dynamo_batch, 'worker_table',
+                        lambda name: _FailingTable(worker_table(name), 'test#k2'))
+    keys = [f'k{i}' for i in range(6)]
+    with pytest.raises(table_backend.ValidationException):
+        idempotency.claim('test', keys)
+    # The keys after the failing one were claimed too, and are released as well
+    assert _claims(dynamodb) == []
+    monkeypatch.setattr(dynamo_batch, 'worker_table', worker_table)
+    assert idempotency.claim('test', keys) == set(keys)
+
+def test_inline_claim_applies_each_key_once(dynamodb):
+    table = dynamodb.Table('Customer')
+    table.put_item(Item={'CustomerID': 'C1'})
+    for _ in range(2):
+        claim = idempotency.inline_claim(['k1', 'k2'])
+        try:
+            table.update_item(Key={'CustomerID': 'C1'}, UpdateExpression=f'ADD Applied :one, {claim.add}',
+                              ConditionExpression=claim.condition, ExpressionAttributeNames=claim.names,
+                              ExpressionAttributeValues=dict(claim.values, **{':one': 1}))
+        except Exception as e:
+            assert table_backend.is_conditional_check_failed(e)
+    item = table.get_item(Key={'CustomerID': 'C1'})['Item']
+    assert item['Applied'] == 1
+    assert idempotency.applied_keys(item) == {'k1', 'k2'}
+
+def test_inline_claim_takes_a_bounded_number_of_keys():
+    with pytest.raises(ValueError):
+        idempotency.inline_claim([f'k{i}' for i in range(idempotency.MAX_INLINE_KEYS + 1)])
@@ -0,0 +1,70 @@
+import threading
+from decimal import Decimal
+import item_cache
+import demand_and_supply
+
+def test_evicts_the_least_recently_used_item():
+    cache = item_cache.ItemCache(2, {'Products': 60})
+    cache.put('Products', {'ProductID': 'P1'}, {'ProductID': 'P1'})
+    cache.put('Products', {'ProductID': 'P2'}, {'ProductID': 'P2'})
+    assert cache.get('Products', {'ProductID': 'P1'})[0]
+    cache.put('Products', {'ProductID': 'P3'}, {'ProductID': 'P3'})
+    assert not cache.get('Products', {'ProductID': 'P2'})[0]
+    assert cache.get('Products', {'ProductID': 'P1'})[0]
+    assert cache.stats()['Evictions'] == 1
+
+def test_expires_items_after_the_table_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(item_cache.time, 'monotonic', lambda: now[0])
+    cache = item_cache.ItemCache(10, {'Products': 10})
+    cache.put('Products', {'ProductID': 'P1'}, None)
+    assert cache.get('Products', {'ProductID': 'P1'}) == (True, None)
+    now[0] += 11
+    assert cache.get('Products', {'ProductID': 'P1'}) == (False, None)
+
+def test_tables_without_a_ttl_are_not_cached():
+    cache = item_cache.ItemCache(10, {'Products': 60})
+    cache.put('Customer', {'CustomerID': 'C1'}, {'CustomerID': 'C1'})
+    assert cache.stats()['Size'] == 0
+
+def test_read_through_serves_hits_from_memory(dynamodb):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('10')})
+    keys = {'Products': [{'ProductID': 'P1'}, {'ProductID': 'P2'}]}
+    items, _ = item_cache.batch_get_items(dynamodb, keys)
+    assert [item['ProductID'] for item in items['Products']] == ['P1']
+    # Served from the cache, including the absence of P2
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P2', 'BasePrice': Decimal('10')})
+    items, _ = item_cache.batch_get_items(dynamodb, keys)
+    assert [item['ProductID'] for item in items['Products']] == ['P1']
+
+def test_products_stream_invalidates_cached_products(dynamodb):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('10')})
+    assert item_cache.get_item(dynamodb.Table('Products'), {'ProductID': 'P1'})['BasePrice'] == Decimal('10')
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('12')})
+    demand_and_supply.lambda_handler({'Records': [{'eventName': 'MODIFY', 'dynamodb': {
+        'SequenceNumber': '1', 'Keys': {'ProductID': {'S': 'P1'}},
+        'NewImage': {'ProductID': {'S': 'P1'}, 'BasePrice': {'N': '12'}, 'Demand': {'N': '1'}, 'Stock': {'N': '1'}}}}]}, None)
+    assert item_cache.get_item(dynamodb.Table('Products'), {'ProductID': 'P1'})['BasePrice'] == Decimal('12')
+
+def test_concurrent_access_keeps_the_cache_consistent():
+    cache = item_cache.ItemCache(50, {'Products': 60})
+    errors = []
+
+    def work(thread):
+        try:
+            for i in range(2000):
+                key = {'ProductID': f'P{(i * 7 + thread) % 200}'}
+                if not cache.get('Products', key)[0]:
+                    cache.put('Products', key, key)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert errors == []
+    assert stats['Size'] <= 50
+    assert stats['Hits'] + stats['Misses'] == 8 * 2000
@@ -0,0 +1,38 @@
+import random
+import pytest
+import key_sampler
+
+@pytest.fixture(autouse=True)
+def cold_indexes():
+    key_sampler.invalidate()
+    yield
+    key_sampler.invalidate()
+
+def test_add_discard_and_sample_keep_the_index_dense():
+    index = key_sampler.KeyIndex(['CompetitorID', 'ProductID'])
+    for number in range(10):
+        index.add({'CompetitorID': 'X', 'ProductID': f'P{number}'})
+    index.add({'CompetitorID': 'X', 'ProductID': 'P0'})
+    index.discard({'CompetitorID': 'X', 'ProductID': 'P3'})
+    index.discard({'CompetitorID': 'X', 'ProductID': 'P9'})
+    index.discard({'CompetitorID': 'X', 'ProductID': 'missing'})
+    assert len(index) == 8
+    assert all(index.keys[position] == key for key, position in index.positions.items())
+    random.seed(1)
+    samples = {index.sample()['ProductID'] for _ in range(500)}
+    assert samples == {f'P{number}' for number in range(10)} - {'P3', 'P9'}
+
+def test_index_covers_every_key_of_a_paged_table(dynamodb, monkeypatch):
+    monkeypatch.setattr('table_backend.SCAN_PAGE_SIZE', 7)
+    table = dynamodb.Table('Products')
+    for number in range(100):
+        table.put_item(Item={'ProductID': f'P{number}', 'BasePrice': number})
+    index = key_sampler.get_index(table, ['ProductID'])
+    assert sorted(key for key, in index.keys) == sorted(f'P{number}' for number in range(100))
+    # The index is cached until it is stale or invalidated
+    assert key_sampler.get_index(table, ['ProductID']) is index
+    key_sampler.invalidate('Products')
+    assert key_sampler.get_index(table, ['ProductID']) is not index
+
+def test_empty_table_samples_none(dynamodb):
+    assert key_sampler.random_key(dynamodb.Table('Customer'), ['CustomerID']) is None
@@ -0,0 +1,68 @@
+import json
+import threading
+from decimal import Decimal
+import pytest
+import customer
+import loyalty_rebuild
+import price
+
+@pytest.fixture
+def tables(dynamodb):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('60')})
+    for customer_id in ('C1', 'C2'):
+        dynamodb.Table('Customer').put_item(Item={'CustomerID': customer_id, 'LoyaltyLevel': 'Bronze', 'TotalSpent': Decimal(0)})
+    selections = dynamodb.Table('CustomerProductSelection')
+    for selection_id, customer_id in ((1, 'C1'), (2, 'C1'), (3, 'C2'), (4, 'C1')):
+        selections.put_item(Item={'SelectionID': Decimal(selection_id), 'CustomerID': customer_id, 'ProductID': 'P1'})
+    return dynamodb
+
+def _expected_total(selections):
+    total = price.ZERO
+    for _ in range(selections):
+        level = customer.determine_loyalty_level(total.to_decimal())
+        total = total + price.Price.parse(customer.calculate_new_price(Decimal('60'), level))
+    return total.to_decimal()
+
+def _customer(dynamodb, customer_id):
+    return dynamodb.Table('Customer').get_item(Key={'CustomerID': customer_id})['Item']
+
+def test_rebuild_replays_every_selection(tables, tmp_path):
+    checkpoint_path = str(tmp_path / 'rebuild.json')
+    summary = loyalty_rebuild.rebuild(total_segments=2, checkpoint_path=checkpoint_path, resume=False)
+    assert summary['Complete'] and summary['Selections'] == 4
+    assert _customer(tables, 'C1')['TotalSpent'] == _expected_total(3)
+    assert _customer(tables, 'C1')['LoyaltyLevel'] == customer.determine_loyalty_level(_expected_total(3))
+    assert _customer(tables, 'C2')['TotalSpent'] == _expected_total(1)
+    # A complete run leaves neither the checkpoint nor the spill behind
+    assert list(tmp_path.iterdir()) == []
+
+def test_resume_ignores_pages_spilled_after_the_checkpoint(tables, tmp_path):
+    checkpoint_path = str(tmp_path / 'rebuild.json')
+    checkpoint = loyalty_rebuild.Checkpoint(checkpoint_path, 1)
+    spill = loyalty_rebuild.SelectionSpill(checkpoint_path + '.selections', checkpoint.state['SpillPartitions'])
+    loyalty_rebuild._collect_selections(checkpoint, spill, 0, threading.Event())
+
+    # The checkpoint holds file lengths, not selections
+    with open(checkpoint_path) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    assert set(state['Selections']['0']) == {'LastEvaluatedKey', 'Done', 'SpillLengths'}
+
+    # A page spilled after the last recorded one counts for nothing
+    spill.append(0, [{'CustomerID': 'C2', 'SelectionID': 9, 'ProductID': 'P1'}])
+
+    summary = loyalty_rebuild.rebuild(checkpoint_path=checkpoint_path, resume=True)
+    assert summary['Complete']
+    assert _customer(tables, 'C1')['TotalSpent'] == _expected_total(3)
+    assert _customer(tables, 'C2')['TotalSpent'] == _expected_total(1)
+
+def test_truncate_cuts_off_unrecorded_pages(tmp_path):
+    spill = loyalty_rebuild.SelectionSpill(str(tmp_path), 2)
+    lengths = spill.append(0, [{'CustomerID': 'C1', 'SelectionID': 1, 'ProductID': 'P1'}])
+    spill.append(0, [{'CustomerID': 'C1', 'SelectionID': 2, 'ProductID': 'P1'},
+                     {'CustomerID': 'C2', 'SelectionID': 3, 'ProductID': 'P1'}])
+    spill.truncate(0, lengths)
+    lengths = spill.append(0, [{'CustomerID': 'C1', 'SelectionID': 4, 'ProductID': 'P1'}])
+    selections = {}
+    for partition in range(2):
+        selections.update(spill.read(partition, {0: lengths}))
+    assert selections == {'C1': [[1, 'P1'], [4, 'P1']]}
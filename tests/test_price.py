@@ -0,0 +1,29 @@
+import json
+from decimal import Decimal
+import pytest
+import price
+from price import Price
+
+@pytest.mark.parametrize('value, cents', [
+    ('12.34', 1234), (Decimal('12.345'), 1234), (Decimal('12.355'), 1236), (12.1, 1210),
+    (7, 700), ({'N': '0.05'}, 5), ('-1.5', -150), (Price(42), 42)
+])
+def test_parse(value, cents):
+    assert Price.parse(value).cents == cents
+
+@pytest.mark.parametrize('value', ['NaN', 'Infinity', 'abc'])
+def test_invalid_prices(value):
+    with pytest.raises(Exception):
+        Price.parse(value)
+
+def test_arithmetic_and_conversions():
+    total = sum([Price(105), Price(250)], price.ZERO)
+    assert total == Price(355) and total - Price(5) == Price(350) and -total == Price(-355)
+    assert str(Price(-5)) == '-0.05' and str(Price(100)) == '1.00'
+    assert total.to_decimal() == Decimal('3.55') and total.to_decimal().as_tuple().exponent == -2
+    assert total.to_attribute() == {'N': '3.55'}
+    assert Price(1) < Price(2) and not price.ZERO
+
+def test_dumps():
+    body = json.loads(price.dumps({'Price': Price(1999), 'Count': Decimal(3), 'Rate': Decimal('0.5'), 'Tags': {'b', 'a'}}))
+    assert body == {'Price': 19.99, 'Count': 3, 'Rate': 0.5, 'Tags': ['a', 'b']}
@@ -0,0 +1,49 @@
+import time
+from decimal import Decimal
+import pytest
+import demand_and_supply
+import price
+import price_aggregator
+import price_history
+import pricing_engine
+
+@pytest.fixture
+def history(monkeypatch):
+    entries = []
+    monkeypatch.setattr(price_history, 'record', lambda product_id, new_price, source, **inputs:
+                        entries.append((product_id, new_price, source)))
+    return entries
+
+def _current_price(dynamodb, product_id):
+    return dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': product_id})['Item']['CurrentPrice']
+
+def test_expired_signals_fall_back_to_the_demand_price(dynamodb, history):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('100'),
+                                              'Demand': Decimal(20), 'Stock': Decimal(10)})
+    dynamodb.Table('CurrentPrice').put_item(Item={'ProductID': 'P1', 'CurrentPrice': Decimal('80.00')})
+    dynamodb.Table('PriceSignals').put_item(Item={'ProductID': 'P1', 'Signal': 'seasonal_sales', 'Price': Decimal('80.00'),
+                                                  'UpdatedAt': int(time.time() * 1000), 'ExpiresAt': int(time.time()) - 1})
+
+    summary = price_aggregator.aggregate(['P1'])
+    expected = pricing_engine.price_one(base_price=Decimal('100'), demand=Decimal(20), stock=Decimal(10))
+    assert summary['Written'] == 1 and summary['Fallbacks'] == 1
+    assert _current_price(dynamodb, 'P1') == expected
+    assert history == [('P1', price.Price.parse(expected), 'aggregated')]
+
+def test_undefined_demand_price_falls_back_to_the_base_price(dynamodb, history):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('100'),
+                                              'Demand': Decimal(20), 'Stock': Decimal(0)})
+    price_aggregator.aggregate(['P1'])
+    assert _current_price(dynamodb, 'P1') == Decimal('100.00')
+
+def test_signals_are_recorded_only_once_written(dynamodb, history, monkeypatch):
+    monkeypatch.setattr(price_aggregator, 'PRICE_AGGREGATION_ENABLED', True)
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('100')})
+    demand_and_supply.lambda_handler({'Records': [{'eventName': 'MODIFY', 'dynamodb': {
+        'SequenceNumber': '1', 'Keys': {'ProductID': {'S': 'P1'}},
+        'NewImage': {'ProductID': {'S': 'P1'}, 'BasePrice': {'N': '100'}, 'Demand': {'N': '20'}, 'Stock': {'N': '10'}}
+    }}]}, None)
+    assert history == []
+
+    price_aggregator.aggregate(['P1'])
+    assert [source for _, _, source in history] == ['aggregated']
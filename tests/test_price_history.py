@@ -0,0 +1,23 @@
+import pytest
+import price
+import price_history
+
+def test_lambda_requires_a_durable_directory():
+    lambda_environ = {'AWS_LAMBDA_FUNCTION_NAME': 'customer'}
+    with pytest.raises(RuntimeError):
+        price_history.store_directory(lambda_environ)
+    with pytest.raises(RuntimeError):
+        price_history.store_directory(dict(lambda_environ, PRICE_HISTORY_DIR='/tmp/price_history'))
+    assert price_history.store_directory(dict(lambda_environ, PRICE_HISTORY_DIR='/mnt/efs/history')) == '/mnt/efs/history'
+    assert price_history.store_directory(lambda_environ, enabled=False) == '/tmp/price_history'
+    assert price_history.store_directory({}) == '/tmp/price_history'
+
+def test_flushed_entries_can_be_queried(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_history, 'PRICE_HISTORY_ENABLED', True)
+    monkeypatch.setattr(price_history, '_store', price_history.PriceHistoryStore(str(tmp_path)))
+    price_history.record('P1', price.Price.parse('12.50'), 'competitor', competitor_price=price.Price.parse('13'), timestamp=1000)
+    price_history.record('P2', price.Price.parse('8'), 'aggregated', timestamp=2000)
+    price_history.flush()
+    entries = price_history.query('P1')
+    assert [(entry['Timestamp'], entry['Source']) for entry in entries] == [(1000, 'competitor')]
+    assert [entry['Source'] for entry in price_history.query(start=1500)] == ['aggregated']
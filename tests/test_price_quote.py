@@ -0,0 +1,41 @@
+import base64
+import json
+from decimal import Decimal
+import pytest
+import customer
+import price_quote
+
+@pytest.fixture
+def tables(dynamodb):
+    dynamodb.Table('Customer').put_item(Item={'CustomerID': 'C1', 'LoyaltyLevel': 'Gold', 'TotalSpent': Decimal(300)})
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('100')})
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P2', 'BasePrice': Decimal('19.99')})
+    dynamodb.Table('CurrentPrice').put_item(Item={'ProductID': 'P1', 'CurrentPrice': Decimal('95.00')})
+    return dynamodb
+
+def _quote(event):
+    response = price_quote.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+def test_quotes_match_what_customer_charges(tables):
+    status, body = _quote({'body': json.dumps({'CustomerID': 'C1', 'ProductIDs': ['P1', 'P2', 'P1', 'P9']})})
+    assert status == 200
+    assert [quote['ProductID'] for quote in body['Quotes']] == ['P1', 'P2']
+    assert body['NotFound'] == ['P9']
+    expected = [customer.calculate_new_price(Decimal('100'), 'Gold'), customer.calculate_new_price(Decimal('19.99'), 'Gold')]
+    assert [Decimal(str(quote['Price'])) for quote in body['Quotes']] == expected
+    assert body['Quotes'][0]['CurrentPrice'] == 95.0 and body['Quotes'][1]['CurrentPrice'] is None
+    assert Decimal(str(body['Total'])) == sum(expected)
+
+def test_request_forms(tables):
+    assert _quote({'queryStringParameters': {'CustomerID': 'C1', 'ProductIDs': 'P1,P2'}})[0] == 200
+    encoded = base64.b64encode(json.dumps({'CustomerID': 'C1', 'ProductIDs': 'P1'}).encode()).decode()
+    assert _quote({'body': encoded, 'isBase64Encoded': True})[0] == 200
+    assert _quote({'CustomerID': 'C1', 'ProductIDs': ['P1']})[0] == 200
+
+def test_invalid_requests(tables, monkeypatch):
+    assert _quote({'CustomerID': 'C1'})[0] == 400
+    assert _quote({'body': '{not json'})[0] == 400
+    assert _quote({'CustomerID': 'C9', 'ProductIDs': ['P1']})[0] == 404
+    monkeypatch.setattr(price_quote, 'MAX_QUOTE_ITEMS', 1)
+    assert _quote({'CustomerID': 'C1', 'ProductIDs': ['P1', 'P2']})[0] == 400
@@ -0,0 +1,57 @@
+import random
+from decimal import Decimal, ROUND_HALF_EVEN
+import numpy as np
+import pricing_engine
+
+# The per-item Decimal rules the handlers applied before the pricing engine
+CENT = Decimal('0.01')
+
+def _demand_baseline(base_price, demand, stock):
+    return (base_price * (Decimal(1) + Decimal('0.05') * (demand / stock))).quantize(CENT, ROUND_HALF_EVEN)
+
+def _loyalty_baseline(base_price, loyalty_level):
+    coefficient = pricing_engine.LOYALTY_COEFFICIENTS.get(loyalty_level, Decimal('0.02'))
+    return (base_price * (Decimal('1.0') + coefficient)).quantize(CENT, ROUND_HALF_EVEN)
+
+def _discount_baseline(base_price, discount):
+    return (base_price * (1 - discount)).quantize(CENT, ROUND_HALF_EVEN)
+
+def _base_prices(rng, size):
+    return [Decimal(rng.randint(1, 5000000)).scaleb(-2) for _ in range(size)]
+
+def test_demand_rule_matches_the_decimal_baseline():
+    rng = random.Random(1)
+    base_prices = _base_prices(rng, 5000)
+    demands = [Decimal(rng.randint(0, 1000)) for _ in base_prices]
+    stocks = [Decimal(rng.randint(1, 1000)) for _ in base_prices]
+    prices = pricing_engine.to_decimals(pricing_engine.price_batch(base_price=base_prices, demand=demands, stock=stocks))
+    assert prices == [_demand_baseline(*inputs) for inputs in zip(base_prices, demands, stocks)]
+
+def test_loyalty_rule_matches_the_decimal_baseline():
+    rng = random.Random(2)
+    base_prices = _base_prices(rng, 5000)
+    levels = [rng.choice(['Bronze', 'Silver', 'Gold', 'Platinum', 'Unknown']) for _ in base_prices]
+    prices = [price.to_decimal() for price in pricing_engine.customer_prices(base_prices, levels)]
+    assert prices == [_loyalty_baseline(*inputs) for inputs in zip(base_prices, levels)]
+
+def test_discount_and_competitor_rules_match_the_decimal_baseline():
+    rng = random.Random(3)
+    base_prices = _base_prices(rng, 5000)
+    discount = Decimal('0.15')
+    prices = pricing_engine.to_decimals(pricing_engine.price_batch(base_price=base_prices, discount=discount))
+    assert prices == [_discount_baseline(base_price, discount) for base_price in base_prices]
+
+    offsets = [rng.choice(pricing_engine.COMPETITOR_OFFSETS) for _ in base_prices]
+    prices = pricing_engine.to_decimals(pricing_engine.price_batch(competitor_price=base_prices, competitor_offset=offsets))
+    assert prices == [base_price + offset for base_price, offset in zip(base_prices, offsets)]
+
+def test_half_cent_ties_round_half_even():
+    # 0.125 and 0.135 are not exact in binary; the Decimal fallback settles them
+    prices = pricing_engine.price_batch(base_price=[Decimal('0.25'), Decimal('0.27')], discount=Decimal('0.5'))
+    assert pricing_engine.to_decimals(prices) == [Decimal('0.12'), Decimal('0.14')]
+
+def test_undefined_prices_are_nan():
+    prices = pricing_engine.price_batch(base_price=[10, 10], demand=[5, 5], stock=[0, 5])
+    assert np.isnan(prices[0])
+    assert pricing_engine.to_prices(prices)[0] is None
+    assert pricing_engine.price_one(base_price=Decimal('10'), demand=Decimal(5), stock=Decimal(0)) is None
@@ -0,0 +1,93 @@
+import random
+from datetime import date, timedelta
+import pytest
+import promotion_index
+import seasonal_dispatch
+import seasonal_sales_trigger
+
+def _event(event_id, start, end):
+    return {'EventID': event_id, 'StartDate': start.strftime('%d-%m-%Y'), 'EndDate': end.strftime('%d-%m-%Y')}
+
+def _change_event(event_id):
+    return {'Records': [{
+        'eventSource': 'aws:dynamodb', 'eventName': 'MODIFY',
+        'eventSourceARN': 'arn:aws:dynamodb:us-east-2:123456789012:table/EventsPromotions/stream/2023-01-01T00:00:00.000',
+        'dynamodb': {'SequenceNumber': '1', 'Keys': {'EventID': {'S': event_id}}}
+    }]}
+
+@pytest.fixture(autouse=True)
+def cold_index():
+    promotion_index.invalidate()
+    yield
+    promotion_index.invalidate()
+
+def test_active_on_matches_a_linear_scan():
+    rng = random.Random(7)
+    first = date(2023, 1, 1)
+    events = []
+    for number in range(300):
+        start = first + timedelta(days=rng.randrange(365))
+        events.append(_event(str(number), start, start + timedelta(days=rng.randrange(40))))
+    index = promotion_index.PromotionIndex(events)
+    for offset in range(-5, 410, 3):
+        day = first + timedelta(days=offset)
+        expected = [event for event in events
+                    if promotion_index.parse_date(event['StartDate']) <= day.toordinal() <= promotion_index.parse_date(event['EndDate'])]
+        found = index.active_on(day)
+        assert sorted(event['EventID'] for event in found) == sorted(event['EventID'] for event in expected)
+        assert [promotion_index.parse_date(event['StartDate']) for event in found] == \
+            sorted(promotion_index.parse_date(event['StartDate']) for event in expected)
+
+def test_invalid_dates_are_skipped():
+    index = promotion_index.PromotionIndex([_event('1', date(2023, 1, 1), date(2023, 1, 5)),
+                                            {'EventID': '2', 'StartDate': '2023-01-01', 'EndDate': '05-01-2023'}])
+    assert [event['EventID'] for event in index.invalid] == ['2']
+    assert [event['EventID'] for event in index.active_on(date(2023, 1, 3))] == ['1']
+
+def test_other_containers_see_a_change_at_their_next_version_check(dynamodb, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(promotion_index.time, 'monotonic', lambda: clock[0])
+    table = dynamodb.Table('EventsPromotions')
+    table.put_item(Item=_event('1', date(2023, 1, 1), date(2023, 1, 5)))
+    assert len(promotion_index.get_index(table)) == 1
+
+    # The stream delivers the change to another container, which bumps the version
+    table.put_item(Item=_event('2', date(2023, 1, 2), date(2023, 1, 3)))
+    promotion_index.bump_version(table)
+    assert len(promotion_index.get_index(table)) == 1
+
+    clock[0] += promotion_index.PROMOTION_INDEX_CHECK_SECONDS + 1
+    index = promotion_index.get_index(table)
+    assert sorted(event['EventID'] for event in index.events) == ['1', '2']
+    assert index.version == 1
+
+def test_trigger_bumps_the_version_and_ignores_the_marker_change(dynamodb):
+    table = dynamodb.Table('EventsPromotions')
+    assert seasonal_sales_trigger.lambda_handler(_change_event('1'), None)['statusCode'] == 200
+    assert promotion_index.read_version(table) == 1
+    assert seasonal_sales_trigger.lambda_handler(_change_event(promotion_index.VERSION_EVENT_ID), None)['statusCode'] == 200
+    assert promotion_index.read_version(table) == 1
+    assert promotion_index.get_index(table).events == []
+
+def test_overlapping_promotions_give_each_product_one_discount():
+    events = [
+        dict(_event('early', date(2023, 1, 1), date(2023, 1, 9)), AffectedProducts='P1,P2,P3', DiscountRate='0.2'),
+        dict(_event('late', date(2023, 1, 3), date(2023, 1, 9)), AffectedProducts='P2,P3,P4', DiscountRate='0.1'),
+        dict(_event('deep', date(2023, 1, 2), date(2023, 1, 9)), AffectedProducts='P3', DiscountRate='0.3'),
+        dict(_event('tie', date(2023, 1, 2), date(2023, 1, 9)), AffectedProducts='P4', DiscountRate='0.1')
+    ]
+    resolved = promotion_index.resolve_overlaps(events)
+    # The highest rate wins, then the latest StartDate; 'tie' wins nothing
+    assert [(event['EventID'], event['AffectedProducts']) for event in resolved] == \
+        [('early', 'P1,P2'), ('late', 'P4'), ('deep', 'P3')]
+
+def test_trigger_dispatches_each_product_once(dynamodb, monkeypatch):
+    dispatched = []
+    monkeypatch.setattr(seasonal_dispatch, 'dispatch',
+                        lambda selected_date, event: dispatched.append((event['EventID'], event['AffectedProducts'])) or [])
+    monkeypatch.setattr(seasonal_sales_trigger.random, 'random', lambda: 1.0)
+    table = dynamodb.Table('EventsPromotions')
+    table.put_item(Item=dict(_event('1', date(2023, 1, 1), date(2023, 1, 1)), AffectedProducts='P1,P2', DiscountRate='0.2'))
+    table.put_item(Item=dict(_event('2', date(2023, 1, 1), date(2023, 1, 1)), AffectedProducts='P2', DiscountRate='0.1'))
+    seasonal_sales_trigger.lambda_handler({}, None)
+    assert dispatched == [('1', 'P1,P2')]
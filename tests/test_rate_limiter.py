@@ -0,0 +1,83 @@
+import pytest
+import rate_limiter
+import table_backend
+
+class _Throttled(Exception):
+    def __init__(self, code='ProvisionedThroughputExceededException', status=400):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rate_limiter.time, 'sleep', sleeps.append)
+    return sleeps
+
+def _flaky(errors, response=None):
+    calls = []
+
+    def function(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return response if response is not None else {'ok': True}
+    return function, calls
+
+def test_throttles_are_retried_and_shrink_the_rate(request):
+    function, calls = _flaky([_Throttled(), _Throttled()])
+    response = rate_limiter.call(request.node.name, function, {'Key': 1})
+    assert response['ResponseMetadata']['RetryAttempts'] == 2
+    assert len(calls) == 3
+    limiter = rate_limiter.get(request.node.name)
+    # The two throttles fall in one burst and shrink the rate once; the
+    # success grows it back no further than twice the measured throughput
+    assert limiter.state()['Throttles'] == 2 and limiter.state()['Retries'] == 2
+    assert rate_limiter.RATE_LIMIT_MIN_RATE < limiter.rate <= 2 * len(calls)
+
+def test_other_errors_are_raised_at_once(request):
+    function, calls = _flaky([table_backend.ConditionalCheckFailedException("no")])
+    with pytest.raises(table_backend.ConditionalCheckFailedException):
+        rate_limiter.call(request.node.name, function, {})
+    assert len(calls) == 1
+
+def test_transient_errors_are_retried_without_shrinking_the_rate(request):
+    function, calls = _flaky([_Throttled('InternalServerError', 500), _Throttled('Unknown', 503)])
+    rate_limiter.call(request.node.name, function, {})
+    assert len(calls) == 3
+    assert rate_limiter.get(request.node.name).rate is None
+
+def test_attempts_are_bounded(request):
+    function, calls = _flaky([_Throttled()] * rate_limiter.RATE_LIMIT_MAX_ATTEMPTS)
+    with pytest.raises(_Throttled):
+        rate_limiter.call(request.node.name, function, {})
+    assert len(calls) == rate_limiter.RATE_LIMIT_MAX_ATTEMPTS
+
+def test_unprocessed_batch_items_count_as_throttles(request):
+    function, _ = _flaky([], {'UnprocessedItems': {'Products': [{}]}})
+    rate_limiter.call(request.node.name, function, {})
+    assert rate_limiter.get(request.node.name).state()['Throttles'] == 1
+
+def test_a_limited_bucket_makes_callers_wait(request, no_sleep):
+    limiter = rate_limiter.get(request.node.name)
+    limiter.on_throttle()
+    limiter.rate = 10.0
+    limiter.tokens = 0.0
+    limiter.updated = rate_limiter.time.monotonic()
+    assert limiter.acquire(5) == pytest.approx(0.5, abs=0.01)
+    assert no_sleep and no_sleep[-1] == pytest.approx(0.5, abs=0.01)
+
+def test_successes_grow_the_rate(request):
+    limiter = rate_limiter.get(request.node.name)
+    limiter.on_throttle()
+    limiter.rate = 100.0
+    limiter.throttled_rate = 1000.0
+    limiter.measured_rate = 100.0
+    limiter.on_success()
+    assert 100.0 < limiter.rate <= 200.0
+
+def test_disabled_limiter_calls_straight_through(request, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'RATE_LIMIT_ENABLED', False)
+    function, calls = _flaky([_Throttled()])
+    with pytest.raises(_Throttled):
+        rate_limiter.call(request.node.name, function, {})
+    assert len(calls) == 1
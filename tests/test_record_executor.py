@@ -0,0 +1,44 @@
+import threading
+import time
+import record_executor
+
+def test_items_of_a_key_run_in_order_and_keys_in_parallel():
+    seen = {}
+    running = []
+    overlap = threading.Event()
+    lock = threading.Lock()
+
+    def function(item):
+        key, number = item
+        with lock:
+            running.append(key)
+            if len(set(running)) > 1:
+                overlap.set()
+        time.sleep(0.01)
+        with lock:
+            running.remove(key)
+            seen.setdefault(key, []).append(number)
+        return number * 10
+
+    items = [(key, number) for number in range(5) for key in 'abcd']
+    results = record_executor.process(items, key=lambda item: item[0], function=function)
+    assert [item for item, _, _ in results] == items
+    assert [result for _, result, _ in results] == [number * 10 for _, number in items]
+    assert all(numbers == list(range(5)) for numbers in seen.values())
+    assert overlap.is_set()
+
+def test_later_items_of_a_failed_key_are_skipped():
+    def function(item):
+        if item == ('a', 1):
+            raise ValueError("failed")
+        return item
+
+    items = [('a', 0), ('b', 0), ('a', 1), ('a', 2), ('b', 1)]
+    results = record_executor.process(items, key=lambda item: item[0], function=function)
+    errors = {item: error for item, _, error in results}
+    assert errors[('a', 0)] is None and errors[('b', 0)] is None and errors[('b', 1)] is None
+    assert isinstance(errors[('a', 1)], ValueError)
+    assert isinstance(errors[('a', 2)], record_executor.SkippedRecord)
+
+def test_empty_batches():
+    assert record_executor.process([], key=lambda item: item, function=lambda item: item) == []
@@ -0,0 +1,41 @@
+import json
+from decimal import Decimal
+import seasonal_sales
+
+def _promotion(products, discount='0.2'):
+    return {'SelectedDate': '2026-11-27', 'ActiveEvent': {
+        'EventID': 'E1', 'DiscountRate': discount, 'AffectedProducts': products}}
+
+def test_applies_the_discount_to_every_product_once(dynamodb):
+    for number in range(150):
+        dynamodb.Table('Products').put_item(Item={'ProductID': f'P{number}', 'BasePrice': Decimal('10.00')})
+    products = ','.join(f'P{number}' for number in range(150))
+
+    response = seasonal_sales.lambda_handler(_promotion(products + ', P0,P1'), None)
+    assert response['statusCode'] == 200
+    assert response['FailedProducts'] == []
+    updated = json.loads(response['body'])
+    assert [product['ProductID'] for product in updated] == [f'P{number}' for number in range(150)]
+    assert {product['NewCurrentPrice'] for product in updated} == {8.0}
+    item = dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': 'P149'})['Item']
+    assert (item['CurrentPrice'], item['Version']) == (Decimal('8.00'), 1)
+
+def test_lists_missing_products_next_to_the_body(dynamodb):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('20.00')})
+    response = seasonal_sales.lambda_handler(_promotion('P1,P2'), None)
+    assert [product['ProductID'] for product in json.loads(response['body'])] == ['P1']
+    assert response['FailedProducts'] == [{'ProductID': 'P2', 'Reason': 'Product not found'}]
+    assert dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': 'P2'}).get('Item') is None
+
+def test_no_active_event(dynamodb):
+    response = seasonal_sales.lambda_handler({'SelectedDate': '2026-11-27', 'ActiveEvent': None}, None)
+    assert json.loads(response['body']) == {'message': 'No active event on the selected date.'}
+
+def test_reports_the_sqs_shards_that_fail(dynamodb):
+    dynamodb.Table('Products').put_item(Item={'ProductID': 'P1', 'BasePrice': Decimal('10.00')})
+    records = [
+        {'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': json.dumps(_promotion('P1'))},
+        {'eventSource': 'aws:sqs', 'messageId': 'm2', 'body': 'not json'}
+    ]
+    assert seasonal_sales.lambda_handler({'Records': records}, None) == {'batchItemFailures': [{'itemIdentifier': 'm2'}]}
+    assert dynamodb.Table('CurrentPrice').get_item(Key={'ProductID': 'P1'})['Item']['CurrentPrice'] == Decimal('8.00')
@@ -0,0 +1,69 @@
+from decimal import Decimal
+import threading
+import pytest
+import table_backend
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def resource(request, tmp_path):
+    if request.param == 'memory':
+        return table_backend.MemoryResource()
+    return table_backend.SQLiteResource(str(tmp_path / 'tables.db'))
+
+def test_items_round_trip(resource):
+    table = resource.Table('Products')
+    item = {'ProductID': 'P1', 'BasePrice': Decimal('12.50'), 'Tags': {'a'}, 'Sizes': [Decimal(1), 'M'],
+            'Meta': {'Color': 'red'}, 'Active': True}
+    table.put_item(Item=item)
+    assert table.get_item(Key={'ProductID': 'P1'})['Item'] == item
+    assert 'Item' not in table.get_item(Key={'ProductID': 'P2'})
+    assert table.get_item(Key={'ProductID': 'P1'}, ProjectionExpression='BasePrice')['Item'] == {'BasePrice': Decimal('12.50')}
+
+def test_conditional_writes(resource):
+    table = resource.Table('CurrentPrice')
+    table.put_item(Item={'ProductID': 'P1', 'Version': 1}, ConditionExpression='attribute_not_exists(ProductID)')
+    with pytest.raises(table_backend.ConditionalCheckFailedException) as raised:
+        table.put_item(Item={'ProductID': 'P1'}, ConditionExpression='attribute_not_exists(ProductID)')
+    assert table_backend.is_conditional_check_failed(raised.value)
+
+    response = table.update_item(Key={'ProductID': 'P1'}, UpdateExpression='SET CurrentPrice = :p ADD Version :one',
+                                 ConditionExpression='Version = :v', ReturnValues='UPDATED_NEW',
+                                 ExpressionAttributeValues={':p': Decimal('5'), ':one': 1, ':v': 1})
+    assert response['Attributes'] == {'CurrentPrice': Decimal('5'), 'Version': Decimal('2')}
+    with pytest.raises(table_backend.ConditionalCheckFailedException):
+        table.delete_item(Key={'ProductID': 'P1'}, ConditionExpression='Version = :v', ExpressionAttributeValues={':v': 1})
+
+def test_segmented_scans_cover_the_table_once(resource):
+    table = resource.Table('Customer')
+    for number in range(250):
+        table.put_item(Item={'CustomerID': f'C{number}', 'TotalSpent': Decimal(number)})
+    seen = []
+    for segment in range(4):
+        kwargs = {'Segment': segment, 'TotalSegments': 4, 'Limit': 30}
+        while True:
+            response = table.scan(**kwargs)
+            seen.extend(item['CustomerID'] for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    assert sorted(seen) == sorted(f'C{number}' for number in range(250))
+
+def test_batch_calls(resource):
+    resource.batch_write_item(RequestItems={'Products': [{'PutRequest': {'Item': {'ProductID': f'P{n}'}}} for n in range(3)]})
+    response = resource.batch_get_item(RequestItems={'Products': {'Keys': [{'ProductID': 'P0'}, {'ProductID': 'P9'}]}})
+    assert response['Responses']['Products'] == [{'ProductID': 'P0'}]
+    assert response['UnprocessedKeys'] == {}
+
+def test_concurrent_adds_are_atomic(resource):
+    table = resource.Table('Customer')
+    table.put_item(Item={'CustomerID': 'C1', 'TotalSpent': Decimal(0)})
+
+    def add():
+        for _ in range(50):
+            table.update_item(Key={'CustomerID': 'C1'}, UpdateExpression='ADD TotalSpent :one',
+                              ExpressionAttributeValues={':one': 1})
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert table.get_item(Key={'CustomerID': 'C1'})['Item']['TotalSpent'] == 400
@@ -0,0 +1,70 @@
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import telemetry
+
+def _emf_lines(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+def test_an_invocation_writes_its_metrics_in_one_line(capsys, monkeypatch):
+    monkeypatch.setattr(telemetry, 'METRICS_ENABLED', True)
+
+    @telemetry.instrument
+    def handler(event, context):
+        telemetry.count('PricesUpdated', 3)
+        telemetry.count('PricesUpdated')
+        with telemetry.timer('Write'):
+            pass
+        return {'statusCode': 500}
+
+    handler({}, None)
+    line, = _emf_lines(capsys.readouterr().out)
+    assert (line['Handler'], line['PricesUpdated'], line['Errors'], line['Invocations']) == (handler.__module__, 4, 1, 1)
+    assert line['Write']['Counts'] == [1]
+    assert {metric['Name'] for metric in line['_aws']['CloudWatchMetrics'][0]['Metrics']} == {
+        'PricesUpdated', 'Errors', 'Invocations', 'Write', 'Duration'}
+
+    # Outside an invocation nothing is recorded
+    telemetry.count('PricesUpdated')
+    assert _emf_lines(capsys.readouterr().out) == []
+
+def test_concurrent_invocations_keep_their_own_metrics(monkeypatch):
+    flushed = []
+    monkeypatch.setattr(telemetry.Metrics, 'flush', lambda self, request_id=None: flushed.append(dict(self.counters)))
+    barrier = threading.Barrier(2)
+
+    @telemetry.instrument
+    def handler(event, context):
+        barrier.wait()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(telemetry.propagate(lambda _: telemetry.count('Seen')), range(event['n'])))
+        return {'statusCode': 200}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda n: handler({'n': n}, None), [2, 5]))
+    assert sorted(counters['Seen'] for counters in flushed) == [2, 5]
+
+def test_histograms_fit_the_emf_value_limit():
+    histogram = telemetry._histogram([value / 7 for value in range(5000)])
+    assert len(histogram['Values']) <= telemetry.MAX_HISTOGRAM_VALUES
+    assert sum(histogram['Counts']) == 5000
+
+def test_debug_lines_follow_the_sampling(monkeypatch):
+    output = io.StringIO()
+    monkeypatch.setattr(telemetry._stream_handler, 'stream', output)
+    log = telemetry.get_logger('test')
+
+    @telemetry.instrument
+    def handler(event, context):
+        log.debug("Sampled line", Value=1)
+        return {'statusCode': 200}
+
+    monkeypatch.setattr(telemetry, 'sample_rate', lambda handler: 0.0)
+    handler({}, None)
+    assert output.getvalue() == ''
+
+    monkeypatch.setattr(telemetry, 'sample_rate', lambda handler: 1.0)
+    handler({}, type('Context', (), {'aws_request_id': 'r1'})())
+    entry = json.loads(output.getvalue())
+    assert (entry['message'], entry['Value'], entry['request_id']) == ('Sampled line', 1, 'r1')